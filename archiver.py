@@ -0,0 +1,161 @@
+import os
+import time
+import zlib
+import tarfile
+import zipfile
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from surface_maps import list_results, ordered_map
+
+logger = logging.getLogger('citycat-dafni')
+
+# Archive file extension of each codec
+extensions = {'deflate': '.zip', 'store': '.zip', 'zstd': '.tar.zst'}
+
+
+def deflate(path, level=zlib.Z_DEFAULT_COMPRESSION, chunk_size=1 << 24):
+    """Compresses a file with raw deflate as used by zip files
+
+    Returns:
+        tuple: CRC-32 and size of the file and the compressed data
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc, size, chunks = 0, 0, []
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    return crc, size, b''.join(chunks)
+
+
+class Archive:
+    """Archive to which files can be added while they are still being created
+
+    With the deflate codec, the files added together are compressed in parallel and written to a standard zip file.
+    Deflate is what shutil.make_archive uses and it runs on a single thread.
+    The store codec writes a zip file without compression and the zstd codec a tar file compressed by zstandard using
+    several threads.
+
+    Args:
+        path: Archive to create
+        codec: deflate, store or zstd
+        workers: Number of files compressed at the same time, or threads used by zstandard
+    """
+    def __init__(self, path, codec='deflate', workers=None):
+        assert codec in extensions, f'Unknown archive codec {codec}, must be one of {list(extensions)}'
+        self.path = path
+        self.codec = codec
+        self.workers = workers or os.cpu_count()
+        self.names = set()
+        self.bytes_in = 0
+        self.seconds = 0
+
+        if codec == 'zstd':
+            import zstandard
+            self.file = open(path, 'wb')
+            self.writer = zstandard.ZstdCompressor(threads=self.workers).stream_writer(self.file)
+            self.tar = tarfile.open(fileobj=self.writer, mode='w|')
+        else:
+            self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED if codec == 'deflate' else zipfile.ZIP_STORED)
+            self.executor = ThreadPoolExecutor(self.workers) if codec == 'deflate' else None
+
+    def add(self, paths):
+        """Adds files to the root of the archive, in order"""
+        start = time.perf_counter()
+        if self.codec == 'deflate':
+            # zlib releases the GIL, so the files are compressed in parallel by threads
+            compressed = ordered_map(self.executor, deflate, paths, ahead=2 * self.workers)
+            for path, (crc, size, data) in zip(paths, compressed):
+                self.write_deflated(path, crc, size, data)
+        for path in paths:
+            name = os.path.basename(path)
+            if self.codec == 'store':
+                self.zip.write(path, name)
+            elif self.codec == 'zstd':
+                self.tar.add(path, name)
+            self.names.add(name)
+            self.bytes_in += os.path.getsize(path)
+        self.seconds += time.perf_counter() - start
+
+    def write_deflated(self, path, crc, size, data):
+        # Writes an entry already compressed, in the same way as ZipFile.write, since both ZipFile.write and
+        # ZipFile.open would compress it again. This uses the fp, start_dir, filelist and NameToInfo attributes of
+        # ZipFile, which are not public, so `python benchmarks/archive.py --zip64` checks the archives with
+        # zipfile.testzip, including a ZIP64 entry.
+        # The flag bits are left as ZipInfo creates them, which is what ZipFile.write uses for deflate on a seekable
+        # file, and FileHeader adds the UTF-8 flag and the ZIP64 extra field when they are needed.
+        info = zipfile.ZipInfo.from_file(path, os.path.basename(path))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.CRC, info.file_size, info.compress_size = crc, size, len(data)
+        self.zip.fp.seek(self.zip.start_dir)
+        info.header_offset = self.zip.fp.tell()
+        self.zip.fp.write(info.FileHeader())
+        self.zip.fp.write(data)
+        self.zip.filelist.append(info)
+        self.zip.NameToInfo[info.filename] = info
+        self.zip.start_dir = self.zip.fp.tell()
+
+    def add_directory(self, in_path):
+        """Adds the files in a directory which have not already been added"""
+        self.add([os.path.join(in_path, name) for name in sorted(os.listdir(in_path))
+                  if name not in self.names and os.path.isfile(os.path.join(in_path, name))])
+
+    def close(self):
+        """Finishes the archive
+
+        Returns:
+            dict: Codec, number of files, uncompressed and archive sizes, compression ratio and throughput
+        """
+        start = time.perf_counter()
+        if self.codec == 'zstd':
+            self.tar.close()
+            self.writer.close()
+            if not self.file.closed:
+                self.file.close()
+        else:
+            self.zip.close()
+            if self.executor is not None:
+                self.executor.shutdown()
+        self.seconds += time.perf_counter() - start
+
+        bytes_out = os.path.getsize(self.path)
+        report = dict(codec=self.codec, files=len(self.names), bytes_in=self.bytes_in, bytes_out=bytes_out,
+                      ratio=round(self.bytes_in / bytes_out, 2) if bytes_out > 0 else None,
+                      seconds=round(self.seconds, 3),
+                      mb_per_second=round(self.bytes_in / 1e6 / self.seconds, 1) if self.seconds > 0 else None)
+        logger.info(f'---- Archived {report["files"]} files with {self.codec}, ratio {report["ratio"]}, '
+                    f'{report["mb_per_second"]}MB/s')
+        return report
+
+
+def archive_directory(in_path, out_path, codec='deflate', workers=None):
+    """Archives the files in a directory, the equivalent of shutil.make_archive for a directory without subdirectories
+
+    Returns:
+        dict: Report created by :meth:`Archive.close`
+    """
+    archive = Archive(out_path, codec=codec, workers=workers)
+    archive.add_directory(in_path)
+    return archive.close()
+
+
+def watch(in_path, process, archive, interval=5):
+    """Adds CityCAT results files to an archive while the simulation is running
+
+    A results file is taken to be complete once a file for a later time step exists, or once the process has exited.
+    The remaining files are left to be added once CityCAT has exited.
+
+    Args:
+        in_path: path where CityCAT writes results files
+        process: The running CityCAT process
+        archive: Archive to add files to
+        interval: Seconds to wait between checking for new results files
+    """
+    while process.poll() is None:
+        file_paths = list_results(in_path)[:-1] if os.path.exists(in_path) else []
+        file_paths = [path for path in file_paths if os.path.basename(path) not in archive.names]
+        if len(file_paths) > 0:
+            archive.add(file_paths)
+        time.sleep(interval)
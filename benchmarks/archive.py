@@ -0,0 +1,105 @@
+"""Compares archiving surface maps with shutil.make_archive against each codec of archiver.Archive
+
+Usage: python benchmarks/archive.py [--steps 24] [--cells 500000] [--workers 4] [--zip64] [path]
+
+Surface maps are written by citycat_stub.py for a synthetic DEM, unless a directory of existing surface maps is given.
+Each archive is checked with zipfile.testzip to contain every file with the same contents before its time, throughput
+and ratio are printed. With --zip64, a sparse file larger than 2GiB is added to the generated surface maps so that the
+zip files need ZIP64 extensions.
+"""
+import os
+import sys
+import time
+import zlib
+import shutil
+import tarfile
+import zipfile
+import argparse
+import subprocess
+import tempfile
+import numpy as np
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, package_path)
+import archiver  # noqa: E402
+
+
+def generate(out_path, steps, cells):
+    """Writes surface maps for a square DEM with about the given number of cells"""
+    n = int(cells ** 0.5)
+    rng = np.random.default_rng(0)
+    with open(os.path.join(out_path, 'Domain_DEM.ASC'), 'w') as f:
+        f.write(f'ncols {n}\nnrows {n}\nxllcorner 400000\nyllcorner 500000\ncellsize 2\nNODATA_value -9999\n')
+        np.savetxt(f, 50 + rng.normal(0, 1, (n, n)), fmt='%.3f')
+    with open(os.path.join(out_path, 'CityCat_Config_1.txt'), 'w') as f:
+        f.write(f'<CityCatConfiguration><SimulationRunTime>{steps * 60}</SimulationRunTime>'
+                f'<OutputFrequency>60</OutputFrequency></CityCatConfiguration>')
+    subprocess.run([sys.executable, os.path.join(package_path, 'benchmarks', 'citycat_stub.py')], cwd=out_path,
+                   check=True)
+    return os.path.join(out_path, 'R1C1_SurfaceMaps')
+
+
+def crc32(f, chunk_size=1 << 24):
+    """CRC-32 of a file object, read in chunks so that large files are not loaded at once"""
+    crc = 0
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def contents(path):
+    """Names and CRC-32 of the files in an archive"""
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as z:
+            assert z.testzip() is None, f'{path} is corrupt'
+            return {info.filename: info.CRC for info in z.infolist()}
+    import zstandard
+    with open(path, 'rb') as f, zstandard.ZstdDecompressor().stream_reader(f) as reader, \
+            tarfile.open(fileobj=reader, mode='r|') as tar:
+        return {member.name: crc32(tar.extractfile(member)) for member in tar}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', nargs='?', help='directory of surface maps, generated if not given')
+    parser.add_argument('--steps', type=int, default=24)
+    parser.add_argument('--cells', type=int, default=500000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--zip64', action='store_true', help='add a file larger than 2GiB to the surface maps')
+    args = parser.parse_args()
+    if args.zip64 and args.path:
+        parser.error('--zip64 only applies to generated surface maps')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        in_path = args.path or generate(tmp, args.steps, args.cells)
+        if args.zip64:
+            with open(os.path.join(in_path, 'zip64.bin'), 'wb') as f:
+                f.truncate(zipfile.ZIP64_LIMIT + (1 << 20))
+        expected = {}
+        for name in sorted(os.listdir(in_path)):
+            with open(os.path.join(in_path, name), 'rb') as f:
+                expected[name] = crc32(f)
+        bytes_in = sum(os.path.getsize(os.path.join(in_path, name)) for name in expected)
+        print(f'{len(expected)} files, {bytes_in / 1e6:.0f}MB')
+
+        start = time.perf_counter()
+        base = shutil.make_archive(os.path.join(tmp, 'make_archive'), 'zip', in_path)
+        seconds = time.perf_counter() - start
+        assert contents(base) == expected
+        print(f'make_archive: {seconds:.2f}s, {bytes_in / 1e6 / seconds:.0f}MB/s, '
+              f'ratio {bytes_in / os.path.getsize(base):.2f}')
+
+        for codec, extension in archiver.extensions.items():
+            out_path = os.path.join(tmp, codec + extension)
+            try:
+                report = archiver.archive_directory(in_path, out_path, codec=codec, workers=args.workers)
+            except ImportError as e:
+                print(f'{codec}: skipped, {e}')
+                continue
+            assert contents(out_path) == expected, f'{codec} archive differs from the surface maps'
+            print(f'{codec}: {report["seconds"]:.2f}s, {report["mb_per_second"]:.0f}MB/s, ratio {report["ratio"]:.2f}, '
+                  f'{seconds / report["seconds"]:.1f}x make_archive')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Stands in for citycat.exe, writing surface maps with the same layout as CityCAT without simulating the flow
+
+Usage: python citycat_stub.py -r 1 -c 1, run in a directory containing the CityCAT input files
+
+A surface map is written for every output interval of the configured run time, with a value for every DEM cell with
+data, followed by the maximum depth file. Water ponds in the lowest cells, rising and falling with a storm profile.
+Set CITYCAT_STUB_STEP_SECONDS to wait between surface maps, which imitates the time taken by the simulation.
+"""
+import os
+import time
+import xml.etree.ElementTree as ET
+import numpy as np
+
+
+def read_header(path):
+    header = {}
+    with open(path) as f:
+        for line in f:
+            key, value = line.split()[:2]
+            if not key[0].isalpha():
+                break
+            header[key.lower()] = float(value)
+    return header
+
+
+def read_dem(path):
+    """Elevations and cell centre coordinates of the cells of an ASCII grid with data"""
+    header = read_header(path)
+    n_header = len(header)
+    nodata = header.get('nodata_value', -9999)
+    dx = header.get('cellsize', header.get('dx'))
+    dy = header.get('cellsize', header.get('dy'))
+    z = np.loadtxt(path, skiprows=n_header, dtype=np.float32)
+    rows, cols = np.nonzero(z != nodata)
+    x = header['xllcorner'] + (cols + 0.5) * dx
+    y = header['yllcorner'] + (z.shape[0] - rows - 0.5) * dy
+    return z[rows, cols], x, y
+
+
+def read_configuration(path):
+    """Run time and output interval in seconds"""
+    config = ET.parse(path).getroot()
+    return float(config.find('SimulationRunTime').text), float(config.find('OutputFrequency').text)
+
+
+def main():
+    z, x, y = read_dem('Domain_DEM.ASC')
+    run_time, output_interval = read_configuration('CityCat_Config_1.txt')
+    step_seconds = float(os.getenv('CITYCAT_STUB_STEP_SECONDS', 0))
+
+    out_path = 'R1C1_SurfaceMaps'
+    os.makedirs(out_path, exist_ok=True)
+
+    # Depth below a water level which peaks half way through the run
+    relative = z - z.min()
+    peak_level = np.quantile(relative, 0.2) if len(z) > 0 else 0
+    rng = np.random.default_rng(0)
+    direction = rng.uniform(0, 2 * np.pi, len(z)).astype(np.float32)
+
+    max_depth = np.zeros_like(z)
+    times = np.arange(0, run_time + output_interval / 2, output_interval)
+    for step, seconds in enumerate(times):
+        level = peak_level * np.sin(np.pi * seconds / run_time) if run_time > 0 else 0
+        depth = np.maximum(level - relative, 0)
+        speed = np.sqrt(depth) * 0.5
+        np.maximum(max_depth, depth, out=max_depth)
+
+        path = os.path.join(out_path, f'R1_C1_T{step}_{int(seconds / 60)}min.rsl')
+        # Written to a temporary file first, so a complete file appears at once as it would from CityCAT
+        with open(path + '.tmp', 'w') as f:
+            f.write('XCen YCen Depth Vx Vy\n')
+            np.savetxt(f, np.column_stack([x, y, depth, speed * np.cos(direction), speed * np.sin(direction)]),
+                       fmt=['%.2f', '%.2f', '%.4f', '%.4f', '%.4f'])
+        os.rename(path + '.tmp', path)
+        time.sleep(step_seconds)
+
+    with open(os.path.join(out_path, 'R1_C1_max_depth.csv'), 'w') as f:
+        f.write('XCen,YCen,Depth\n')
+        np.savetxt(f, np.column_stack([x, y, max_depth]), fmt=['%.2f', '%.2f', '%.4f'], delimiter=',')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Compares the size and read latency of the default outputs with the analysis ready outputs
+
+Usage: python benchmarks/outputs.py <surface maps directory> [workers]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import time
+import numpy as np
+import netCDF4 as nc
+import rasterio as rio
+from rasterio.windows import Window
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import surface_maps  # noqa: E402
+from hazard import max_hazards  # noqa: E402
+from cog import to_cog  # noqa: E402
+
+names = ['max_depth', 'max_velocity', 'max_vd_product']
+
+
+def timed(fn, repeats=3):
+    """Shortest time taken to call fn"""
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def read_netcdf(path, key):
+    with nc.Dataset(path) as ds:
+        depth = ds['depth']
+        n_times, y_size, x_size = depth.shape
+        if key == 'map':
+            return depth[n_times // 2, :, :]
+        if key == 'time_series':
+            return depth[:, y_size // 2, x_size // 2]
+        return depth[:, y_size // 2:y_size // 2 + 64, x_size // 2:x_size // 2 + 64]
+
+
+def read_raster(path, key):
+    with rio.open(path) as src:
+        if key == 'full':
+            return src.read(1)
+        if key == 'window':
+            return src.read(1, window=Window(src.width // 2, src.height // 2, 256, 256))
+        return src.read(1, out_shape=(max(1, src.height // 8), max(1, src.width // 8)))
+
+
+def benchmark(in_path, workers=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, encoding in [('default', {}), ('analysis_ready', dict(chunks='auto', shuffle=True))]:
+            out_path = os.path.join(tmp, name)
+            os.mkdir(out_path)
+            netcdf_path = os.path.join(out_path, 'R1C1_SurfaceMaps.nc')
+            start = time.perf_counter()
+            surface_maps.to_netcdf(in_path, out_path=netcdf_path, workers=workers, **encoding)
+            write_seconds = time.perf_counter() - start
+
+            if name == 'default':
+                max_hazards(netcdf_path, out_path, names=names)
+            else:
+                for raster in names:
+                    shutil.copy(os.path.join(tmp, 'default', f'{raster}.tif'), out_path)
+                    to_cog(os.path.join(out_path, f'{raster}.tif'))
+
+            raster_paths = [os.path.join(out_path, f'{raster}.tif') for raster in names]
+            results[name] = dict(
+                netcdf_write_seconds=write_seconds,
+                netcdf_bytes=os.path.getsize(netcdf_path),
+                raster_bytes=sum(os.path.getsize(path) for path in raster_paths),
+                **{f'netcdf_{key}_seconds': timed(lambda: read_netcdf(netcdf_path, key))
+                   for key in ['map', 'time_series', 'window']},
+                **{f'raster_{key}_seconds': timed(lambda: read_raster(raster_paths[0], key))
+                   for key in ['full', 'window', 'overview']})
+
+        with nc.Dataset(os.path.join(tmp, 'default', 'R1C1_SurfaceMaps.nc')) as a, \
+                nc.Dataset(os.path.join(tmp, 'analysis_ready', 'R1C1_SurfaceMaps.nc')) as b:
+            for var in ['depth', 'x_vel', 'y_vel', 'time']:
+                np.testing.assert_array_equal(a[var][:], b[var][:])
+    return results
+
+
+if __name__ == '__main__':
+    results = benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    for key in results['default']:
+        print(f'{key}: {results["default"][key]:.4g} default, {results["analysis_ready"][key]:.4g} analysis ready')
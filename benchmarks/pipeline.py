@@ -0,0 +1,196 @@
+"""Times every stage of run.py on synthetic domains, using a stub in place of CityCAT so Wine is not needed
+
+Usage: python benchmarks/pipeline.py [--scales small medium] [--results path] [--compare] [--threshold 0.2]
+
+For each scale a DEM tile, buildings and green areas are generated in a temporary data directory and run.py is run
+with citycat_stub.py as citycat.exe. A wine64 script on the PATH runs the stub with Python. The telemetry of each run
+is appended to the results file along with the git commit, so runs of different versions can be compared. With
+--compare, stages which are slower than the previous result for the same scale and host are reported and the exit
+status is 1. Performance options such as WORKERS or ANALYSIS_READY_OUTPUTS are passed through to run.py.
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+import geopandas as gpd
+import rasterio as rio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+benchmarks_path = os.path.join(package_path, 'benchmarks')
+
+# Domain size in km, DEM resolution in metres, numbers of features and run length
+scales = {
+    'small': dict(size=1, res=5, buildings=500, green_areas=100, duration=1, output_interval=600),
+    'medium': dict(size=2, res=2, buildings=5000, green_areas=1000, duration=1, output_interval=300),
+    'large': dict(size=5, res=2, buildings=30000, green_areas=5000, duration=3, output_interval=300),
+}
+
+# Centre of the synthetic domains
+x, y = 420000, 565000
+
+options = ['WORKERS', 'SIMPLIFY_TOLERANCE', 'WATCH_SURFACE_MAPS', 'ANALYSIS_READY_OUTPUTS', 'RENDER_TILES',
+           'TILE_ZOOMS', 'CACHE_PATH', 'DECOMPOSITION', 'ARCHIVE_CODEC', 'ARCHIVE_INCREMENTAL',
+           'ARCHIVE_REMOVE_ORIGINALS', 'CITYCAT_STUB_STEP_SECONDS']
+
+
+def random_boxes(n, bounds, min_size, max_size, rng):
+    left, bottom, right, top = bounds
+    x0, y0 = rng.uniform(left, right - max_size, n), rng.uniform(bottom, top - max_size, n)
+    width, height = rng.uniform(min_size, max_size, n), rng.uniform(min_size, max_size, n)
+    return gpd.GeoDataFrame(geometry=[box(*b) for b in zip(x0, y0, x0 + width, y0 + height)], crs='EPSG:27700')
+
+
+def generate(data_path, scale, seed=0):
+    """Writes a synthetic DEM tile, buildings and green areas covering a domain of the given scale"""
+    rng = np.random.default_rng(seed)
+    size = scale['size'] * 1000
+    # The DEM extends beyond the domain, as the real tiles would
+    bounds = x - size / 2 - 100, y - size / 2 - 100, x + size / 2 + 100, y + size / 2 + 100
+    n = int((bounds[2] - bounds[0]) / scale['res'])
+
+    # Gently undulating ground with a valley through the middle
+    cols, rows = np.meshgrid(np.linspace(0, 1, n), np.linspace(0, 1, n))
+    elevation = (50 + 20 * np.abs(cols - 0.5) + 3 * np.sin(rows * 12) * np.cos(cols * 9) +
+                 rng.normal(0, 0.05, (n, n))).astype(np.float32)
+
+    inputs_path = os.path.join(data_path, 'inputs')
+    for directory in ['dem', 'buildings', 'green_areas', 'boundary', 'parameters']:
+        os.makedirs(os.path.join(inputs_path, directory), exist_ok=True)
+    os.makedirs(os.path.join(data_path, 'outputs'), exist_ok=True)
+
+    with rio.open(os.path.join(inputs_path, 'dem', 'dem.asc'), 'w', driver='AAIGrid', width=n, height=n, count=1,
+                  dtype='float32', transform=from_origin(bounds[0], bounds[3], scale['res'], scale['res']),
+                  nodata=-9999) as dst:
+        dst.write(elevation, 1)
+
+    random_boxes(scale['buildings'], bounds, 5, 25, rng).to_file(
+        os.path.join(inputs_path, 'buildings', 'buildings.gpkg'), driver='GPKG')
+    random_boxes(scale['green_areas'], bounds, 10, 80, rng).to_file(
+        os.path.join(inputs_path, 'green_areas', 'green_areas.gpkg'), driver='GPKG')
+
+
+def parameters(name, scale):
+    """Environment variables defining the run"""
+    return dict(NAME=name, RAINFALL_MODE='total_depth', TOTAL_DEPTH='40', DURATION=str(scale['duration']),
+                POST_EVENT_DURATION='0', OUTPUT_INTERVAL=str(scale['output_interval']), SIZE=str(scale['size']),
+                X=str(x), Y=str(y), OPEN_BOUNDARIES='True', PERMEABLE_AREAS='polygons', ROOF_STORAGE='0')
+
+
+def run(name, scale):
+    """Runs run.py on a synthetic domain
+
+    Returns:
+        dict: Wall time of the whole run and the telemetry written by run.py
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = os.path.join(tmp, 'data')
+        start = time.perf_counter()
+        generate(data_path, scale)
+        generate_seconds = time.perf_counter() - start
+
+        # run.py copies citycat.exe from its working directory and runs it with wine64
+        work_path = os.path.join(tmp, 'work')
+        bin_path = os.path.join(tmp, 'bin')
+        os.makedirs(work_path)
+        os.makedirs(bin_path)
+        shutil.copy(os.path.join(benchmarks_path, 'citycat_stub.py'), os.path.join(work_path, 'citycat.exe'))
+        with open(os.path.join(bin_path, 'wine64'), 'w') as f:
+            f.write(f'#!/bin/sh\nexec "{sys.executable}" "$@"\n')
+        os.chmod(os.path.join(bin_path, 'wine64'), 0o755)
+
+        env = dict(os.environ, **parameters(name, scale), DATA_PATH=data_path,
+                   PATH=bin_path + os.pathsep + os.environ['PATH'])
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(package_path, 'run.py')], cwd=work_path, env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        seconds = time.perf_counter() - start
+
+        with open(os.path.join(data_path, 'outputs', 'run', 'telemetry.json')) as f:
+            telemetry = json.load(f)
+
+    return dict(generate_seconds=round(generate_seconds, 3), wall_seconds=round(seconds, 3),
+                peak_rss_mb=max(record['peak_rss_mb'] for record in telemetry['stages']),
+                stages={record['name']: {key: record[key] for key in ['wall_seconds', 'cpu_seconds', 'peak_rss_mb']}
+                        for record in telemetry['stages']})
+
+
+def commit():
+    """Current git commit, marked as dirty if there are uncommitted changes"""
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=package_path, capture_output=True,
+                              text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=package_path,
+                               capture_output=True, text=True).stdout.strip()
+        return head + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(result, previous, threshold, min_seconds=0.5):
+    """Stages of result which are more than threshold slower than in previous and by at least min_seconds"""
+    regressions = []
+    for name, stage in result['stages'].items():
+        before = previous['stages'].get(name)
+        if before is None:
+            continue
+        if stage['wall_seconds'] > before['wall_seconds'] * (1 + threshold) and \
+                stage['wall_seconds'] - before['wall_seconds'] >= min_seconds:
+            regressions.append((name, before['wall_seconds'], stage['wall_seconds']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', nargs='+', choices=list(scales), default=['small', 'medium'])
+    parser.add_argument('--results', default=os.path.join(benchmarks_path, 'results', 'pipeline.jsonl'))
+    parser.add_argument('--compare', action='store_true', help='exit with status 1 if any stage is slower')
+    parser.add_argument('--threshold', type=float, default=0.2, help='fraction by which a stage may be slower')
+    args = parser.parse_args()
+
+    history = read_results(args.results)
+    os.makedirs(os.path.dirname(os.path.abspath(args.results)), exist_ok=True)
+
+    regressed = False
+    for name in args.scales:
+        result = dict(scale=name, created=datetime.now().isoformat(), commit=commit(), host=platform.node(),
+                      cpus=os.cpu_count(), options={key: os.environ[key] for key in options if key in os.environ},
+                      **scales[name])
+        result.update(run(name, scales[name]))
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+        print(f'{name}: {result["wall_seconds"]:.1f}s, peak RSS {result["peak_rss_mb"]:.0f}MB')
+        for stage, record in result['stages'].items():
+            print(f'  {stage}: {record["wall_seconds"]:.2f}s, {record["peak_rss_mb"]:.0f}MB')
+
+        if args.compare:
+            previous = [r for r in history if r['scale'] == name and r['host'] == result['host'] and
+                        r['options'] == result['options']]
+            if len(previous) == 0:
+                print('  No previous result to compare with')
+                continue
+            for stage, before, after in compare(result, previous[-1], args.threshold):
+                print(f'  REGRESSION {stage}: {before:.2f}s in {previous[-1]["commit"]} -> {after:.2f}s')
+                regressed = True
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""Compares reading geometries one file at a time with the parallel reader in geometries.py
+
+Usage: python benchmarks/read_geometries.py <directory> [xmin ymin xmax ymax] [workers]
+"""
+import os
+import sys
+import time
+import pandas as pd
+import geopandas as gpd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import geometries  # noqa: E402
+
+
+def read_sequential(paths, bbox=None):
+    # Reads each file in turn and appends it to the features read so far
+    features = gpd.read_file(paths[0], bbox=bbox)
+    for path in paths[1:]:
+        features = pd.concat([features, gpd.read_file(path, bbox=bbox)])
+    return features
+
+
+def benchmark(path, bbox=None, workers=None):
+    paths = geometries.list_files(path)
+    results = {}
+    for name, read in [('sequential', lambda: read_sequential(paths, bbox)),
+                       ('parallel', lambda: geometries.read_files(paths, bbox=bbox, workers=workers)),
+                       ('parallel_geometry_only', lambda: geometries.read_files(paths, bbox=bbox, columns=[],
+                                                                                workers=workers))]:
+        start = time.perf_counter()
+        features = read()
+        results[name] = dict(seconds=time.perf_counter() - start, features=len(features))
+    assert len(set(result['features'] for result in results.values())) == 1
+    return results
+
+
+if __name__ == '__main__':
+    bbox = tuple(float(v) for v in sys.argv[2:6]) if len(sys.argv) >= 6 else None
+    results = benchmark(sys.argv[1], bbox, int(sys.argv[6]) if len(sys.argv) > 6 else None)
+    for name, result in results.items():
+        print(f'{name}: {result["seconds"]:.2f}s ({result["features"] / result["seconds"]:.0f} features/s)')
+    print(f'Speed up: {results["sequential"]["seconds"] / results["parallel"]["seconds"]:.1f}x')
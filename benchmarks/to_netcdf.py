@@ -0,0 +1,41 @@
+"""Compares citycatio.output.to_netcdf with the parallel converter in surface_maps.py
+
+Usage: python benchmarks/to_netcdf.py <surface maps directory> [workers]
+"""
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import xarray as xr
+from citycatio import output
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import surface_maps  # noqa: E402
+
+
+def benchmark(in_path, workers=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, convert in [('citycatio', lambda out: output.to_netcdf(in_path, out_path=out, srid=27700)),
+                              ('surface_maps', lambda out: surface_maps.to_netcdf(in_path, out_path=out, srid=27700,
+                                                                                  workers=workers))]:
+            out_path = os.path.join(tmp, f'{name}.nc')
+            start = time.perf_counter()
+            convert(out_path)
+            results[name] = dict(seconds=time.perf_counter() - start, bytes=os.path.getsize(out_path))
+
+        with xr.open_dataset(os.path.join(tmp, 'citycatio.nc'), decode_times=False) as a, \
+                xr.open_dataset(os.path.join(tmp, 'surface_maps.nc'), decode_times=False) as b:
+            for var in ['depth', 'x_vel', 'y_vel']:
+                np.testing.assert_allclose(a[var].values, b[var].values, atol=1e-3)
+
+    return results
+
+
+if __name__ == '__main__':
+    results = benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    n_files = len(surface_maps.list_results(sys.argv[1]))
+    for name, result in results.items():
+        print(f'{name}: {result["seconds"]:.2f}s ({n_files / result["seconds"]:.1f} files/s), {result["bytes"]} bytes')
+    print(f'Speed up: {results["citycatio"]["seconds"] / results["surface_maps"]["seconds"]:.1f}x')
@@ -0,0 +1,97 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+
+logger = logging.getLogger('citycat-dafni')
+
+# Increment when the contents of cache entries change
+version = 1
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def get_key(paths, **parameters):
+    """Hash of the contents of the input files and the parameters used to prepare them
+
+    Args:
+        paths: Input files
+        **parameters: JSON serialisable values which affect the prepared inputs
+
+    Returns:
+        str: Hexadecimal key
+    """
+    h = hashlib.sha256(json.dumps(dict(version=version, **parameters), sort_keys=True).encode())
+    for path in sorted(paths):
+        h.update(os.path.basename(path).encode())
+        h.update(file_digest(path).encode())
+    return h.hexdigest()
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+class Cache:
+    """Directory of prepared model inputs keyed by the hash of their sources
+
+    Entries are evicted, least recently used first, when the total size exceeds max_size.
+
+    Args:
+        path: Directory in which to store entries
+        max_size: Maximum size of the cache in bytes
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def get(self, key):
+        """Path of the entry or None if it is not in the cache"""
+        entry_path = os.path.join(self.path, key)
+        if not os.path.exists(entry_path):
+            logger.info(f'---- Cache miss {key[:12]}')
+            return None
+        os.utime(entry_path)
+        logger.info(f'---- Cache hit {key[:12]}')
+        return entry_path
+
+    def put(self, key, source_path):
+        """Moves source_path into the cache and evicts entries if the cache is too large
+
+        Returns:
+            str: Path of the entry
+        """
+        entry_path = os.path.join(self.path, key)
+        staging_path = tempfile.mkdtemp(dir=self.path, prefix='.')
+        shutil.move(source_path, os.path.join(staging_path, 'entry'))
+        try:
+            os.rename(os.path.join(staging_path, 'entry'), entry_path)
+        except OSError:
+            # Another process has already created the entry
+            pass
+        shutil.rmtree(staging_path, ignore_errors=True)
+        self.evict(keep=key)
+        return entry_path
+
+    def evict(self, keep=None):
+        entries = [entry for entry in os.scandir(self.path) if entry.is_dir() and not entry.name.startswith('.')]
+        sizes = {entry.name: directory_size(entry.path) for entry in entries}
+        total = sum(sizes.values())
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            if total <= self.max_size:
+                break
+            if entry.name == keep:
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+            total -= sizes[entry.name]
+            logger.info(f'---- Evicted {entry.name[:12]} from cache')
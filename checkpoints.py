@@ -0,0 +1,88 @@
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime
+
+logger = logging.getLogger('citycat-dafni')
+
+# Stages of a run in the order they are run
+stage_names = ['prepare', 'simulate', 'convert', 'hazard_rasters', 'exposure', 'render', 'metadata']
+
+
+def list_files(paths):
+    """Files in paths, including the files within any directories"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(root, f) for root, _, names in os.walk(path) for f in names)
+        elif os.path.exists(path):
+            files.append(path)
+    return sorted(files)
+
+
+def fingerprint(paths, **parameters):
+    """Hash of the names, sizes and modification times of the files in paths and any parameters
+
+    Contents are not hashed, so large results files can be checked quickly.
+    """
+    h = hashlib.sha256(json.dumps(parameters, sort_keys=True, default=str).encode())
+    for path in list_files(paths):
+        stat = os.stat(path)
+        h.update(f'{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return h.hexdigest()
+
+
+class Checkpoints:
+    """Completion markers of the stages of a run, stored in the .stages directory of the run
+
+    Each marker records the fingerprint of the stage inputs and outputs and any state needed by later stages.
+
+    Args:
+        run_path: Directory of the run
+    """
+    def __init__(self, run_path):
+        self.path = os.path.join(run_path, '.stages')
+
+    def marker(self, name):
+        path = os.path.join(self.path, f'{name}.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def valid(self, name, inputs):
+        """Whether the stage has completed with the same inputs and its outputs are unchanged
+
+        Args:
+            name: Stage name
+            inputs: Fingerprint of the stage inputs
+        """
+        marker = self.marker(name)
+        return marker is not None and marker['inputs'] == inputs and \
+            all(os.path.exists(path) for path in marker['outputs']) and \
+            marker['outputs_fingerprint'] == fingerprint(marker['outputs'])
+
+    def complete(self, name, inputs, outputs, **state):
+        """Records that a stage has completed
+
+        Args:
+            name: Stage name
+            inputs: Fingerprint of the stage inputs
+            outputs: Files and directories created by the stage
+            **state: JSON serialisable values used by later stages
+        """
+        os.makedirs(self.path, exist_ok=True)
+        outputs = [path for path in outputs if os.path.exists(path)]
+        with open(os.path.join(self.path, f'{name}.json'), 'w') as f:
+            json.dump(dict(completed=datetime.now().isoformat(), inputs=inputs, outputs=outputs,
+                           outputs_fingerprint=fingerprint(outputs), state=state), f, indent=2, default=str)
+
+    def state(self):
+        """State recorded by all completed stages"""
+        state = {}
+        for name in stage_names:
+            marker = self.marker(name)
+            if marker is not None:
+                state.update(marker['state'])
+        return state
@@ -0,0 +1,44 @@
+import os
+import logging
+
+logger = logging.getLogger('citycat-dafni')
+
+
+def overview_factors(width, height, blocksize):
+    """Decimation factors of the overviews, halving the resolution until the raster fits within one block"""
+    factors = []
+    factor = 2
+    while max(width, height) / (factor / 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def to_cog(path, blocksize=512, resampling='average'):
+    """Rewrites a GeoTIFF as a Cloud-Optimized GeoTIFF
+
+    The raster is tiled and compressed with overviews stored before the full resolution data, so windows and
+    reduced resolution views can be read without reading the whole file.
+
+    Args:
+        path: GeoTIFF to rewrite
+        blocksize: Width and height of the tiles, which must be a multiple of 16
+        resampling: Resampling method used to create the overviews
+    """
+    import rasterio as rio
+    from rasterio.enums import Resampling
+    from rasterio.shutil import copy
+
+    tmp_path = path + '.tmp.tif'
+    with rio.open(path) as src:
+        profile = src.profile
+        profile.update(driver='GTiff', tiled=True, blockxsize=blocksize, blockysize=blocksize, compress='deflate')
+        with rio.open(tmp_path, 'w', **profile) as dst:
+            dst.write(src.read())
+            factors = overview_factors(src.width, src.height, blocksize)
+            if len(factors) > 0:
+                dst.build_overviews(factors, Resampling[resampling])
+
+    copy(tmp_path, path, driver='GTiff', tiled=True, blockxsize=blocksize, blockysize=blocksize, compress='deflate',
+         predictor=3 if profile['dtype'].startswith('float') else 2, copy_src_overviews=True)
+    os.remove(tmp_path)
@@ -0,0 +1,314 @@
+import os
+import json
+import logging
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import rasterio as rio
+from rasterio.windows import Window, from_bounds, bounds as window_bounds
+from rasterio.transform import from_origin
+from dem import read_dem, mosaic_to_file, block_rows, update_index, intersecting_tiles
+from cog import to_cog
+from render import plot_max_depth
+import run
+
+logger = logging.getLogger('citycat-dafni')
+
+# Rasters which are stitched together from the sub-domains
+raster_names = ['max_depth', 'max_velocity', 'max_vd_product']
+
+
+def parse_layout(layout):
+    """Number of columns and rows from a layout such as 2x3"""
+    n_x, n_y = (int(n) for n in layout.lower().split('x'))
+    assert n_x > 0 and n_y > 0, f'Invalid decomposition {layout}'
+    return n_x, n_y
+
+
+def ridge_splits(elevation, start, res, n, search):
+    """Coordinates which split an axis into n parts, moved to the highest ground within search of an even split
+
+    Each split is only searched for after the previous split and before the next even split, within a quarter of the
+    even spacing, so the splits strictly increase and every part is at least half as wide as an even part.
+
+    Args:
+        elevation: Median elevation of each row or column, NaN where there is no data
+        start: Coordinate of the start of the axis
+        res: Resolution of the DEM
+        n: Number of parts
+        search: Distance either side of an even split in which to look for a ridge
+
+    Returns:
+        list: Split coordinates
+    """
+    splits = []
+    size = len(elevation)
+    centres = [int(round(size * i / n)) for i in range(n + 1)]
+    reach = min(int(search / res), size // (4 * n))
+    previous = 0
+    for i in range(1, n):
+        lo = max(centres[i] - reach, previous + 1, 1)
+        hi = min(centres[i] + reach, centres[i + 1] - 1, size - 1)
+        window = elevation[lo:hi + 1]
+        if hi < lo or np.isnan(window).all():
+            split = centres[i]
+        else:
+            split = lo + int(np.nanargmax(window))
+        if split <= previous or split >= size:
+            # The axis has fewer cells than parts
+            continue
+        splits.append(start + split * res)
+        previous = split
+    return splits
+
+
+def elevation_profiles(bounds, tmp=None):
+    """Median elevation of each column and row of the DEM, and its transform
+
+    If DEM_MEMORY_LIMIT is set, the DEM is mosaicked to a file and the medians are taken from bands of columns and
+    rows which fit within the limit, as the whole DEM may not fit in memory.
+    """
+    if run.dem_memory_limit is None:
+        array, transform = read_dem(run.dem_path, bounds, run.nodata, index_path=os.getenv('DEM_INDEX'))
+        array = np.where(array[0] == run.nodata, np.nan, array[0])
+        return np.nanmedian(array, axis=0), np.nanmedian(array, axis=1), transform
+
+    with tempfile.TemporaryDirectory(dir=tmp) as profile_tmp:
+        dem_file = os.path.join(profile_tmp, 'dem.tif')
+        mosaic_to_file(run.dem_path, bounds, run.nodata, dem_file, index_path=os.getenv('DEM_INDEX'),
+                       memory_limit=run.dem_memory_limit)
+        with rio.open(dem_file) as src:
+            width, height, transform = src.width, src.height, src.transform
+            # Each band, its float64 copy and the copy partitioned by nanmedian
+            rows = block_rows(width, run.dem_memory_limit, 20)
+            cols = block_rows(height, run.dem_memory_limit, 20)
+            row_medians = np.concatenate([
+                np.nanmedian(src.read(1, window=Window(0, row, width, min(rows, height - row)), masked=True)
+                             .astype(np.float64).filled(np.nan), axis=1) for row in range(0, height, rows)])
+            col_medians = np.concatenate([
+                np.nanmedian(src.read(1, window=Window(col, 0, min(cols, width - col), height), masked=True)
+                             .astype(np.float64).filled(np.nan), axis=0) for col in range(0, width, cols)])
+    return col_medians, row_medians, transform
+
+
+def snap(value, origin, res):
+    """Nearest coordinate to value which is a whole number of cells from origin"""
+    return origin + round((value - origin) / res) * res
+
+
+def split_bounds(bounds, n_x, n_y, halo, ridges=True, tmp=None):
+    """Splits the domain into overlapping sub-domains
+
+    Split lines are moved onto the highest ground near an even split, so that less water crosses them.
+    The edges of every sub-domain are a whole number of DEM cells from the top left of the domain, so the grids of
+    the sub-domains, each anchored at its own top left, line up with each other.
+
+    Args:
+        bounds: Extent of the domain
+        n_x: Number of columns
+        n_y: Number of rows
+        halo: Distance that each sub-domain extends beyond its core
+        ridges: Whether to move split lines onto ridges in the DEM
+        tmp: Directory in which to mosaic the DEM if DEM_MEMORY_LIMIT is set
+
+    Returns:
+        list: Dictionaries with the bounds of each sub-domain including and excluding the halo
+    """
+    x_min, y_min, x_max, y_max = bounds
+    x_splits = list(np.linspace(x_min, x_max, n_x + 1)[1:-1])
+    y_splits = list(np.linspace(y_min, y_max, n_y + 1)[1:-1])
+
+    if ridges and n_x * n_y > 1:
+        col_medians, row_medians, transform = elevation_profiles(bounds, tmp)
+        res = transform.a
+        # Rows are ordered from north to south, so the y profile is reversed to start from y_min
+        x_splits = ridge_splits(col_medians, transform.c, res, n_x, halo)
+        y_splits = ridge_splits(row_medians[::-1], transform.f - len(row_medians) * res, res, n_y, halo)
+
+    # The DEM is mosaicked at the resolution of the first tile, as in dem.mosaic_windows
+    index = update_index(run.dem_path, os.getenv('DEM_INDEX'))
+    names = intersecting_tiles(index, bounds)
+    assert len(names) > 0, "No DEM data available for selected location"
+    res = index[names[0]]['res'][0]
+    x_splits = [snap(x, x_min, res) for x in x_splits]
+    y_splits = [snap(y, y_max, res) for y in y_splits]
+
+    xs, ys = [x_min, *x_splits, x_max], [y_min, *y_splits, y_max]
+    sub_domains = []
+    for j in range(n_y):
+        for i in range(n_x):
+            core = xs[i], ys[j], xs[i + 1], ys[j + 1]
+            sub_domains.append(dict(
+                core=core,
+                bounds=(max(snap(core[0] - halo, x_min, res), x_min), max(snap(core[1] - halo, y_max, res), y_min),
+                        min(snap(core[2] + halo, x_min, res), x_max), min(snap(core[3] + halo, y_max, res), y_max))))
+    return sub_domains
+
+
+def run_sub_domain(i, run_path, tmp, parameters, boundary, bounds, rainfall_bounds, workers):
+    tmp = os.path.join(tmp, f'sub_domain_{i:03d}')
+    os.mkdir(tmp)
+    start_timestamp = pd.Timestamp.now()
+    try:
+        template_path, domain_info = run.get_template(tmp, bounds, parameters)
+        run.run_scenario(run_path, parameters, boundary, template_path, domain_info, workers=workers,
+                         rainfall_bounds=rainfall_bounds)
+        status = 'completed'
+    except Exception:
+        logger.exception(f'Sub-domain {i} failed')
+        status = 'failed'
+    return dict(sub_domain=i, status=status, seconds=(pd.Timestamp.now() - start_timestamp).total_seconds())
+
+
+def stitch(paths, cores, out_path):
+    """Mosaics rasters from overlapping sub-domains, keeping only the core of each sub-domain
+
+    Args:
+        paths: Raster of each sub-domain, all on the same grid
+        cores: Bounds of each sub-domain excluding the halo
+        out_path: Path to create the stitched raster
+    """
+    with rio.open(paths[0]) as src:
+        profile = src.profile
+        res = src.res[0]
+    extents = []
+    for path in paths:
+        with rio.open(path) as src:
+            extents.append(src.bounds)
+    left, bottom = min(e.left for e in extents), min(e.bottom for e in extents)
+    right, top = max(e.right for e in extents), max(e.top for e in extents)
+    transform = from_origin(left, top, res, res)
+    shape = int(round((top - bottom) / res)), int(round((right - left) / res))
+
+    array = np.full(shape, profile['nodata'], dtype=profile['dtype'])
+    for path, core in zip(paths, cores):
+        with rio.open(path) as src:
+            # Cells are assigned to the sub-domain containing their centre
+            window = from_bounds(*core, transform=transform).round_offsets().round_lengths()
+            window = window.intersection(from_bounds(*src.bounds, transform=transform).round_offsets()
+                                         .round_lengths())
+            src_window = from_bounds(*window_bounds(window, transform), transform=src.transform)
+            (row_start, row_stop), (col_start, col_stop) = window.toranges()
+            array[row_start:row_stop, col_start:col_stop] = src.read(
+                1, window=src_window.round_offsets().round_lengths())
+
+    profile.update(height=shape[0], width=shape[1], transform=transform)
+    with rio.open(out_path, 'w', **profile) as dst:
+        dst.write(array, 1)
+
+
+def compare(path, reference_path, threshold=0.1):
+    """Differences between a stitched raster and the same raster from a full domain run
+
+    Args:
+        path: Stitched raster
+        reference_path: Raster from the full domain run
+        threshold: Value above which a cell is counted as flooded
+
+    Returns:
+        dict: Error statistics over cells with data in both rasters
+    """
+    with rio.open(path) as src, rio.open(reference_path) as ref:
+        window = from_bounds(*ref.bounds, transform=src.transform).round_offsets().round_lengths()
+        a = src.read(1, window=window, boundless=True, fill_value=src.nodata).astype(np.float64)
+        b = ref.read(1).astype(np.float64)
+        valid = (a != src.nodata) & (b != ref.nodata)
+    error = a[valid] - b[valid]
+    flooded, flooded_reference = a[valid] > threshold, b[valid] > threshold
+    hits = (flooded & flooded_reference).sum()
+    return dict(
+        cells=int(valid.sum()),
+        mean_error=float(error.mean()) if error.size else None,
+        mean_absolute_error=float(np.abs(error).mean()) if error.size else None,
+        rmse=float(np.sqrt((error ** 2).mean())) if error.size else None,
+        max_absolute_error=float(np.abs(error).max()) if error.size else None,
+        # Critical success index of cells above the threshold
+        csi=float(hits / (flooded | flooded_reference).sum()) if (flooded | flooded_reference).any() else None)
+
+
+def run_decomposed(layout, parameters, boundary, bounds, tmp, halo=None, workers=None, reference=None):
+    """Runs CityCAT separately on overlapping sub-domains in parallel and stitches the maximum rasters together
+
+    Each sub-domain is run in outputs/run/sub_domain_{i} and the stitched rasters are written to outputs/run.
+    Flow across the edges of the sub-domains is not modelled, so the halo should be wide enough that errors at the
+    edges do not reach the core of each sub-domain.
+
+    Args:
+        layout: Number of columns and rows, such as 2x2
+        parameters: Run parameters
+        boundary: Boundary polygons used for plotting and rainfall extraction
+        bounds: Extent of the full domain
+        tmp: Directory in which to prepare the domains
+        halo: Overlap between sub-domains in metres, defaults to DECOMPOSITION_HALO or 500
+        workers: Number of sub-domains run at the same time, defaults to DECOMPOSITION_WORKERS or the number of CPUs
+        reference: Whether to also run the full domain and report the differences, defaults to DECOMPOSITION_REFERENCE
+    """
+    n_x, n_y = parse_layout(layout)
+    halo = halo if halo is not None else float(os.getenv('DECOMPOSITION_HALO', 500))
+    if reference is None:
+        reference = os.getenv('DECOMPOSITION_REFERENCE', 'False').lower() == 'true'
+
+    sub_domains = split_bounds(bounds, n_x, n_y, halo,
+                               ridges=os.getenv('DECOMPOSITION_RIDGES', 'True').lower() == 'true', tmp=tmp)
+    workers = min(workers or int(os.getenv('DECOMPOSITION_WORKERS', os.cpu_count())), len(sub_domains))
+    conversion_workers = max(1, run.workers // workers)
+
+    decomposition_path = os.path.join(run.outputs_path, 'run')
+    if not os.path.exists(decomposition_path):
+        os.mkdir(decomposition_path)
+    run_paths = [os.path.join(decomposition_path, f'sub_domain_{i:03d}') for i in range(len(sub_domains))]
+
+    logger.info(f'Running {len(sub_domains)} sub-domains with a {halo}m halo using {workers} workers')
+    results = []
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(run_sub_domain, i, run_path, tmp, parameters, boundary, sub_domain['bounds'],
+                                   bounds, conversion_workers)
+                   for i, (run_path, sub_domain) in enumerate(zip(run_paths, sub_domains))]
+        if reference:
+            reference_path = os.path.join(decomposition_path, 'reference')
+            futures.append(executor.submit(run_sub_domain, len(sub_domains), reference_path, tmp, parameters,
+                                           boundary, bounds, bounds, conversion_workers))
+        for future in as_completed(futures):
+            result = future.result()
+            logger.info(f'Sub-domain {result["sub_domain"]} {result["status"]} in {result["seconds"]:.0f}s')
+            results.append(result)
+
+    results = {result['sub_domain']: result for result in results}
+    assert all(results[i]['status'] == 'completed' for i in range(len(sub_domains))), 'Sub-domain runs failed'
+
+    logger.info('Stitching sub-domains')
+    for name in raster_names:
+        stitch([os.path.join(run_path, f'{name}.tif') for run_path in run_paths],
+               [sub_domain['core'] for sub_domain in sub_domains],
+               os.path.join(decomposition_path, f'{name}.tif'))
+        if run.analysis_ready:
+            to_cog(os.path.join(decomposition_path, f'{name}.tif'))
+
+    geotiff_path = os.path.join(decomposition_path, 'max_depth.tif')
+    plot_max_depth(geotiff_path, os.path.join(decomposition_path, 'max_depth.png'), boundary)
+    run.interpolate(geotiff_path, os.path.join(decomposition_path, 'max_depth_interpolated.tif'))
+    if run.analysis_ready:
+        to_cog(os.path.join(decomposition_path, 'max_depth_interpolated.tif'))
+    if run.render_tiles:
+        run.write_tiles(decomposition_path)
+
+    with open(os.path.join(run_paths[0], 'metadata.json')) as f:
+        metadata = json.load(f)
+    run.write_metadata(decomposition_path, metadata['dct:title'],
+                       f'{metadata["dct:description"]} The domain was split into {len(sub_domains)} sub-domains '
+                       f'with a {halo}m overlap.', bounds)
+
+    report = dict(layout=layout, halo=halo, sub_domains=[{**sub_domain, **results[i]}
+                                                         for i, sub_domain in enumerate(sub_domains)])
+    if reference and results[len(sub_domains)]['status'] == 'completed':
+        report['reference_seconds'] = results[len(sub_domains)]['seconds']
+        report['accuracy'] = {name: compare(os.path.join(decomposition_path, f'{name}.tif'),
+                                            os.path.join(reference_path, f'{name}.tif'))
+                              for name in raster_names}
+        logger.info(f'---- Maximum depth RMSE compared to the full domain: {report["accuracy"]["max_depth"]["rmse"]}')
+
+    with open(os.path.join(decomposition_path, 'decomposition.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    return report
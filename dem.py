@@ -0,0 +1,305 @@
+import os
+import json
+import math
+import logging
+import numpy as np
+import rasterio as rio
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+logger = logging.getLogger('citycat-dafni')
+
+index_name = 'dem_index.json'
+
+
+def read_header(path):
+    """Reads the georeferencing of an ESRI ASCII grid from its header without parsing the data
+
+    Args:
+        path: Path to the ASCII grid
+
+    Returns:
+        dict: Bounds, resolution and nodata value of the grid
+    """
+    header = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 2 or not parts[0][0].isalpha():
+                break
+            header[parts[0].lower()] = float(parts[1])
+
+    cellsize = header['cellsize']
+    left = header['xllcorner'] if 'xllcorner' in header else header['xllcenter'] - cellsize / 2
+    bottom = header['yllcorner'] if 'yllcorner' in header else header['yllcenter'] - cellsize / 2
+
+    return dict(
+        bounds=[left, bottom, left + header['ncols'] * cellsize, bottom + header['nrows'] * cellsize],
+        res=[cellsize, cellsize],
+        nodata=header.get('nodata_value'))
+
+
+def read_profile(path):
+    """Reads the georeferencing of any raster supported by GDAL
+
+    Args:
+        path: Path to the raster
+
+    Returns:
+        dict: Bounds, resolution and nodata value of the raster
+    """
+    with rio.open(path) as ds:
+        return dict(bounds=list(ds.bounds), res=list(ds.res), nodata=ds.nodata)
+
+
+def update_index(dem_path, index_path=None):
+    """Creates or updates the spatial index of DEM tiles
+
+    Only tiles which are new or have changed since the index was last written have their headers read.
+    Tiles which no longer exist are removed from the index.
+
+    Args:
+        dem_path: Directory containing ASCII grid tiles
+        index_path: Location of the index file, defaults to dem_index.json in dem_path
+
+    Returns:
+        dict: Tile footprint, resolution, nodata value and modification time keyed by file name
+    """
+    if index_path is None:
+        index_path = os.path.join(dem_path, index_name)
+
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    tiles = {entry.name: entry.stat() for entry in os.scandir(dem_path)
+             if entry.is_file() and entry.name.lower().endswith('.asc')}
+
+    changed = False
+    for name in set(index) - set(tiles):
+        del index[name]
+        changed = True
+
+    for name, stat in tiles.items():
+        entry = index.get(name)
+        if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            continue
+        path = os.path.join(dem_path, name)
+        try:
+            entry = read_header(path)
+        except (KeyError, ValueError):
+            entry = read_profile(path)
+        entry.update(mtime=stat.st_mtime, size=stat.st_size)
+        index[name] = entry
+        changed = True
+
+    if changed:
+        try:
+            with open(index_path, 'w') as f:
+                json.dump(index, f)
+        except OSError:
+            logger.warning(f'---- Could not write DEM index to {index_path}')
+
+    logger.info(f'---- DEM index contains {len(index)} tiles')
+    return index
+
+
+def intersecting_tiles(index, bounds):
+    """Names of the tiles in the index which overlap the bounds"""
+    left, bottom, right, top = bounds
+    return sorted(name for name, entry in index.items()
+                  if entry['bounds'][0] < right and entry['bounds'][2] > left
+                  and entry['bounds'][1] < top and entry['bounds'][3] > bottom)
+
+
+def cells(length, res):
+    """Number of cells of size res needed to cover length, ignoring floating point error"""
+    return int(math.ceil(round(length / res, 6)))
+
+
+def get_window(bounds, transform):
+    """Window covering the bounds, rounded out to whole cells"""
+    left, bottom, right, top = bounds
+    return Window(int(round((left - transform.c) / transform.a)),
+                  int(round((top - transform.f) / transform.e)),
+                  cells(right - left, transform.a),
+                  cells(bottom - top, transform.e))
+
+
+def mosaic_windows(dem_path, index, bounds):
+    """Pairs of source and destination windows for every tile overlapping the bounds
+
+    The destination grid uses the resolution of the first overlapping tile and is anchored to the top left of the
+    bounds. As in :func:`rasterio.merge.merge` of rasterio 1.1, it extends right and down to a whole number of cells,
+    so it covers the bounds even if they are not a multiple of the resolution. Tiles are read over the whole of the
+    last row and column.
+
+    Args:
+        dem_path: Directory containing the tiles
+        index: Tile index created by :func:`update_index`
+        bounds: Extent of the output grid
+
+    Returns:
+        tuple: Transform, shape and a list of (path, source window, destination window)
+    """
+    names = intersecting_tiles(index, bounds)
+    assert len(names) > 0, "No DEM data available for selected location"
+
+    res = index[names[0]]['res']
+    left, bottom, right, top = bounds
+    transform = Affine.translation(left, top) * Affine.scale(res[0], -res[1])
+    shape = cells(top - bottom, res[1]), cells(right - left, res[0])
+    right, bottom = left + shape[1] * res[0], top - shape[0] * res[1]
+
+    windows = []
+    for name in intersecting_tiles(index, (left, bottom, right, top)):
+        tile, tile_res = index[name]['bounds'], index[name]['res']
+        intersection = max(tile[0], left), max(tile[1], bottom), min(tile[2], right), min(tile[3], top)
+        tile_transform = Affine.translation(tile[0], tile[3]) * Affine.scale(tile_res[0], -tile_res[1])
+        src_window = get_window(intersection, tile_transform)
+        # Rounding out can reach past the edge of a tile which is not aligned with the grid
+        src_window = Window(src_window.col_off, src_window.row_off,
+                            min(src_window.width, cells(tile[2] - tile[0], tile_res[0]) - src_window.col_off),
+                            min(src_window.height, cells(tile[3] - tile[1], tile_res[1]) - src_window.row_off))
+        dst_window = get_window(intersection, transform)
+        if min(src_window.width, src_window.height, dst_window.width, dst_window.height) <= 0:
+            continue
+        windows.append((os.path.join(dem_path, name), src_window, dst_window))
+
+    return transform, shape, windows
+
+
+def read_tile(path, src_window, dst_window):
+    with rio.open(path) as src:
+        return src.read(1, window=src_window, out_shape=(dst_window.height, dst_window.width), masked=True)
+
+
+def read_dem(dem_path, bounds, nodata, index_path=None):
+    """Mosaics the DEM tiles overlapping the bounds
+
+    Only tiles which intersect the bounds according to the index are opened and only the overlapping window of each
+    is read. Where tiles overlap, the first tile takes precedence.
+
+    Args:
+        dem_path: Directory containing ASCII grid tiles
+        bounds: Extent of the domain
+        nodata: Value used for cells without data
+        index_path: Location of the index file
+
+    Returns:
+        tuple: Array of shape (1, rows, cols) and its transform
+    """
+    index = update_index(dem_path, index_path)
+    transform, shape, windows = mosaic_windows(dem_path, index, bounds)
+    logger.info(f'---- Reading {len(windows)} of {len(index)} DEM tiles')
+
+    array = np.full((1, *shape), nodata, dtype=np.float32)
+    for path, src_window, dst_window in windows:
+        data = read_tile(path, src_window, dst_window)
+        region = array[0, dst_window.row_off:dst_window.row_off + dst_window.height,
+                       dst_window.col_off:dst_window.col_off + dst_window.width]
+        data = data[:region.shape[0], :region.shape[1]]
+        np.copyto(region, data.filled(nodata), where=(region == nodata) & ~np.ma.getmaskarray(data))
+
+    return array, transform
+
+
+def block_rows(width, memory_limit, bytes_per_cell):
+    """Number of rows of a grid width cells wide which fit in memory_limit bytes, at least one"""
+    if memory_limit is None:
+        return None
+    return max(1, int(memory_limit // (width * bytes_per_cell)))
+
+
+def mosaic_to_file(dem_path, bounds, nodata, out_path, index_path=None, memory_limit=None):
+    """Mosaics the DEM tiles overlapping the bounds into a GeoTIFF, one band of rows at a time
+
+    Gives the same grid as :func:`read_dem`, but only a band of rows and the overlapping parts of the tiles are held in
+    memory, so the DEM can be larger than the available memory.
+
+    Args:
+        dem_path: Directory containing ASCII grid tiles
+        bounds: Extent of the domain
+        nodata: Value used for cells without data
+        out_path: GeoTIFF to create
+        index_path: Location of the index file
+        memory_limit: Approximate number of bytes used by each band of rows, defaults to the whole grid
+
+    Returns:
+        tuple: Bounds of the grid and the number of cells with data
+    """
+    index = update_index(dem_path, index_path)
+    transform, (height, width), windows = mosaic_windows(dem_path, index, bounds)
+    logger.info(f'---- Reading {len(windows)} of {len(index)} DEM tiles')
+
+    # The band, a tile window read as a masked array and the temporary comparisons
+    rows = block_rows(width, memory_limit, 16) or height
+    n_cells = 0
+    with rio.open(out_path, 'w', driver='GTiff', width=width, height=height, count=1, dtype=rio.float32,
+                  nodata=nodata, transform=transform, tiled=True, blockxsize=256, blockysize=256) as dst:
+        for row_start in range(0, height, rows):
+            row_stop = min(row_start + rows, height)
+            band = np.full((row_stop - row_start, width), nodata, dtype=np.float32)
+            for path, src_window, dst_window in windows:
+                start = max(row_start, dst_window.row_off)
+                stop = min(row_stop, dst_window.row_off + dst_window.height)
+                if start >= stop:
+                    continue
+                # Rows of the tile window which fall within the band, the tile may have a different resolution
+                scale = src_window.height / dst_window.height
+                window = Window(src_window.col_off, src_window.row_off + (start - dst_window.row_off) * scale,
+                                src_window.width, (stop - start) * scale)
+                with rio.open(path) as src:
+                    data = src.read(1, window=window, out_shape=(stop - start, dst_window.width), masked=True)
+                region = band[start - row_start:stop - row_start,
+                              dst_window.col_off:dst_window.col_off + dst_window.width]
+                data = data[:region.shape[0], :region.shape[1]]
+                np.copyto(region, data.filled(nodata), where=(region == nodata) & ~np.ma.getmaskarray(data))
+            n_cells += int((band != nodata).sum())
+            dst.write(band, 1, window=Window(0, row_start, width, row_stop - row_start))
+        return tuple(dst.bounds), n_cells
+
+
+def write_ascii(path, out_path, memory_limit=None):
+    """Writes a single band raster as an ESRI ASCII grid, a block of rows at a time
+
+    The file is the same as the one written by GDAL's AAIGrid driver, which formats each value with %.20g and adds .0
+    to the first value if it has no decimal point, so that the grid is read back as floating point.
+
+    Args:
+        path: Raster to convert
+        out_path: ASCII grid to create
+        memory_limit: Approximate number of bytes used by each block of rows, defaults to the whole raster
+    """
+    with rio.open(path) as src, open(out_path, 'w', buffering=1 << 20) as f:
+        transform = src.transform
+        if abs(transform.a + transform.e) < 1e-7 or abs(transform.a - transform.e) < 1e-7:
+            f.write(f'ncols        {src.width}\nnrows        {src.height}\n'
+                    f'xllcorner    {transform.c:.12f}\nyllcorner    {transform.f - src.height * transform.a:.12f}\n'
+                    f'cellsize     {transform.a:.12f}\n')
+        else:
+            f.write(f'ncols        {src.width}\nnrows        {src.height}\n'
+                    f'xllcorner    {transform.c:.12f}\nyllcorner    {transform.f + src.height * transform.e:.12f}\n'
+                    f'dx           {transform.a:.12f}\ndy           {abs(transform.e):.12f}\n')
+        if src.nodata is not None:
+            f.write(f'NODATA_value {src.nodata:.20g}\n')
+
+        # Values as doubles, their text and the list holding it
+        rows = block_rows(src.width, memory_limit, 64) or src.height
+        has_decimal = False
+        for row_start in range(0, src.height, rows):
+            block = src.read(1, window=Window(0, row_start, src.width, min(rows, src.height - row_start)))
+            for row in block.astype(np.float64).tolist():
+                values = list(map('%.20g'.__mod__, row))
+                if not has_decimal:
+                    for i, value in enumerate(values):
+                        if any(c in value for c in '.eE'):
+                            has_decimal = True
+                            break
+                        if np.isfinite(row[i]):
+                            values[i] = value + '.0'
+                            has_decimal = True
+                            break
+                f.write(' '.join(values))
+                f.write(' \n')
@@ -0,0 +1,84 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import run
+
+logger = logging.getLogger('citycat-dafni')
+
+# Files created by each scenario which are listed in the ensemble index
+output_files = ['max_depth.tif', 'max_depth_interpolated.tif', 'max_velocity.tif', 'max_vd_product.tif',
+                'max_depth.png', 'R1C1_SurfaceMaps.nc', 'R1C1_SurfaceMaps.zip', 'R1C1_SurfaceMaps.tar.zst',
+                'point_timeseries.csv', 'exposure', 'metadata.json']
+
+
+def run_member(i, run_path, parameters, boundary, template_path, domain_info, workers, resume=False, only=None,
+               rainfall_bounds=None):
+    start_timestamp = pd.Timestamp.now()
+    try:
+        title, _ = run.run_scenario(run_path, parameters, boundary, template_path, domain_info, workers=workers,
+                                    rainfall_bounds=rainfall_bounds, resume=resume, only=only)
+        status = 'completed'
+    except Exception:
+        logger.exception(f'Scenario {i} failed')
+        title, status = None, 'failed'
+    return dict(scenario=i, title=title, status=status,
+                seconds=(pd.Timestamp.now() - start_timestamp).total_seconds())
+
+
+def run_ensemble(scenarios, boundary, template_path, domain_info, workers=None, resume=False, only=None,
+                 ensemble_path=None, ids=None, rainfall_bounds=None):
+    """Runs CityCAT for each scenario concurrently, sharing the domain input files
+
+    The DEM, buildings and green areas are linked from the template, so only the rainfall and configuration files
+    are written for each scenario. Each scenario is run in its own directory within outputs/run and its results are
+    processed as soon as its simulation finishes.
+    An index of all scenarios and their outputs is written to outputs/run/ensemble_index.csv.
+
+    Args:
+        scenarios: Parameters of each scenario
+        boundary: Boundary polygons used for plotting and rainfall extraction
+        template_path: Template created by :func:`run.prepare_template`
+        domain_info: Domain information created by :func:`run.prepare_template`
+        workers: Number of simulations to run at the same time, defaults to ENSEMBLE_WORKERS or the number of CPUs
+        resume: Whether to skip the stages of each scenario whose outputs are up to date
+        only: Name of a single stage to run for each scenario
+        ensemble_path: Directory in which to run the scenarios, defaults to outputs/run
+        ids: Number of each scenario used to name its directory, defaults to its position in scenarios
+        rainfall_bounds: Extent used to extract the rainfall if there is no boundary, defaults to the domain bounds
+    """
+    workers = workers or int(os.getenv('ENSEMBLE_WORKERS', os.cpu_count()))
+    workers = min(workers, len(scenarios))
+    # CPUs left for converting results are shared between the simulations
+    conversion_workers = max(1, run.workers // workers)
+
+    ensemble_path = ensemble_path or os.path.join(run.outputs_path, 'run')
+    if not os.path.exists(ensemble_path):
+        os.makedirs(ensemble_path)
+
+    ids = ids if ids is not None else list(range(len(scenarios)))
+    run_paths = [os.path.join(ensemble_path, f'scenario_{i:03d}') for i in ids]
+
+    logger.info(f'Running {len(scenarios)} scenarios using {workers} workers')
+    results = []
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(run_member, i, run_path, parameters, boundary, template_path, domain_info,
+                                   conversion_workers, resume, only, rainfall_bounds)
+                   for i, run_path, parameters in zip(ids, run_paths, scenarios)]
+        for future in as_completed(futures):
+            result = future.result()
+            logger.info(f'Scenario {result["scenario"]} {result["status"]} in {result["seconds"]:.0f}s')
+            results.append(result)
+
+    index = pd.DataFrame(scenarios, index=ids)
+    index.index.name = 'scenario'
+    index['run_path'] = [os.path.relpath(run_path, run.outputs_path) for run_path in run_paths]
+    index = index.join(pd.DataFrame(results).set_index('scenario'))
+    for file_name in output_files:
+        index[file_name] = [os.path.join(path, file_name) if os.path.exists(os.path.join(run.outputs_path, path,
+                                                                                          file_name)) else None
+                            for path in index.run_path]
+    index.to_csv(os.path.join(ensemble_path, 'ensemble_index.csv'))
+
+    logger.info(f'{(index.status == "completed").sum()} of {len(index)} scenarios completed')
+    return index
@@ -0,0 +1,221 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+import rasterio as rio
+from rasterio.features import rasterize
+from rasterio.vrt import WarpedVRT
+from rasterio import windows
+from rasterio.enums import Resampling
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from render import classes
+
+logger = logging.getLogger('citycat-dafni')
+
+# Hazard rasters summarised for each asset, the depth raster defines the grid
+hazards = ['max_depth', 'max_velocity', 'max_vd_product']
+# Depth classes used by the map, the lowest being the depth at which a cell is taken to be flooded
+depth_classes = classes['max_depth'][1]
+# Statistics of each asset, in the order they are returned by block_statistics
+statistic_names = ['cells', 'depth_sum', 'max_depth', 'max_velocity', 'max_vd_product', 'flooded_cells']
+
+
+def read_window(path, window, profile):
+    """Reads a window of a raster on the grid of profile as float32 with NaN where there is no data"""
+    with rio.open(path) as ds:
+        if ds.transform == profile['transform'] and (ds.width, ds.height) == (profile['width'], profile['height']):
+            array = ds.read(1, window=window, masked=True)
+        else:
+            with WarpedVRT(ds, crs=profile['crs'], transform=profile['transform'], width=profile['width'],
+                           height=profile['height'], resampling=Resampling.nearest) as vrt:
+                array = vrt.read(1, window=window, masked=True)
+    return array.astype(np.float32).filled(np.nan)
+
+
+def label_statistics(rasters, depth, shapes, window, transform):
+    """Statistics of the assets in a single grid of labels, which must not overlap"""
+    from shapely import wkb
+
+    labels = rasterize([(wkb.loads(geometry), label) for geometry, label in shapes],
+                       out_shape=(window.height, window.width), transform=transform, fill=0, all_touched=True,
+                       dtype='int32').ravel()
+
+    # Cells are sorted by label so each asset is a contiguous run reduced in a single call
+    cells = np.flatnonzero((labels > 0) & np.isfinite(depth))
+    cells = cells[np.argsort(labels[cells], kind='stable')]
+    sorted_labels = labels[cells]
+    if len(cells) == 0:
+        return np.empty(0, dtype=np.int32), np.empty((len(statistic_names), 0))
+    starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+
+    cell_depth = depth[cells].astype(np.float64)
+    statistics = np.vstack([
+        np.diff(np.r_[starts, len(cells)]),
+        np.add.reduceat(cell_depth, starts),
+        np.maximum.reduceat(cell_depth, starts),
+        np.fmax.reduceat(rasters['max_velocity'][cells], starts),
+        np.fmax.reduceat(rasters['max_vd_product'][cells], starts),
+        np.add.reduceat(cell_depth >= depth_classes[0], starts),
+    ])
+    return sorted_labels[starts], statistics
+
+
+def block_statistics(paths, profile, window, passes):
+    """Statistics of the assets within a window of the hazard rasters
+
+    Args:
+        paths: Path of each hazard raster
+        profile: Profile of the depth raster
+        window: Window to summarise
+        passes: Lists of the WKB geometries of the assets intersecting the window and their labels, numbered from 1.
+            The assets in each list do not overlap, so each list is rasterized into its own grid of labels
+
+    Returns:
+        tuple: Labels of the assets with cells in the window, an array of their statistics and the number of cells
+            with data in each depth class
+    """
+    rasters = {name: read_window(path, window, profile).ravel() for name, path in paths.items()}
+    depth = rasters['max_depth']
+    histogram = np.histogram(depth[np.isfinite(depth)], bins=depth_classes + [np.inf])[0]
+
+    transform = windows.transform(window, profile['transform'])
+    results = [label_statistics(rasters, depth, shapes, window, transform) for shapes in passes if len(shapes) > 0]
+    if len(results) == 0:
+        return np.empty(0, dtype=np.int32), np.empty((len(statistic_names), 0)), histogram
+    # Each asset is in a single pass, so the labels remain unique
+    return np.concatenate([labels for labels, _ in results]), np.hstack([block for _, block in results]), histogram
+
+
+def overlap_passes(polygons):
+    """Pass in which each asset is rasterized, so that assets which touch or overlap are in different passes
+
+    Assets are assigned in order to the first pass containing none of the assets they intersect.
+
+    Returns:
+        numpy.ndarray: Pass of each asset
+    """
+    import geopandas as gpd
+
+    sindex = polygons.sindex
+    # geopandas before 0.12 only queries several geometries at once with query_bulk, which was later removed
+    bulk = tuple(int(v) for v in gpd.__version__.split('.')[:2]) < (0, 12)
+    left, right = (sindex.query_bulk if bulk else sindex.query)(polygons.geometry, predicate='intersects')
+    earlier = left > right
+    neighbours = pd.Series(right[earlier]).groupby(left[earlier]).agg(list)
+
+    passes = np.zeros(len(polygons), dtype=np.int32)
+    for i, others in neighbours.items():
+        used = set(passes[others])
+        while passes[i] in used:
+            passes[i] += 1
+    return passes
+
+
+def zonal_statistics(polygons, run_path, workers=None, block_size=1024):
+    """Maximum and mean depth, maximum velocity and V×D product and flooded area of each asset
+
+    Each block of the hazard rasters is summarised in parallel. The assets intersecting a block are rasterized into a
+    grid of labels and the cells of each asset reduced at once, rather than masking the rasters one asset at a time.
+    Every cell touched by an asset is included, so buildings, which CityCAT does not flood, include the cells along
+    their walls. Assets which touch or overlap, such as nested zones or terraced buildings, are rasterized in separate
+    passes, so cells they share count towards each of them.
+
+    Args:
+        polygons: GeoDataFrame of assets in the same CRS as the rasters
+        run_path: Directory containing the hazard rasters
+        workers: Number of processes used to summarise blocks
+        block_size: Width and height in cells of each block
+
+    Returns:
+        tuple: GeoDataFrame of the assets with a column for each statistic and a DataFrame of the area and number of
+            assets in each depth class
+    """
+    paths = {name: os.path.join(run_path, f'{name}.tif') for name in hazards}
+    with rio.open(paths['max_depth']) as ds:
+        profile = ds.profile
+    cell_area = abs(profile['transform'].a * profile['transform'].e)
+    workers = workers or os.cpu_count()
+
+    geometries = polygons.geometry.values
+    bounds = polygons.geometry.bounds.values
+    valid = ~(polygons.geometry.isna() | polygons.geometry.is_empty).values
+    passes = overlap_passes(polygons)
+    n_passes = int(passes.max()) + 1 if len(passes) > 0 else 0
+    if n_passes > 1:
+        logger.info(f'---- {int((passes > 0).sum())} assets touch or overlap others, rasterizing in {n_passes} passes')
+
+    blocks = []
+    for row in range(0, profile['height'], block_size):
+        for col in range(0, profile['width'], block_size):
+            window = windows.Window(col, row, min(block_size, profile['width'] - col),
+                                    min(block_size, profile['height'] - row))
+            left, bottom, right, top = windows.bounds(window, profile['transform'])
+            intersecting = np.flatnonzero(valid & (bounds[:, 0] <= right) & (bounds[:, 2] >= left) &
+                                          (bounds[:, 1] <= top) & (bounds[:, 3] >= bottom))
+            blocks.append((window, [[(geometries[i].wkb, i + 1) for i in intersecting[passes[intersecting] == p]]
+                                    for p in range(n_passes)]))
+
+    statistics = np.zeros((len(statistic_names), len(polygons) + 1))
+    statistics[2:5] = np.nan
+    histogram = np.zeros(len(depth_classes), dtype=np.int64)
+
+    def combine(result):
+        nonlocal histogram
+        labels, block, block_histogram = result
+        # Labels are unique within a block, so the statistics of each asset are combined with fancy indexing
+        statistics[np.ix_([0, 1, 5], labels)] += block[[0, 1, 5]]
+        statistics[2:5, labels] = np.fmax(statistics[2:5, labels], block[2:5])
+        histogram += block_histogram
+
+    with ProcessPoolExecutor(min(workers, len(blocks))) as executor:
+        pending = set()
+        for window, block_passes in blocks:
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    combine(future.result())
+            pending.add(executor.submit(block_statistics, paths, profile, window, block_passes))
+        for future in pending:
+            combine(future.result())
+
+    cells, depth_sum, max_depth, max_velocity, max_vd_product, flooded_cells = statistics[:, 1:]
+    assets = polygons.copy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        assets['max_depth'] = max_depth.round(3)
+        assets['mean_depth'] = (depth_sum / cells).round(3)
+    assets['max_velocity'] = max_velocity.round(3)
+    assets['max_vd_product'] = max_vd_product.round(3)
+    assets['flooded_area'] = flooded_cells * cell_area
+
+    # Assets are counted in the class of their maximum depth
+    asset_classes = np.digitize(max_depth[np.isfinite(max_depth)], depth_classes) - 1
+    summary = pd.DataFrame({
+        'lower_depth': depth_classes,
+        'upper_depth': depth_classes[1:] + [np.inf],
+        'flooded_area': histogram * cell_area,
+        'assets': np.bincount(asset_classes[asset_classes >= 0], minlength=len(depth_classes)),
+    })
+
+    logger.info(f'---- Calculated exposure of {len(assets)} assets, {int((flooded_cells > 0).sum())} flooded')
+    return assets, summary
+
+
+def write_exposure(assets, summary, out_path, name, driver='GPKG'):
+    """Writes the statistics of each asset as a GeoPackage or Parquet file and the summary of each depth class as CSV
+
+    Returns:
+        list: Paths of the files created
+    """
+    os.makedirs(out_path, exist_ok=True)
+    if driver == 'Parquet':
+        # Parquet files need pyarrow, which is optional
+        assets_path = os.path.join(out_path, f'{name}.parquet')
+        assets.to_parquet(assets_path)
+    else:
+        assets_path = os.path.join(out_path, f'{name}.gpkg')
+        if os.path.exists(assets_path):
+            os.remove(assets_path)
+        assets.to_file(assets_path, driver='GPKG', layer=name)
+    summary_path = os.path.join(out_path, f'{name}_depth_classes.csv')
+    summary.to_csv(summary_path, index=False)
+    return [assets_path, summary_path]
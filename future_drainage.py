@@ -0,0 +1,161 @@
+"""Binary store of the FUTURE-DRAINAGE grids indexed by 5km cell
+
+Usage: python future_drainage.py <future-drainage directory> [store path]
+"""
+import os
+import sys
+import json
+import logging
+import zipfile
+import tempfile
+import warnings
+from glob import glob
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+from shapely.prepared import prep
+
+logger = logging.getLogger('citycat-dafni')
+
+# Increment when the layout of the store changes
+version = 1
+
+# Width of the FUTURE-DRAINAGE grid cells
+cell_size = 5000
+
+
+def grid_name(time_horizon, duration, return_period):
+    """Name of the grid containing the return levels and uplifts, the 2050 grid is used for the baseline"""
+    return f'Uplift_{time_horizon if time_horizon != "baseline" else "2050"}_{duration}hr_Pr_{return_period}yrRL_Grid'
+
+
+def read_grid(path):
+    """Reads a FUTURE-DRAINAGE CSV file onto a regular grid
+
+    Returns:
+        tuple: Column names, values of shape (columns, rows, cols) with NaN where there is no point and the centre of
+        the south west cell
+    """
+    df = pd.read_csv(path, header=1)
+    columns = [column for column in df.columns if pd.api.types.is_numeric_dtype(df[column])]
+    x0, y0 = df.easting.min(), df.northing.min()
+    cols = np.round((df.easting.values - x0) / cell_size).astype(int)
+    rows = np.round((df.northing.values - y0) / cell_size).astype(int)
+
+    values = np.full((len(columns), rows.max() + 1, cols.max() + 1), np.nan)
+    values[:, rows, cols] = df[columns].values.T
+    return columns, values, (x0, y0)
+
+
+def sources(directory):
+    """Modification time and size of each CSV file keyed by grid name"""
+    return {os.path.splitext(os.path.basename(path))[0]: [os.path.getmtime(path), os.path.getsize(path)]
+            for path in sorted(glob(os.path.join(directory, 'Uplift_*_Grid.csv')))}
+
+
+def build_store(directory, store_path):
+    """Converts every grid in directory into a single compressed file
+
+    The store is written to a temporary file which then replaces store_path, so processes opening the store at the
+    same time never read a partly written file.
+    """
+    arrays = {}
+    for name in sources(directory):
+        columns, values, origin = read_grid(os.path.join(directory, f'{name}.csv'))
+        arrays[name] = values
+        arrays[f'{name}.columns'] = np.array(columns)
+        arrays[f'{name}.origin'] = np.array(origin)
+    arrays['sources'] = np.array(json.dumps(dict(version=version, sources=sources(directory))))
+    fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(os.path.abspath(store_path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, store_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    logger.info(f'---- Converted {len(arrays) // 3} FUTURE-DRAINAGE grids')
+
+
+def open_store(directory, store_path=None):
+    """Opens the store, converting the grids first if it is missing or any CSV file has changed
+
+    If the store cannot be written, it is kept in TMPDIR instead.
+
+    Args:
+        directory: Directory containing the FUTURE-DRAINAGE CSV files
+        store_path: Location of the store, defaults to future_drainage.npz in directory
+
+    Returns:
+        Store: The open store
+    """
+    store_path = store_path or os.path.join(directory, 'future_drainage.npz')
+    expected = json.dumps(dict(version=version, sources=sources(directory)))
+    if os.path.exists(store_path):
+        try:
+            store = np.load(store_path)
+            if str(store['sources']) == expected:
+                return Store(store)
+            logger.info('---- FUTURE-DRAINAGE files have changed')
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            logger.warning(f'Could not read FUTURE-DRAINAGE store {store_path}, recreating it')
+
+    fallback_path = os.path.join(os.getenv('TMPDIR', '/tmp'), 'future_drainage.npz')
+    try:
+        build_store(directory, store_path)
+    except OSError:
+        if store_path == fallback_path:
+            raise
+        logger.warning(f'Could not write FUTURE-DRAINAGE store to {store_path}')
+        return open_store(directory, fallback_path)
+    return Store(np.load(store_path))
+
+
+class Store:
+    """Grids loaded from the store, each grid is only decompressed when it is first used"""
+    def __init__(self, npz):
+        self.npz = npz
+        self.grids = {}
+
+    def grid(self, name):
+        if name not in self.grids:
+            assert f'{name}.columns' in self.npz, f'{name} not found in FUTURE-DRAINAGE data'
+            self.grids[name] = list(self.npz[f'{name}.columns']), self.npz[name], self.npz[f'{name}.origin']
+        return self.grids[name]
+
+    def lookup(self, name, geometry):
+        """Values averaged over the cells intersecting geometry
+
+        Args:
+            name: Grid name created by :func:`grid_name`
+            geometry: Shapely geometry of the domain
+
+        Returns:
+            pandas.Series: Mean of each column, the same as averaging the CSV rows whose cells intersect geometry
+        """
+        columns, values, (x0, y0) = self.grid(name)
+        x_min, y_min, x_max, y_max = geometry.bounds
+        half = cell_size / 2
+        # Cells which could intersect the bounds of the geometry, clipped to the grid
+        col_start = max(int(np.ceil((x_min - half - x0) / cell_size)), 0)
+        col_stop = min(int(np.floor((x_max + half - x0) / cell_size)), values.shape[2] - 1)
+        row_start = max(int(np.ceil((y_min - half - y0) / cell_size)), 0)
+        row_stop = min(int(np.floor((y_max + half - y0) / cell_size)), values.shape[1] - 1)
+
+        geometry = prep(geometry)
+        cells = [(row, col) for row in range(row_start, row_stop + 1) for col in range(col_start, col_stop + 1)
+                 if not np.isnan(values[0, row, col])
+                 and geometry.intersects(box(x0 + col * cell_size - half, y0 + row * cell_size - half,
+                                             x0 + col * cell_size + half, y0 + row * cell_size + half))]
+        if len(cells) == 0:
+            return pd.Series(np.nan, index=columns)
+        rows, cols = zip(*cells)
+        # Missing values are skipped as pandas does when averaging the CSV rows, a column with none is NaN
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return pd.Series(np.nanmean(values[:, rows, cols], axis=1), index=columns)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    build_store(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else os.path.join(sys.argv[1], 'future_drainage.npz'))
@@ -0,0 +1,67 @@
+import os
+import time
+import logging
+from glob import glob
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import geopandas as gpd
+
+logger = logging.getLogger('citycat-dafni')
+
+
+def list_files(path):
+    """GeoPackage and shapefiles in a directory"""
+    return sorted(glob(os.path.join(path, '*.gpkg'))) + sorted(glob(os.path.join(path, '*.shp')))
+
+
+def read_file(path, bbox=None, columns=None, simplify=None):
+    """Reads a single file, keeping only the features intersecting bbox
+
+    Args:
+        path: File to read
+        bbox: Bounds used by the driver to filter features, which uses the spatial index of the file if it has one
+        columns: Attribute columns to keep, defaults to all columns
+        simplify: Tolerance used to simplify the geometries, defaults to no simplification
+
+    Returns:
+        geopandas.GeoDataFrame: The features
+    """
+    geometries = gpd.read_file(path, bbox=bbox)
+    if columns is not None:
+        geometries = geometries[[column for column in columns if column in geometries.columns] + ['geometry']]
+    if simplify:
+        geometries['geometry'] = geometries.geometry.simplify(simplify, preserve_topology=True)
+    return geometries
+
+
+def read_files(paths, bbox=None, columns=None, simplify=None, workers=None):
+    """Reads files in parallel and concatenates the features once
+
+    Args:
+        paths: Files to read
+        bbox: Bounds used by the driver to filter features
+        columns: Attribute columns to keep, defaults to all columns
+        simplify: Tolerance used to simplify the geometries, defaults to no simplification
+        workers: Number of processes used to read the files, defaults to the number of CPUs
+
+    Returns:
+        geopandas.GeoDataFrame: The features from all files or None if there are no files
+    """
+    if len(paths) == 0:
+        return None
+
+    start = time.perf_counter()
+    workers = min(workers or os.cpu_count(), len(paths))
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            frames = list(executor.map(read_file, paths, repeat(bbox), repeat(columns), repeat(simplify)))
+    else:
+        frames = [read_file(path, bbox, columns, simplify) for path in paths]
+
+    geometries = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs=frames[0].crs)
+
+    seconds = time.perf_counter() - start
+    logger.info(f'-------- Read {len(geometries)} features from {len(paths)} files in {seconds:.2f}s '
+                f'({len(geometries) / seconds:.0f} features/s)')
+    return geometries
@@ -0,0 +1,95 @@
+import os
+import logging
+import numpy as np
+import xarray as xr
+import rioxarray as rx  # registers the rio accessor
+from surface_maps import fill_value
+
+logger = logging.getLogger('citycat-dafni')
+
+
+class RunningMaxima:
+    """Maximum depth, velocity and velocity-depth product accumulated one time step at a time
+
+    Args:
+        shape: Shape of the grid (rows, cols)
+    """
+    def __init__(self, shape):
+        self.depth = np.full(shape, np.nan, dtype=np.float32)
+        self.velocity = np.full(shape, np.nan, dtype=np.float32)
+        self.vd_product = np.full(shape, np.nan, dtype=np.float32)
+        self.steps = 0
+
+    def update(self, depth, x_vel, y_vel):
+        """Updates the maxima using a single time step or a block of time steps
+
+        Args:
+            depth: Depth array of shape (rows, cols) or (steps, rows, cols), NaN where there is no data
+            x_vel: Velocity in the x direction with the same shape as depth
+            y_vel: Velocity in the y direction with the same shape as depth
+        """
+        depth = np.asarray(depth, dtype=np.float32)
+        velocity = np.hypot(np.asarray(x_vel, dtype=np.float32), np.asarray(y_vel, dtype=np.float32))
+
+        if depth.ndim == 2:
+            depth, velocity = depth[np.newaxis], velocity[np.newaxis]
+
+        for step_depth, step_velocity in zip(depth, velocity):
+            np.fmax(self.depth, step_depth, out=self.depth)
+            np.fmax(self.velocity, step_velocity, out=self.velocity)
+            step_velocity *= step_depth
+            np.fmax(self.vd_product, step_velocity, out=self.vd_product)
+            self.steps += 1
+
+    def rasters(self):
+        """Maxima rounded to 3 decimal places with cells lacking data set to the CityCAT fill value"""
+        rasters = {}
+        for name, array in [('max_depth', self.depth), ('max_velocity', self.velocity),
+                            ('max_vd_product', self.vd_product)]:
+            array = array.round(3)
+            array[~np.isfinite(array)] = fill_value
+            rasters[name] = array
+        return rasters
+
+
+def write_raster(array, x, y, path):
+    raster = xr.DataArray(array, coords=[y, x], dims=('y', 'x'))
+    raster.rio.set_crs('EPSG:27700')
+    raster.rio.set_nodata(fill_value)
+    raster.rio.to_raster(path)
+
+
+def max_hazards(netcdf_path, out_path, names=('max_velocity', 'max_vd_product'), steps=1):
+    """Calculates maximum depth, velocity and velocity-depth product rasters in a single pass
+
+    The netCDF file is read one block of time steps at a time, so memory use does not depend on the number of
+    output time steps.
+
+    Args:
+        netcdf_path: netCDF file created from the CityCAT surface maps
+        out_path: Directory in which to create GeoTIFF files
+        names: Rasters to write, any of max_depth, max_velocity and max_vd_product
+        steps: Number of time steps to read at once
+
+    Returns:
+        RunningMaxima: The accumulated maxima
+    """
+    with xr.open_dataset(netcdf_path) as ds:
+        maxima = RunningMaxima((ds.dims['y'], ds.dims['x']))
+        for start in range(0, ds.dims['time'], steps):
+            block = ds.isel(time=slice(start, start + steps))
+            maxima.update(block.depth.values, block.x_vel.values, block.y_vel.values)
+        x, y = ds.x.values, ds.y.values
+
+    logger.info(f'---- Calculated maxima from {maxima.steps} time steps')
+
+    write_rasters(maxima, x, y, out_path, names)
+
+    return maxima
+
+
+def write_rasters(maxima, x, y, out_path, names=('max_velocity', 'max_vd_product')):
+    """Writes accumulated maxima to GeoTIFF files named after each raster"""
+    rasters = maxima.rasters()
+    for name in names:
+        write_raster(rasters[name], x, y, os.path.join(out_path, f'{name}.tif'))
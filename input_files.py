@@ -0,0 +1,91 @@
+import os
+import shutil
+import logging
+import numpy as np
+import shapely
+from dem import write_ascii
+
+logger = logging.getLogger('citycat-dafni')
+
+# Polygon files written by citycatio.Model and whether each includes the polygon index
+polygon_files = {
+    'rainfall_polygons': ('Rainfall_Polygons.txt', False),
+    'buildings': ('Buildings.txt', False),
+    'green_areas': ('GreenAreas.txt', False),
+    'friction': ('FrictionCoeffs.txt', True),
+    'open_boundaries': ('BCs_open.txt', False),
+    'flow_polygons': ('BCs_flow.txt', False),
+}
+
+
+def exterior_coordinates(geoseries):
+    """Coordinates of the exterior rings of polygons and the number of coordinates in each ring"""
+    if hasattr(shapely, 'get_coordinates'):
+        # Shapely 2 reads the coordinates of every ring at once
+        rings = shapely.get_exterior_ring(np.asarray(geoseries.values))
+        return shapely.get_coordinates(rings), shapely.get_num_coordinates(rings)
+    exteriors = [np.asarray(geometry.exterior.coords)[:, :2] for geometry in geoseries.values]
+    counts = np.array([len(exterior) for exterior in exteriors], dtype=int)
+    return (np.concatenate(exteriors) if len(exteriors) > 0 else np.empty((0, 2))), counts
+
+
+def polygon_lines(geoseries, index=False, index_first=True):
+    """Lines of the CityCAT representation of polygons, the same as citycatio.utils.geoseries_to_string
+
+    Coordinates are converted to text in bulk, each with the same shortest representation as str(float).
+    """
+    assert (geoseries.geom_type == 'Polygon').all(), 'Geometries must be of type Polygon'
+
+    coords, counts = exterior_coordinates(geoseries)
+    x = list(map(repr, coords[:, 0].tolist()))
+    y = list(map(repr, coords[:, 1].tolist()))
+    ends = np.cumsum(counts).tolist()
+
+    yield f'{len(geoseries)}\n'
+    start = 0
+    for idx, count, end in zip(geoseries.index, counts.tolist(), ends):
+        if not index:
+            prefix = f'{count}'
+        elif index_first:
+            prefix = f'{idx} {count}'
+        else:
+            prefix = f'{count} {idx}'
+        yield f'{prefix} {" ".join(x[start:end])} {" ".join(y[start:end])}\n'
+        start = end
+
+
+def write_polygons(geoseries, path, index=False, index_first=True, buffer_size=1 << 20):
+    with open(path, 'w', buffering=buffer_size) as f:
+        f.writelines(polygon_lines(geoseries, index=index, index_first=index_first))
+
+
+def write_model(model, path, dem_file=None, memory_limit=None):
+    """Writes the input files of a citycatio Model, giving the same files as Model.write
+
+    The polygon files, which grow with the number of buildings and green areas, are written in bulk and the remaining
+    files by citycatio. The DEM is already written by GDAL, which is faster than formatting it in Python.
+
+    Args:
+        model: citycatio.Model to write
+        path: Directory in which to create the input files, replaced if it exists
+        dem_file: GeoTIFF from which the DEM is written a block of rows at a time instead of from the model
+        memory_limit: Approximate number of bytes used by each block of rows of the DEM
+    """
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.mkdir(path)
+    if dem_file is not None:
+        write_ascii(dem_file, os.path.join(path, 'Domain_DEM.ASC'), memory_limit=memory_limit)
+    else:
+        model.dem.write(path)
+    model.rainfall.write(path)
+    model.configuration.write(path)
+    if model.flow is not None:
+        model.flow.write(path)
+
+    for name, (file_name, index) in polygon_files.items():
+        polygons = getattr(model, name)
+        if polygons is not None:
+            # Flow and rainfall polygons are stored as a GeoSeries, the others as a GeoDataFrame
+            data = polygons.data if name in ['flow_polygons', 'rainfall_polygons'] else polygons.data.geometry
+            write_polygons(data, os.path.join(path, file_name), index=index, index_first=False)
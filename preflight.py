@@ -0,0 +1,179 @@
+import os
+import json
+import math
+import logging
+from glob import glob
+from datetime import datetime
+import numpy as np
+from dem import update_index, intersecting_tiles
+
+logger = logging.getLogger('citycat-dafni')
+
+# Quantities predicted from past runs and the size of the domain each one scales with
+targets = {
+    'simulate_seconds': 'cell_seconds',
+    'wall_seconds': 'cell_seconds',
+    'peak_rss_mb': 'cells',
+    'disk_mb': 'cell_steps',
+}
+
+
+def count_features(paths, bounds):
+    """Number of features intersecting bounds, using the spatial index of each file rather than reading geometries"""
+    import fiona
+
+    n = 0
+    for path in paths:
+        with fiona.open(path) as collection:
+            n += sum(1 for _ in collection.keys(bbox=tuple(bounds)))
+    return n
+
+
+def dem_coverage(index, bounds):
+    """Fraction and area of the domain covered by DEM tiles and the finest tile resolution, from the tile index"""
+    from shapely.geometry import box
+    from shapely.ops import unary_union
+
+    domain = box(*bounds)
+    names = intersecting_tiles(index, bounds)
+    if len(names) == 0:
+        return 0, 0, None
+    covered = unary_union([box(*index[name]['bounds']) for name in names]).intersection(domain).area
+    return covered / domain.area, covered, min(index[name]['res'][0] for name in names)
+
+
+def run_size(cells, parameters):
+    """Simulated time and the products of cells and time used to scale predictions"""
+    simulated_seconds = (parameters['duration'] + parameters['post_event_duration']) * 3600
+    output_steps = simulated_seconds // parameters['output_interval'] + 1
+    return dict(cells=cells, simulated_seconds=simulated_seconds, output_steps=output_steps,
+                cell_seconds=cells * simulated_seconds, cell_steps=cells * output_steps)
+
+
+def domain_metrics(inputs_path, bounds, parameters, index_path=None):
+    """Size of a run found from the DEM tile headers and feature counts, without reading the DEM or geometries
+
+    Cells are estimated from the area covered by DEM tiles, so nodata cells within tiles are counted. The wet area
+    is the area covered by the DEM, on which rain falls.
+
+    Returns:
+        dict: DEM coverage, resolution, cells, wet area, numbers of buildings and green areas and the simulated time
+    """
+    import geometries
+
+    index = update_index(os.path.join(inputs_path, 'dem'), index_path)
+    coverage, covered, res = dem_coverage(index, bounds)
+    cells = int(round(covered / res ** 2)) if res else 0
+    metrics = dict(coverage=round(coverage, 4), res=res, wet_area=covered)
+    for name in ['buildings', 'green_areas']:
+        metrics[name] = count_features(geometries.list_files(os.path.join(inputs_path, name)), bounds)
+    metrics.update(run_size(cells, parameters))
+    return metrics
+
+
+def observation(telemetry):
+    """Size and measured resources of a past run from its telemetry, None if CityCAT was not run"""
+    stages = {record['name']: record for record in telemetry['stages']}
+    if 'simulate' not in stages:
+        return None
+
+    # The preflight estimate is preferred, so predictions are made from the same measure of size
+    cells = stages.get('preflight', {}).get('cells') or stages.get('dem', {}).get('cells')
+    if not cells:
+        return None
+
+    starts = [datetime.fromisoformat(record['start']) for record in telemetry['stages']]
+    ends = [start.timestamp() + record['wall_seconds'] for start, record in zip(starts, telemetry['stages'])]
+    return dict(
+        run_size(cells, telemetry['parameters']),
+        simulate_seconds=stages['simulate']['wall_seconds'],
+        wall_seconds=max(ends) - min(starts).timestamp(),
+        # CityCAT runs in a child process, older telemetry recorded the peak of the child processes for each stage
+        peak_rss_mb=max([telemetry.get('lifetime_children_peak_rss_mb') or 0] +
+                        [max(record['peak_rss_mb'], record.get('children_peak_rss_mb') or 0)
+                         for record in telemetry['stages']]),
+        disk_mb=telemetry.get('disk_mb'))
+
+
+def read_history(path):
+    """Observations of the runs described by telemetry.json files within path"""
+    paths = [path] if os.path.isfile(path) else glob(os.path.join(path, '**', 'telemetry.json'), recursive=True)
+    history = []
+    for telemetry_path in paths:
+        try:
+            with open(telemetry_path) as f:
+                run = observation(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.warning(f'---- Could not read telemetry from {telemetry_path}')
+            continue
+        if run is not None:
+            history.append(run)
+    return history
+
+
+def fit(history, target, size):
+    """Fits log(target) = intercept + slope * log(size)
+
+    With fewer than three different sizes, the target is taken to be proportional to the size.
+
+    Returns:
+        tuple: Slope, intercept and number of runs, or None if no runs have recorded the target
+    """
+    points = np.array([(run[size], run[target]) for run in history
+                       if run.get(target) is not None and run[target] > 0 and run[size] > 0], dtype=np.float64)
+    if len(points) == 0:
+        return None
+    x, y = np.log(points[:, 0]), np.log(points[:, 1])
+    if len(np.unique(x)) >= 3:
+        slope, intercept = np.polyfit(x, y, 1)
+    else:
+        slope, intercept = 1.0, float(np.median(y - x))
+    return float(slope), float(intercept), len(points)
+
+
+def predict(history, metrics):
+    """Predicted wall time of the simulation and the whole run, peak memory and disk usage"""
+    prediction = {}
+    for target, size in targets.items():
+        model = fit(history, target, size)
+        if model is not None and metrics[size] > 0:
+            slope, intercept, runs = model
+            prediction[target] = round(math.exp(intercept + slope * math.log(metrics[size])), 1)
+            prediction[f'{target}_runs'] = runs
+    return prediction
+
+
+def layout(seconds, max_seconds):
+    """Decomposition into enough sub-domains for each to be predicted to take less than max_seconds"""
+    n = math.ceil(seconds / max_seconds)
+    n_x = math.ceil(math.sqrt(n))
+    return f'{n_x}x{math.ceil(n / n_x)}'
+
+
+def check(inputs_path, bounds, parameters, history_path, limits, index_path=None):
+    """Estimates the size of a run and predicts its resources from past runs before anything is read or run
+
+    Args:
+        inputs_path: Directory containing the dem, buildings and green_areas directories
+        bounds: Extent of the domain
+        parameters: Run parameters
+        history_path: Directory containing the telemetry.json files of past runs, or a single file
+        limits: Maximum wall_seconds, peak_rss_mb and disk_mb, None where there is no limit
+
+    Returns:
+        dict: Domain metrics, predictions and the limits which are predicted to be exceeded
+    """
+    metrics = domain_metrics(inputs_path, bounds, parameters, index_path=index_path)
+    if metrics['coverage'] < 1:
+        logger.warning(f'---- DEM tiles cover {metrics["coverage"]:.1%} of the domain')
+
+    history = read_history(history_path) if history_path and os.path.exists(history_path) else []
+    prediction = predict(history, metrics)
+    exceeded = [name for name, limit in limits.items()
+                if limit is not None and prediction.get(name) is not None and prediction[name] > limit]
+
+    logger.info(f'---- Preflight: {metrics["cells"]} cells, {metrics["buildings"]} buildings, '
+                f'{metrics["simulated_seconds"] / 3600:g}hr simulated, predicted from {len(history)} runs '
+                f'{prediction.get("wall_seconds", "?")}s, {prediction.get("peak_rss_mb", "?")}MB peak, '
+                f'{prediction.get("disk_mb", "?")}MB disk')
+    return dict(metrics, history=len(history), prediction=prediction, exceeded=exceeded)
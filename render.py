@@ -0,0 +1,180 @@
+import os
+import json
+import math
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib as mpl
+import matplotlib.image  # noqa: F401
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.transform import from_bounds
+
+logger = logging.getLogger('citycat-dafni')
+
+# Colour map and class boundaries of each raster
+classes = {
+    'max_depth': ('Blues', [0.01, 0.05, 0.10, 0.15, 0.30, 0.50, 0.80, 1.00]),
+    'max_velocity': ('Reds', [0.10, 0.25, 0.50, 1.00, 1.50, 2.00, 3.00]),
+    'max_vd_product': ('Purples', [0.05, 0.10, 0.25, 0.50, 1.00, 1.50, 2.00]),
+}
+
+# Half the width of the web mercator projection in metres
+origin_shift = 20037508.342789244
+tile_size = 256
+
+
+def read_decimated(path, max_size):
+    """Reads a raster reduced to at most max_size cells along each side, using overviews if there are any
+
+    Returns:
+        tuple: Masked array and its transform
+    """
+    with rio.open(path) as src:
+        factor = max(1, math.ceil(max(src.width, src.height) / max_size))
+        shape = math.ceil(src.height / factor), math.ceil(src.width / factor)
+        array = src.read(1, out_shape=shape, masked=True, resampling=Resampling.nearest)
+        transform = src.transform * src.transform.scale(src.width / shape[1], src.height / shape[0])
+    return array, transform
+
+
+def plot_max_depth(geotiff_path, out_path, boundary, max_size=2048):
+    """Creates a depth map, with the boundary and max water levels
+
+    The raster is read at no more than max_size cells along each side, which is the most that can be seen at 300dpi.
+    """
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.axes_grid1.inset_locator import inset_axes
+    from rasterio.plot import show
+
+    dpi = 300
+
+    #Plotting the Raster and the ShapeFile together
+    fig, ax = plt.subplots(1, 1, dpi = dpi)
+    cmap = mpl.cm.Blues
+
+    plt.subplots_adjust(left = 0.10 , bottom = 0, right = 0.90 , top =1)
+
+    #Bounds for the raster
+    bounds_depth = classes['max_depth'][1] #you could change here the water depth of your results
+    norm = mpl.colors.BoundaryNorm(bounds_depth, cmap.N)
+
+    axins = inset_axes(ax,
+                       width="2%", # width of colorbar in % of plot width
+                       height="45%", # height of colorbar in % of plot height
+                       loc=2, #topright location
+                       bbox_to_anchor=(1.01, 0, 1, 1), #first number: space relative to plot (1.0 = no space between cb and plot)
+                       bbox_transform=ax.transAxes,
+                       borderpad=0)
+
+    if boundary is not None and len(boundary) != 0:
+        boundary.boundary.plot(edgecolor = 'black', lw = 0.5, ax = ax) #lw = 0.05 -> entire area #0.2 #0.80 for zoom
+
+    #The line below correspond to the raster
+    array, transform = read_decimated(geotiff_path, max_size)
+    show(array, transform=transform, ax = ax, title = 'max_water_depth', cmap = 'Blues', norm = norm)
+
+    #Plotting the colorbar for the raster file Water Depth:
+    plt.colorbar(mpl.cm.ScalarMappable(cmap = cmap, norm = norm),
+                 ax = ax,
+                 cax = axins,
+                 extend = 'both',
+                 format='%.2f',
+                 ticks = bounds_depth,
+                 spacing = 'uniform',
+                 orientation = 'vertical',
+                 label = 'Water Depth in m')
+
+    plt.savefig(out_path, dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
+
+
+def colourise(array, name):
+    """RGBA image of the classes of a masked array, cells without data or below the lowest class are transparent"""
+    cmap, bounds = classes[name]
+    cmap = getattr(mpl.cm, cmap)
+    image = cmap(mpl.colors.BoundaryNorm(bounds, cmap.N)(array.filled(0)), bytes=True)
+    image[..., 3] = np.where(array.mask | (array.filled(0) < bounds[0]), 0, 255)
+    return image
+
+
+def tile_bounds(x, y, z):
+    """Web mercator bounds of an XYZ tile"""
+    size = 2 * origin_shift / 2 ** z
+    left, top = -origin_shift + x * size, origin_shift - y * size
+    return left, top - size, left + size, top
+
+
+def zoom_range(path):
+    """Zoom levels from one tile covering the raster to tiles with about the resolution of the raster"""
+    with rio.open(path) as src:
+        left, bottom, right, top = transform_bounds(src.crs, 'EPSG:3857', *src.bounds)
+        # Web mercator distances are stretched by the scale factor at the latitude of the raster
+        res = src.res[0] * (right - left) / (src.bounds.right - src.bounds.left)
+    max_zoom = max(0, math.ceil(math.log2(2 * origin_shift / (tile_size * res))))
+    min_zoom = min(max_zoom, max(0, math.floor(math.log2(2 * origin_shift / max(right - left, top - bottom)))))
+    return min_zoom, max_zoom
+
+
+def render_column(path, name, out_path, z, x, y_start, y_stop):
+    """Renders the tiles in one column of the pyramid, skipping tiles without any data
+
+    Returns:
+        int: Number of tiles written
+    """
+    n_tiles = 0
+    with rio.open(path) as src:
+        for y in range(y_start, y_stop + 1):
+            bounds = tile_bounds(x, y, z)
+            with WarpedVRT(src, crs='EPSG:3857', transform=from_bounds(*bounds, tile_size, tile_size),
+                           width=tile_size, height=tile_size, resampling=Resampling.nearest) as vrt:
+                array = vrt.read(1, masked=True)
+            if array.mask.all():
+                continue
+            tile_path = os.path.join(out_path, str(z), str(x), f'{y}.png')
+            os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+            mpl.image.imsave(tile_path, colourise(array, name))
+            n_tiles += 1
+    return n_tiles
+
+
+def tile_pyramid(path, name, out_path, zooms=None, workers=None):
+    """Renders a raster as a pyramid of XYZ web map tiles using the classes of the raster
+
+    Each column of tiles is rendered in a process pool. A TileJSON file describing the pyramid is written to
+    out_path/tiles.json.
+
+    Args:
+        path: Raster to render
+        name: Name of the raster in :data:`classes`
+        out_path: Directory in which to create the tiles
+        zooms: Minimum and maximum zoom levels, defaults to :func:`zoom_range`
+        workers: Number of processes used to render the tiles, defaults to the number of CPUs
+
+    Returns:
+        int: Number of tiles written
+    """
+    min_zoom, max_zoom = zooms or zoom_range(path)
+    with rio.open(path) as src:
+        left, bottom, right, top = transform_bounds(src.crs, 'EPSG:3857', *src.bounds)
+        lon_lat_bounds = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+
+    tasks = []
+    for z in range(min_zoom, max_zoom + 1):
+        size = 2 * origin_shift / 2 ** z
+        x_start, x_stop = int((left + origin_shift) // size), int((right + origin_shift) // size)
+        y_start, y_stop = int((origin_shift - top) // size), int((origin_shift - bottom) // size)
+        tasks.extend((path, name, out_path, z, x, y_start, y_stop) for x in range(x_start, x_stop + 1))
+
+    with ProcessPoolExecutor(workers or os.cpu_count()) as executor:
+        n_tiles = sum(executor.map(render_column, *zip(*tasks)))
+
+    os.makedirs(out_path, exist_ok=True)
+    with open(os.path.join(out_path, 'tiles.json'), 'w') as f:
+        json.dump(dict(tilejson='2.2.0', name=name, tiles=['{z}/{x}/{y}.png'], minzoom=min_zoom, maxzoom=max_zoom,
+                       bounds=list(lon_lat_bounds), legend=dict(zip(['colormap', 'classes'], classes[name]))), f)
+
+    logger.info(f'---- Rendered {n_tiles} {name} tiles for zoom levels {min_zoom} to {max_zoom}')
+    return n_tiles
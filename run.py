@@ -1,35 +1,23 @@
 import os
 import shutil  # must be imported before GDAL
-from rasterio.merge import merge
-import rasterio as rio
-from rasterio.io import MemoryFile
-from citycatio import Model, output
-import pandas as pd
 import subprocess
-import xarray as xr
 from glob import glob
-import geopandas as gpd
-import rioxarray as rx
-from rasterio.plot import show
-from rasterio.mask import mask
-import matplotlib.pyplot as plt
-from matplotlib_scalebar.scalebar import ScaleBar
-from rasterio.fill import fillnodata
 from datetime import datetime
-import numpy as np
-from shapely.geometry import box
 import json
-from matplotlib.colors import ListedColormap
-from zipfile import ZipFile
-import matplotlib as mpl
-from mpl_toolkits.axes_grid1.inset_locator import inset_axes
-from matplotlib.colors import ListedColormap
-
+import argparse
 import random
 import string
 import logging
 from pathlib import Path
 from os.path import isfile, join, isdir
+from cache import Cache, get_key
+from checkpoints import Checkpoints, fingerprint, stage_names, list_files
+from telemetry import telemetry, stage
+from cog import to_cog
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Heavy libraries are imported by the functions which use them, so stages which do not need them start quickly
 
 # Set up paths
 data_path = os.getenv('DATA_PATH', '/data')
@@ -37,57 +25,126 @@ inputs_path = os.path.join(data_path, 'inputs')
 outputs_path = os.path.join(data_path, 'outputs')
 if not os.path.exists(outputs_path):
     os.mkdir(outputs_path)
-    
+
 parameters_path = os.path.join(inputs_path, 'parameters')
 print('parameters_path:',parameters_path)
 udm_para_in_path = os.path.join(inputs_path, 'udm_parameters')
+scenarios_path = os.path.join(inputs_path, 'scenarios')
+dem_path = os.path.join(inputs_path, 'dem')
 
-# Set up log file
 logger = logging.getLogger('citycat-dafni')
-logger.setLevel(logging.INFO)
-log_file_name = 'citycat-dafni-%s.log' %(''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(6)))
-fh = logging.FileHandler( Path(join(data_path, outputs_path)) / log_file_name)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-fh.setFormatter(formatter)
-logger.addHandler(fh)
-
-logger.info('Log file established!')
-logger.info('--------')
-
-logger.info('Paths have been setup')    
-    
-# If the UDM model preceeds the CityCat model in the workflow, a zip file should appear in the inputs folder
-# Check if the zip file exists
-archive = glob(inputs_path + "/**/*.zip", recursive = True)
-logger.info(archive)
-
-# Look to see if a parameter file has been added
-parameter_file = glob(parameters_path + "/*.csv", recursive = True)
-print('parameter_file:', parameter_file)
-
-# If a parameter.csv is available: read the variables from the document
-if len(parameter_file) == 1 :
-    file_path = os.path.splitext(parameter_file[0])
+
+discharge_parameter = float(0)
+nodata = -9999
+
+
+def default_workers():
+    return int(os.getenv('WORKERS', os.cpu_count()))
+
+
+def configure():
+    """Reads the options set by environment variables
+
+    Called again by :func:`main`, so each job run by a worker uses its own options rather than those of the worker.
+    """
+    global workers, simplify_tolerance, watch_surface_maps, analysis_ready, render_tiles, tile_zooms, fast_inputs
+    global archive_codec, archive_incremental, remove_surface_maps, exposure_statistics, exposure_format
+    global preflight_enabled, preflight_history, preflight_action, preflight_limits, dem_memory_limit
+    workers = default_workers()
+    # Tolerance in metres used to simplify building and green area polygons
+    simplify_tolerance = float(os.getenv('SIMPLIFY_TOLERANCE', 0)) or None
+    # Convert the surface maps while CityCAT is running
+    watch_surface_maps = os.getenv('WATCH_SURFACE_MAPS', 'False').lower() == 'true'
+    # Write chunked netCDF files and Cloud-Optimized GeoTIFFs
+    analysis_ready = os.getenv('ANALYSIS_READY_OUTPUTS', 'False').lower() == 'true'
+    # Render XYZ web map tiles of the depth, velocity and V×D rasters, optionally limited to a range of zoom levels
+    render_tiles = os.getenv('RENDER_TILES', 'False').lower() == 'true'
+    tile_zooms = tuple(int(z) for z in os.getenv('TILE_ZOOMS').split('-')) if os.getenv('TILE_ZOOMS') else None
+    # Write the polygon input files in bulk rather than with citycatio.Model.write
+    fast_inputs = os.getenv('FAST_INPUTS', 'True').lower() == 'true'
+    # Codec used to archive the surface maps: deflate (zip), store (zip without compression) or zstd (tar.zst)
+    archive_codec = os.getenv('ARCHIVE_CODEC', 'deflate')
+    # Archive the surface maps while CityCAT is running and, if they are also being watched, remove them once
+    # archived
+    archive_incremental = os.getenv('ARCHIVE_INCREMENTAL', 'False').lower() == 'true'
+    remove_surface_maps = os.getenv('ARCHIVE_REMOVE_ORIGINALS', 'False').lower() == 'true'
+    # Calculate the depth, velocity and V×D product at each building and flood impact polygon, written as gpkg or
+    # parquet
+    exposure_statistics = os.getenv('EXPOSURE_STATISTICS', 'False').lower() == 'true'
+    exposure_format = os.getenv('EXPOSURE_FORMAT', 'gpkg').lower()
+    # Predict the resources of a run from the telemetry of past runs and check them against limits before running
+    # CityCAT
+    preflight_enabled = os.getenv('PREFLIGHT', 'True').lower() == 'true'
+    preflight_history = os.getenv('PREFLIGHT_HISTORY', os.path.join(inputs_path, 'telemetry'))
+    # What to do if a limit is exceeded: warn, reject or decompose
+    preflight_action = os.getenv('PREFLIGHT_ACTION', 'warn').lower()
+    preflight_limits = dict(
+        wall_seconds=float(os.getenv('PREFLIGHT_MAX_HOURS', 0)) * 3600 or None,
+        peak_rss_mb=float(os.getenv('PREFLIGHT_MAX_MEMORY_MB', 0)) or None,
+        disk_mb=float(os.getenv('PREFLIGHT_MAX_DISK_MB', 0)) or None)
+    # Approximate memory in MB used when mosaicking the DEM and writing it to the input files, keeping the DEM on disk
+    dem_memory_limit = float(os.getenv('DEM_MEMORY_LIMIT', 0)) * 1e6 or None
+
+
+configure()
+
+
+# Parameters which can be set using environment variables or the columns of a scenarios table
+parameter_types = {
+    'NAME': ('name', str),
+    'RAINFALL_MODE': ('rainfall_mode', str),
+    'TOTAL_DEPTH': ('rainfall_total', int),
+    'DURATION': ('duration', int),
+    'OPEN_BOUNDARIES': ('open_boundaries', lambda value: str(value).lower() == 'true'),
+    'PERMEABLE_AREAS': ('permeable_areas', str),
+    'ROOF_STORAGE': ('roof_storage', float),
+    'POST_EVENT_DURATION': ('post_event_duration', int),
+    'OUTPUT_INTERVAL': ('output_interval', int),
+    'TIME_HORIZON': ('time_horizon', str),
+    'RETURN_PERIOD': ('return_period', int),
+}
+
+
+def check_options():
+    """Checks the options set by environment variables before anything is read or run"""
+    from importlib.util import find_spec
+
+    assert archive_codec in ['deflate', 'store', 'zstd'], \
+        f'Unknown ARCHIVE_CODEC {archive_codec}, must be deflate, store or zstd'
+    assert archive_codec != 'zstd' or find_spec('zstandard') is not None, \
+        'ARCHIVE_CODEC=zstd needs the zstandard package'
+    assert exposure_format in ['gpkg', 'parquet'], \
+        f'Unknown EXPOSURE_FORMAT {exposure_format}, must be gpkg or parquet'
+    assert not exposure_statistics or exposure_format != 'parquet' or find_spec('pyarrow') is not None, \
+        'EXPOSURE_FORMAT=parquet needs the pyarrow package'
+
+
+def setup_logging():
+    logger.setLevel(logging.INFO)
+    log_file_name = 'citycat-dafni-%s.log' %(''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(6)))
+    fh = logging.FileHandler( Path(join(data_path, outputs_path)) / log_file_name)
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    fh.setFormatter(formatter)
+    logger.addHandler(fh)
+
+    logger.info('Log file established!')
+    logger.info('--------')
+
+    logger.info('Paths have been setup')
+
+
+def read_parameter_file(path):
+    file_path = os.path.splitext(path)
     print('Filepath:',file_path)
     filename=file_path[0].split("/")
     print('Filename:',filename[-1])
 
+    import pandas as pd
     parameters = pd.read_csv(os.path.join(parameters_path + '/' + filename[-1] + '.csv'))
 
     name = filename[-1]
     name = name.replace('-parameters','')
-    rainfall_mode = parameters.loc[3][1]
-    rainfall_total = int(parameters.loc[4][1])
-    duration = int(parameters.loc[5][1])
     open_boundaries = parameters.loc[6][1]
-    if open_boundaries.lower()=='true':
-        open_boundaries=True
-    else :
-        open_boundaries=False
-    permeable_areas = parameters.loc[7][1]
-    roof_storage = float(parameters.loc[8][1])
-    post_event_duration = int(parameters.loc[9][1])
-    output_interval = int(parameters.loc[10][1])
     size = parameters.loc[11][1]
     if size != "None":
         size = float(size)
@@ -102,414 +159,861 @@ if len(parameter_file) == 1 :
     #time_horizon = parameters.loc[X][1]
     #return_period = int(parameters.loc[X][1])
 
-# If no parameter file is available, the user needs to define the parameters
-if len(parameter_file) == 0 :
-    name = os.getenv('NAME')
-    rainfall_mode = os.getenv('RAINFALL_MODE')
-    rainfall_total = int(os.getenv('TOTAL_DEPTH'))
-    duration = int(os.getenv('DURATION'))
-    open_boundaries = (os.getenv('OPEN_BOUNDARIES').lower() == 'true')
-    permeable_areas = os.getenv('PERMEABLE_AREAS')
-    roof_storage = float(os.getenv('ROOF_STORAGE'))
-    post_event_duration = int(os.getenv('POST_EVENT_DURATION'))
-    output_interval = int(os.getenv('OUTPUT_INTERVAL'))
-    size = os.getenv('SIZE') 
+    return dict(
+        name=name,
+        rainfall_mode=parameters.loc[3][1],
+        rainfall_total=int(parameters.loc[4][1]),
+        duration=int(parameters.loc[5][1]),
+        open_boundaries=open_boundaries.lower() == 'true',
+        permeable_areas=parameters.loc[7][1],
+        roof_storage=float(parameters.loc[8][1]),
+        post_event_duration=int(parameters.loc[9][1]),
+        output_interval=int(parameters.loc[10][1]),
+        size=size,
+        x=x,
+        y=y,
+        time_horizon=None,
+        return_period=None)
+
+
+def read_parameters():
+    # Look to see if a parameter file has been added
+    parameter_file = glob(parameters_path + "/*.csv", recursive = True)
+    print('parameter_file:', parameter_file)
+
+    # If a parameter.csv is available: read the variables from the document
+    if len(parameter_file) == 1:
+        return read_parameter_file(parameter_file[0])
+
+    # If no parameter file is available, the user needs to define the parameters
+    parameters = {key: None if os.getenv(name) is None else parse(os.getenv(name))
+                  for name, (key, parse) in parameter_types.items()}
+
+    size = os.getenv('SIZE')
     x = os.getenv('X')
     y = os.getenv('Y')
-    if size != None:
-        size = float(size)*1000
-    if x != None:
-        x = int(x)
-    if y != None:
-        y = int(y)
-    
-    #time_horizon = os.getenv('TIME_HORIZON')
-    #return_period = int(os.getenv('RETURN_PERIOD'))
+    parameters['size'] = float(size)*1000 if size is not None else None
+    parameters['x'] = int(x) if x is not None else None
+    parameters['y'] = int(y) if y is not None else None
+
     #discharge_parameter = float(os.getenv('DISCHARGE'))
 
-discharge_parameter = float(0)
-nodata = -9999
+    return parameters
 
 
-def read_geometries(path, bbox=None):
+def read_scenarios(parameters):
+    """Combines the parameters with each row of the scenarios table
+
+    Columns of the table are named using the parameter names, e.g. TOTAL_DEPTH or ROOF_STORAGE.
+    Empty cells and missing columns take the value of the run parameters.
+    All scenarios share the domain defined by the run parameters.
+    """
+    scenarios_file = glob(os.path.join(scenarios_path, '*.csv'))
+    if len(scenarios_file) == 0:
+        return None
+
+    import pandas as pd
+    table = pd.read_csv(scenarios_file[0], dtype=str)
+    unknown = set(table.columns) - set(parameter_types)
+    assert len(unknown) == 0, f'Unknown scenario parameters: {unknown}'
+
+    scenarios = []
+    for i, row in table.iterrows():
+        scenario = dict(parameters)
+        for name, value in row.dropna().items():
+            key, parse = parameter_types[name]
+            scenario[key] = parse(value)
+        if 'NAME' not in row or pd.isnull(row['NAME']):
+            scenario['name'] = f'{parameters["name"] or "scenario"} {i}'
+        scenarios.append(scenario)
+
+    logger.info(f'Read {len(scenarios)} scenarios from {os.path.basename(scenarios_file[0])}')
+    return scenarios
+
+
+def read_geometries(path, bbox=None, columns=None, simplify=None):
+    import geometries
     logger.info('---- In read geometries function')
-    paths = glob(os.path.join(inputs_path, path, '*.gpkg'))
-    paths.extend(glob(os.path.join(inputs_path, path, '*.shp')))
+    paths = geometries.list_files(os.path.join(inputs_path, path))
     print(f'Files in {path} directory: {[os.path.basename(p) for p in paths]}')
     logger.info(f'---- Files in {path} directory to read in: {[os.path.basename(p) for p in paths]}')
-    
-    # set a default value
-    geometries = None
-    
-    if len(paths) > 0:
-        logger.info('-------- Reading in %s' %path)
-        geometries = gpd.read_file(paths[0], bbox=bbox)
-        logger.info('-------- Number of features read now: %s' %geometries.shape[0])
-              
-    if len(paths) > 1:
-        for path in paths[1:]:
-            logger.info('-------- Reading in %s' %path)
-            geometries = geometries.append(gpd.read_file(path, bbox=bounds))
-            logger.info('-------- Number of features read now: %s' %geometries.shape[0])
-            
+
+    features = geometries.read_files(paths, bbox=bbox, columns=columns, simplify=simplify, workers=workers)
+
     logger.info('---- Completed read geometries funtion')
-    return geometries
-
-logger.info('--------')
-logger.info('Starting to run code')
-
-logger.info('Setting boundary')
-boundary = read_geometries('boundary')
-
-if boundary is None:
-    bounds = x-size/2, y-size/2, x+size/2, y+size/2
-else:
-    bounds = boundary.geometry.total_bounds.tolist()
-
-logger.info('Checking if rainfall period being used')
-if rainfall_mode == 'return_period':
-    uplifts = pd.read_csv(
-        os.path.join(inputs_path,
-                     'future-drainage',
-                     f'Uplift_{time_horizon if time_horizon != "baseline" else "2050"}_{duration}hr_Pr_{return_period}'
-                     f'yrRL_Grid.csv'),
-        header=1)
-
-    uplifts = gpd.GeoDataFrame(uplifts,
-                               geometry=gpd.points_from_xy(uplifts.easting, uplifts.northing).buffer(2500, cap_style=3))
-    if boundary is not None:
-        row = uplifts[uplifts.intersects(boundary.geometry.unary_union)].mean()
-    else:
-        row = uplifts[uplifts.intersects(box(*bounds))].mean()
+    return features
+
+
+def get_bounds(boundary, parameters):
+    if boundary is None:
+        x, y, size = parameters['x'], parameters['y'], parameters['size']
+        return x-size/2, y-size/2, x+size/2, y+size/2
+    return boundary.geometry.total_bounds.tolist()
+
 
-    rainfall_total = row[f'ReturnLevel.{return_period}']
+def open_future_drainage():
+    """Opens the FUTURE-DRAINAGE CSV files, which are converted once into a binary store indexed by 5km cell"""
+    import future_drainage
+    return future_drainage.open_store(os.path.join(inputs_path, 'future-drainage'), os.getenv('FUTURE_DRAINAGE_STORE'))
 
-    if time_horizon != 'baseline':
 
-        rainfall_total *= float(((100 + row['Uplift_50']) / 100))
+def get_rainfall_total(parameters, boundary, bounds):
+    """Rainfall depth, extracted from FUTURE-DRAINAGE if RAINFALL_MODE is return_period
 
-logging.info(f'Rainfall Total: {rainfall_total}')
-print(f'Rainfall Total: {rainfall_total}')
+    Returns:
+        tuple: Rainfall total and the FUTURE-DRAINAGE values averaged over the domain, None unless in return_period mode
+    """
+    import future_drainage
+    from shapely.geometry import box
+    rainfall_total = parameters['rainfall_total']
+    row = None
 
-unit_profile = np.array([0.017627993, 0.027784045, 0.041248418, 0.064500665, 0.100127555, 0.145482534, 0.20645758,
-                         0.145482534, 0.100127555, 0.064500665, 0.041248418, 0.027784045, 0.017627993])
+    logger.info('Checking if rainfall period being used')
+    if parameters['rainfall_mode'] == 'return_period':
+        time_horizon = parameters['time_horizon']
+        return_period = parameters['return_period']
+        store = open_future_drainage()
+        row = store.lookup(future_drainage.grid_name(time_horizon, parameters['duration'], return_period),
+                           boundary.geometry.unary_union if boundary is not None else box(*bounds))
 
-# Fit storm profile
-logger.info('Fitting rainfall to sotrm profile')
-rainfall_times = np.linspace(start=0, stop=duration*3600, num=len(unit_profile))
+        rainfall_total = row[f'ReturnLevel.{return_period}']
 
-unit_total = sum((unit_profile + np.append(unit_profile[1:], [0])) / 2 *
-                 (np.append(rainfall_times[1:], rainfall_times[[-1]]+1)-rainfall_times))
+        if time_horizon != 'baseline':
 
-rainfall = pd.DataFrame(list(unit_profile*rainfall_total/unit_total/1000) + [0, 0],
+            rainfall_total *= float(((100 + row['Uplift_50']) / 100))
+
+    logger.info(f'Rainfall Total: {rainfall_total}')
+    print(f'Rainfall Total: {rainfall_total}')
+
+    return rainfall_total, row
+
+
+unit_profile = [0.017627993, 0.027784045, 0.041248418, 0.064500665, 0.100127555, 0.145482534, 0.20645758,
+                0.145482534, 0.100127555, 0.064500665, 0.041248418, 0.027784045, 0.017627993]
+
+
+def storm_profile(rainfall_total, duration):
+    import numpy as np
+    import pandas as pd
+    # Fit storm profile
+    logger.info('Fitting rainfall to sotrm profile')
+    profile = np.array(unit_profile)
+    rainfall_times = np.linspace(start=0, stop=duration*3600, num=len(profile))
+
+    unit_total = sum((profile + np.append(profile[1:], [0])) / 2 *
+                     (np.append(rainfall_times[1:], rainfall_times[[-1]]+1)-rainfall_times))
+
+    return pd.DataFrame(list(profile*rainfall_total/unit_total/1000) + [0, 0],
                         index=list(rainfall_times) + [duration*3600+1, duration*3600+2])
 
-# Create run directory
-logging.info('Creating run directory')
-run_path = os.path.join(outputs_path, 'run')
-if not os.path.exists(run_path):
+
+def prepare_domain(bounds, dem_file=None, res=None):
+    """Reads the DEM, buildings and green areas which are shared by all scenarios
+
+    Args:
+        bounds: Extent of the domain
+        dem_file: GeoTIFF into which the DEM is mosaicked if DEM_MEMORY_LIMIT is set
+        res: Cell size to which the domain is coarsened, defaults to the resolution of the DEM
+
+    Returns:
+        dict: DEM memory file or dem_file, bounds snapped to the DEM grid, buildings, green areas and flow polygons
+    """
+    import rasterio as rio
+    from rasterio.io import MemoryFile
+    import geopandas as gpd
+    from dem import read_dem, mosaic_to_file
+
+    # Read and clip DEM
+    logger.info('Reading and clipping DEM')
+
+    # Only the tiles intersecting the domain are opened, using a persistent index of tile footprints
+    disk_backed = dem_memory_limit is not None and dem_file is not None
+    with stage('dem') as record:
+        if disk_backed:
+            # The DEM is kept on disk and never held in memory as a whole
+            dem_bounds, n_cells = mosaic_to_file(dem_path, bounds, nodata, dem_file, index_path=os.getenv('DEM_INDEX'),
+                                                 memory_limit=dem_memory_limit)
+        else:
+            array, transform = read_dem(dem_path, bounds, nodata, index_path=os.getenv('DEM_INDEX'))
+            n_cells = int((array != nodata).sum())
+        record.update(cells=n_cells, disk_backed=disk_backed)
+    assert n_cells > 0, "No DEM data available for selected location"
+
+    # Read buildings
+    logger.info('Reading buildings')
+    # Only the geometries are written to the CityCAT input files, so the attributes are dropped
+    with stage('buildings') as record:
+        buildings = read_geometries('buildings', bbox=bounds, columns=[], simplify=simplify_tolerance)
+        record['features'] = len(buildings) if buildings is not None else 0
+
+    # Read green areas
+    logger.info('Reading green areas')
+    with stage('green_areas') as record:
+        green_areas = read_geometries('green_areas', bbox=bounds, columns=[], simplify=simplify_tolerance)
+        record['features'] = len(green_areas) if green_areas is not None else 0
+
+    if discharge_parameter > 0:
+        flow_polygons = gpd.read_file(glob(os.path.join(inputs_path, 'flow_polygons', '*'))[0]).geometry
+    else:
+        flow_polygons = None
+
+    if disk_backed:
+        domain = dict(dem=dem_file, bounds=dem_bounds, buildings=buildings, green_areas=green_areas,
+                      flow_polygons=flow_polygons)
+        return coarsen(domain, res) if res is not None else domain
+
+    logger.info('Creating DEM dataset and boundary dataset')
+    dem = MemoryFile()
+    with dem.open(driver='GTiff', transform=transform, width=array.shape[2], height=array.shape[1], count=1,
+                  dtype=rio.float32, nodata=nodata) as dataset:
+        bounds = dataset.bounds
+        dataset.write(array)
+
+    # if boundary is not None:
+    #     array, transform = mask(dem.open(), boundary.geometry, crop=True)
+    #     dem = MemoryFile()
+    #     with dem.open(driver='GTiff', transform=transform, width=array.shape[2], height=array.shape[1], count=1,
+    #                   dtype=rio.float32, nodata=nodata) as dataset:
+    #         bounds = dataset.bounds
+    #         dataset.write(array)
+
+    domain = dict(dem=dem, bounds=bounds, buildings=buildings, green_areas=green_areas, flow_polygons=flow_polygons)
+    return coarsen(domain, res) if res is not None else domain
+
+
+def coarsen(domain, res):
+    from screening import coarsen_domain
+
+    with stage('coarsen') as record:
+        domain = coarsen_domain(domain, res)
+        record['buildings'] = len(domain['buildings']) if domain['buildings'] is not None else 0
+    return domain
+
+
+def domain_sources(bounds):
+    """Input files used to prepare the domain"""
+    from dem import update_index, intersecting_tiles
+    index = update_index(dem_path, os.getenv('DEM_INDEX'))
+    paths = [os.path.join(dem_path, name) for name in intersecting_tiles(index, bounds)]
+    for directory in ['buildings', 'green_areas'] + (['flow_polygons'] if discharge_parameter > 0 else []):
+        paths.extend(path for path in glob(os.path.join(inputs_path, directory, '*')) if os.path.isfile(path))
+    return paths
+
+
+def prepare_template(template_path, bounds, parameters, res=None):
+    """Writes the clipped DEM and the input files which do not depend on the scenario parameters
+
+    Returns:
+        dict: Bounds snapped to the DEM grid and the number of buildings and green areas
+    """
+    import rasterio as rio
+    domain = prepare_domain(bounds, dem_file=os.path.join(template_path, 'dem.tif'), res=res)
+
+    with stage('write_inputs'):
+        write_inputs(os.path.join(template_path, 'inputs'), domain, parameters,
+                     storm_profile(0, parameters['duration']))
+    for file_name in scenario_files:
+        if os.path.exists(os.path.join(template_path, 'inputs', file_name)):
+            os.remove(os.path.join(template_path, 'inputs', file_name))
+
+    if not isinstance(domain['dem'], str):
+        with domain['dem'].open() as src:
+            with rio.open(os.path.join(template_path, 'dem.tif'), 'w', **{**src.profile, 'driver': 'GTiff'}) as dst:
+                dst.write(src.read())
+
+    domain_info = dict(
+        bounds=list(domain['bounds']),
+        n_buildings=len(domain['buildings']) if domain['buildings'] is not None else 0,
+        n_green_areas=len(domain['green_areas']) if domain['green_areas'] is not None else 0)
+    with open(os.path.join(template_path, 'domain.json'), 'w') as f:
+        json.dump(domain_info, f)
+
+    return domain_info
+
+
+def get_template(tmp, bounds, parameters, res=None):
+    """Prepares the domain or reuses it from the cache if CACHE_PATH is set
+
+    Cache entries are keyed by the contents of the DEM tiles, buildings, green areas and flow polygons and the bounds.
+
+    Args:
+        tmp: Directory in which to prepare the domain
+        bounds: Extent of the domain
+        parameters: Run parameters
+        res: Cell size to which the domain is coarsened, defaults to the resolution of the DEM
+
+    Returns:
+        tuple: Path of the template and the domain information created by :func:`prepare_template`
+    """
+    template_path = os.path.join(tmp, 'template')
+    cache_path = os.getenv('CACHE_PATH')
+
+    if cache_path is None:
+        os.mkdir(template_path)
+        return template_path, prepare_template(template_path, bounds, parameters, res=res)
+
+    logger.info('Checking input cache')
+    cache = Cache(cache_path, max_size=float(os.getenv('CACHE_SIZE', 10)) * 1e9)
+    with stage('cache_key'):
+        key = get_key(domain_sources(bounds), bounds=list(bounds), nodata=nodata, discharge=discharge_parameter > 0,
+                      simplify=simplify_tolerance, res=res)
+    entry_path = cache.get(key)
+    if entry_path is None:
+        os.mkdir(template_path)
+        prepare_template(template_path, bounds, parameters, res=res)
+        entry_path = cache.put(key, template_path)
+
+    with open(os.path.join(entry_path, 'domain.json')) as f:
+        return entry_path, json.load(f)
+
+
+def get_discharge(parameters):
+    total_duration = 3600*parameters['duration']+3600*parameters['post_event_duration']
+
+    # Create discharge timeseries
+    logger.info('Creating discharge timeseries')
+    if discharge_parameter > 0:
+        import pandas as pd
+        discharge = pd.Series([discharge_parameter, discharge_parameter], index=[0, total_duration])
+
+        # Divide by the length of each cell
+        return discharge.divide(5)
+    return None
+
+
+def model_options(parameters):
+    """Configuration options passed to the CityCAT model"""
+    return dict(
+        duration=3600*parameters['duration']+3600*parameters['post_event_duration'],
+        output_interval=parameters['output_interval'],
+        open_external_boundaries=parameters['open_boundaries'],
+        use_infiltration=True,
+        permeable_areas={'polygons': 0, 'impermeable': 1, 'permeable': 2}[parameters['permeable_areas']],
+        roof_storage=parameters['roof_storage'])
+
+
+def write_inputs(run_path, domain, parameters, rainfall):
+    from citycatio import Model
+    from rasterio.io import MemoryFile
+    # Create input files
+    logger.info('Creating input files')
+    # A DEM kept on disk is written from its GeoTIFF a block at a time, so the model holds an empty placeholder
+    on_disk = isinstance(domain['dem'], str)
+    model = Model(
+        dem=MemoryFile() if on_disk else domain['dem'],
+        rainfall=rainfall,
+        buildings=domain['buildings'],
+        green_areas=domain['green_areas'],
+        flow=get_discharge(parameters),
+        flow_polygons=domain['flow_polygons'],
+        **model_options(parameters)
+    )
+    if fast_inputs or on_disk:
+        from input_files import write_model
+        try:
+            write_model(model, run_path, dem_file=domain['dem'] if on_disk else None, memory_limit=dem_memory_limit)
+            return
+        except Exception:
+            if on_disk:
+                raise
+            logger.exception('Could not write the input files in bulk, writing them with citycatio')
+    model.write(run_path)
+
+
+# Input files which depend on the scenario parameters rather than the domain
+scenario_files = ['Rainfall_Data_1.txt', 'CityCat_Config_1.txt', 'Flow_BC.flw']
+
+
+def write_scenario_inputs(run_path, template_path, parameters, rainfall):
+    """Creates input files from a template containing the DEM, buildings and green areas
+
+    Only the rainfall, configuration and flow files are written, the remaining files are linked from the template.
+    """
+    from citycatio import inputs
+    logger.info('Creating scenario input files')
+    if os.path.exists(run_path):
+        shutil.rmtree(run_path)
     os.mkdir(run_path)
 
-# Read and clip DEM
-logger.info('Reading and clipping DEM')
-dem_path = os.path.join(inputs_path, 'dem')
-dem_datasets = [rio.open(os.path.join(dem_path, os.path.abspath(p))) for p in glob(os.path.join(dem_path, '*.asc'))]
-
-array, transform = merge(dem_datasets, bounds=bounds, precision=50, nodata=nodata)
-assert array[array != nodata].size > 0, "No DEM data available for selected location"
-
-# Read buildings
-logger.info('Reading buildings')
-buildings = read_geometries('buildings', bbox=bounds)
-
-# Read green areas
-logger.info('Reading green areas')
-green_areas = read_geometries('green_areas', bbox=bounds)
-
-total_duration = 3600*duration+3600*post_event_duration
-
-# Create discharge timeseries
-logger.info('Creating discharge timeseries')
-if discharge_parameter > 0:
-    discharge = pd.Series([discharge_parameter, discharge_parameter], index=[0, total_duration])
-
-    # Divide by the length of each cell
-    discharge = discharge.divide(5)
-
-    flow_polygons = gpd.read_file(glob(os.path.join(inputs_path, 'flow_polygons', '*'))[0]).geometry
-else:
-    discharge = None
-    flow_polygons = None
-
-logger.info('Creating DEM dataset and boundary dataset')
-dem = MemoryFile()
-with dem.open(driver='GTiff', transform=transform, width=array.shape[2], height=array.shape[1], count=1,
-              dtype=rio.float32, nodata=nodata) as dataset:
-    bounds = dataset.bounds
-    dataset.write(array)
-
-# if boundary is not None:
-#     array, transform = mask(dem.open(), boundary.geometry, crop=True)
-#     dem = MemoryFile()
-#     with dem.open(driver='GTiff', transform=transform, width=array.shape[2], height=array.shape[1], count=1,
-#                   dtype=rio.float32, nodata=nodata) as dataset:
-#         bounds = dataset.bounds
-#         dataset.write(array)
-
-# Create input files
-logger.info('Creating input files')
-Model(
-    dem=dem,
-    rainfall=rainfall,
-    duration=total_duration,
-    output_interval=output_interval,
-    open_external_boundaries=open_boundaries,
-    buildings=buildings,
-    green_areas=green_areas,
-    use_infiltration=True,
-    permeable_areas={'polygons': 0, 'impermeable': 1, 'permeable': 2}[permeable_areas],
-    roof_storage=roof_storage,
-    flow=discharge,
-    flow_polygons=flow_polygons
-
-).write(run_path)
-
-# Copy executable
-logger.info('Preparing CityCat')
-shutil.copy('citycat.exe', run_path)
-
-start_timestamp = pd.Timestamp.now()
-
-# Run executable
-logger.info('Running CityCat......')
-if os.name == 'nt':
-    subprocess.call('cd {run_path} & citycat.exe -r 1 -c 1'.format(run_path=run_path), shell=True)
-else:
-    subprocess.call('cd {run_path} && wine64 citycat.exe -r 1 -c 1'.format(run_path=run_path), shell=True)
-
-end_timestamp = pd.Timestamp.now()
-
-logger.info('....CityCat completed!')
-
-# Delete executable
-logger.info('Deleting CityCAT model')
-os.remove(os.path.join(run_path, 'citycat.exe'))
-
-# Archive results files
-logger.info('Archiving results')
-surface_maps = os.path.join(run_path, 'R1C1_SurfaceMaps')
-shutil.make_archive(surface_maps, 'zip', surface_maps)
-
-# Create geotiff
-logger.info('Creating outputs')
-geotiff_path = os.path.join(run_path, 'max_depth.tif')
-netcdf_path = os.path.join(run_path, 'R1C1_SurfaceMaps.nc')
-
-output.to_geotiff(os.path.join(surface_maps, 'R1_C1_max_depth.csv'), geotiff_path, srid=27700)
-
-output.to_netcdf(surface_maps, out_path=netcdf_path, srid=27700,
-                 attributes=dict(
-                    rainfall_mode=rainfall_mode,
-                    rainfall_total=float(rainfall_total),
-                    size=size,
-                    duration=duration,
-                    post_event_duration=post_event_duration,
-                    #return_period=return_period,
-                    x=x,
-                    y=y,
-                    open_boundaries=str(open_boundaries),
-                    permeable_areas=permeable_areas))
-
-a = xr.open_dataset(netcdf_path)
-
-velocity = xr.ufuncs.sqrt(a.x_vel**2+a.y_vel**2).astype(np.float64)
-max_velocity = velocity.max(dim='time').round(3)
-max_velocity = max_velocity.where(xr.ufuncs.isfinite(max_velocity), other=output.fill_value)
-max_velocity.rio.set_crs('EPSG:27700')
-max_velocity.rio.set_nodata(output.fill_value)
-max_velocity.rio.to_raster(os.path.join(run_path, 'max_velocity.tif'))
-
-vd_product = velocity * a.depth
-max_vd_product = vd_product.max(dim='time').round(3)
-max_vd_product = max_vd_product.where(xr.ufuncs.isfinite(max_vd_product), other=output.fill_value)
-max_vd_product.rio.set_crs('EPSG:27700')
-max_vd_product.rio.set_nodata(output.fill_value)
-max_vd_product.rio.to_raster(os.path.join(run_path, 'max_vd_product.tif'))
-
-# # Create depth map
-# with rio.open(geotiff_path) as ds:
-#     f, ax = plt.subplots()
-
-#     cmap = ListedColormap(['#f7fbff', '#deebf7', '#c6dbef', '#9ecae1', '#6baed6', '#4292c6', '#2171b5', '#08519c',
-#                            '#08306b', 'black'])
-#     cmap.set_bad(color='lightgrey')
-#     cmap.colorbar_extend = 'max'
-
-#     im = show(ds, ax=ax, cmap=cmap, vmin=0, vmax=1).get_images()[0]
-
-#     ax.set_xticks([])
-#     ax.set_yticks([])
-
-#     ax.add_artist(ScaleBar(1, frameon=False))
-#     f.colorbar(im, label='Water Depth (m)')
-#     f.savefig(os.path.join(run_path, 'max_depth.png'), dpi=200, bbox_inches='tight')
-
-# Create a depth map, with the boundary and max water levels
-
-dpi = 300
-
-#Plotting the Raster and the ShapeFile together
-fig, ax = plt.subplots(1, 1, dpi = dpi)
-cmap = mpl.cm.Blues
-
-plt.subplots_adjust(left = 0.10 , bottom = 0, right = 0.90 , top =1)
-
-#Bounds for the raster
-bounds_depth =  [0.01, 0.05, 0.10, 0.15, 0.30, 0.50, 0.80, 1.00] #you could change here the water depth of your results
-norm = mpl.colors.BoundaryNorm(bounds_depth, cmap.N)
-
-axins = inset_axes(ax,
-                   width="2%", # width of colorbar in % of plot width
-                   height="45%", # height of colorbar in % of plot height
-                   loc=2, #topright location
-                   bbox_to_anchor=(1.01, 0, 1, 1), #first number: space relative to plot (1.0 = no space between cb and plot)
-                   bbox_transform=ax.transAxes,
-                   borderpad=0) 
-
-if len(boundary) != 0:
-    boundary.boundary.plot(edgecolor = 'black', lw = 0.5, ax = ax) #lw = 0.05 -> entire area #0.2 #0.80 for zoom
-
-citycat_outputs = rio.open(geotiff_path, mode ='r')
-#The line below correspond to the raster
-show(citycat_outputs, ax = ax, title = 'max_water_depth', cmap = 'Blues', norm = norm)
-
-#Plotting the colorbar for the raster file Water Depth:
-plt.colorbar(mpl.cm.ScalarMappable(cmap = cmap, norm = norm),
-             ax = ax,
-             cax = axins,
-             extend = 'both',
-             format='%.2f',
-             ticks = bounds_depth,
-             spacing = 'uniform',
-             orientation = 'vertical',
-             label = 'Water Depth in m')
-
-plt.savefig(os.path.join(run_path, 'max_depth.png'), dpi=dpi, bbox_inches='tight')
-
-    
-# Create interpolated GeoTIFF
-with rio.open(geotiff_path) as ds:
-    with rio.open(os.path.join(run_path, 'max_depth_interpolated.tif'), 'w', **ds.profile) as dst:
-        dst.write(fillnodata(ds.read(1), mask=ds.read_masks(1)), 1)
-
-title = f'{name} {x},{y} {size/1000}km {duration}hr'
-description = f'A {size/1000}x{size/1000}km domain centred at {x},{y} was simulated for ' \
-              f'{duration+post_event_duration}hrs, which took ' \
-              f'{round((end_timestamp-start_timestamp).total_seconds()/3600, 1)}hrs to complete. '
-
-if rainfall_mode == 'return_period':
-    description += f'The {return_period}yr {duration}hr event was extracted from the UKCP18 baseline (1980-2000)'
-    if time_horizon != 'baseline':
-        description += f' and uplifted by {row["Uplift_50"]}%'
-    description += '. '
-
-    title += f' {time_horizon} {return_period}yr'
-
-description += f'Total depth of rainfall was {int(round(rainfall_total, 0))}mm. '
-title += f' {int(round(rainfall_total, 0))}mm'
-if post_event_duration > 0:
-    description += f'Following the {duration}hr event, the simulation continued for {post_event_duration}hrs. '
-
-if buildings is not None and len(buildings) > 0:
-    description += f'{len(buildings)} buildings were extracted from the domain. '
-
-if green_areas is not None and len(green_areas) > 0:
-    description += f'{len(green_areas)} green areas where infiltration can take place were defined. '
-
-description += f'The boundaries of the domain were set to {"open" if open_boundaries else "closed"}.'
-
-if roof_storage > 0:
-    description += f' There was {roof_storage}m of roof storage.'
-    title += f' storage={roof_storage}m'
-
-if discharge is not None:
-    description += f' A flow of {discharge_parameter} cumecs was used as a boundary condition.'
-    title += f' {discharge_parameter}m3/s'
-
-udm_para_out_path = os.path.join(outputs_path, 'udm_parameters')
-if not os.path.exists(udm_para_out_path):
-    os.mkdir(udm_para_out_path)
-
-meta_data_txt = glob(udm_para_in_path + "/**/metadata.txt", recursive = True)
-meta_data_csv = glob(udm_para_in_path + "/**/metadata.csv", recursive = True)
-attractors = glob(udm_para_in_path + "/**/attractors.csv", recursive = True)
-constraints = glob(udm_para_in_path + "/**/constraints.csv", recursive = True)
-
-if len(meta_data_txt)==1:
-    src = meta_data_txt[0]
-    dst = os.path.join(udm_para_out_path,'metadata.txt')
-    shutil.copy(src,dst)
-
-if len(meta_data_csv)==1:
-    src = meta_data_csv[0]
-    dst = os.path.join(udm_para_out_path,'metadata.csv')
-    shutil.copy(src,dst)
-
-if len(attractors)==1:
-    src = attractors[0]
-    dst = os.path.join(udm_para_out_path,'attractors.csv')
-    shutil.copy(src,dst)
-
-if len(constraints)==1:
-    src = constraints[0]
-    dst = os.path.join(udm_para_out_path,'constraints.csv')
-    shutil.copy(src,dst)
-
-geojson = json.dumps({
-    'type': 'Feature',
-    'properties': {},
-    'geometry': gpd.GeoSeries(box(*bounds), crs='EPSG:27700').to_crs(epsg=4326).iloc[0].__geo_interface__})
-print(title)
-
-# Moving essential files across:
-boundary_input_path = os.path.join(inputs_path,'boundary')
-boundary_file = glob(boundary_input_path + "/*.gpkg", recursive = True)
-print('boundary_file:',boundary_file)
-boundary_output_path = os.path.join(outputs_path,'boundary')
-if not os.path.exists(boundary_output_path):
-    os.mkdir(boundary_output_path)
-
-fi_input_path = os.path.join(inputs_path,'flood_impact')
-fi_file = glob(fi_input_path + "/*.gpkg", recursive = True)
-print('fi_file:',fi_file)
-fi_output_path = os.path.join(outputs_path,'flood_impact')
-if not os.path.exists(fi_output_path):
-    os.mkdir(fi_output_path)
-
-# Move the boundary file to the outputs folder
-if len(boundary_file) != 0 :
-    for i in range (0, len(boundary_file)):
-        file_path = os.path.splitext(boundary_file[i])
-        filename=file_path[0].split("/")
-    
-        src = boundary_file[i]
-        dst = os.path.join(boundary_output_path,filename[-1] + '.gpkg')
+    for file_name in set(os.listdir(template_path)) - set(scenario_files):
+        try:
+            os.link(os.path.join(template_path, file_name), os.path.join(run_path, file_name))
+        except OSError:
+            shutil.copy(os.path.join(template_path, file_name), run_path)
+
+    inputs.Rainfall(rainfall).write(run_path)
+    inputs.Configuration(**{**dict(duration=rainfall.index[-1], rainfall_zones=len(rainfall.columns)),
+                            **model_options(parameters)}).write(run_path)
+    discharge = get_discharge(parameters)
+    if discharge is not None:
+        inputs.Flow(discharge).write(run_path)
+
+
+def run_citycat(run_path, monitor=None):
+    """Runs the CityCAT executable in run_path
+
+    Args:
+        run_path: Directory containing the input files
+        monitor: Function called in a separate thread with the running process, which returns once it has exited
+
+    Returns:
+        tuple: Start and end timestamps of the simulation and the value returned by monitor
+
+    Raises:
+        subprocess.CalledProcessError: If CityCAT exits with an error, so the simulate stage is not marked complete
+    """
+    # Copy executable
+    logger.info('Preparing CityCat')
+    shutil.copy('citycat.exe', run_path)
+
+    start_timestamp = datetime.now()
+
+    # Run executable
+    logger.info('Running CityCat......')
+    if os.name == 'nt':
+        process = subprocess.Popen('cd {run_path} & citycat.exe -r 1 -c 1'.format(run_path=run_path), shell=True)
+    else:
+        process = subprocess.Popen('cd {run_path} && wine64 citycat.exe -r 1 -c 1'.format(run_path=run_path),
+                                   shell=True)
+
+    with ThreadPoolExecutor(1) as executor:
+        monitored = executor.submit(monitor, process) if monitor is not None else None
+        process.wait()
+
+        end_timestamp = datetime.now()
+
+        logger.info('....CityCat completed!' if process.returncode == 0 else
+                    f'....CityCat exited with code {process.returncode}')
+
+        if monitored is not None:
+            with stage('remaining_surface_maps'):
+                monitored = monitored.result()
+
+    # Delete executable
+    logger.info('Deleting CityCAT model')
+    os.remove(os.path.join(run_path, 'citycat.exe'))
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    return start_timestamp, end_timestamp, monitored
+
+
+def netcdf_attributes(parameters, rainfall_total):
+    return dict(
+        rainfall_mode=parameters['rainfall_mode'],
+        rainfall_total=float(rainfall_total),
+        size=parameters['size'],
+        duration=parameters['duration'],
+        post_event_duration=parameters['post_event_duration'],
+        #return_period=return_period,
+        x=parameters['x'],
+        y=parameters['y'],
+        open_boundaries=str(parameters['open_boundaries']),
+        permeable_areas=parameters['permeable_areas'])
+
+
+def netcdf_encoding():
+    """Chunks and filters of the netCDF file, created either while CityCAT is running or afterwards"""
+    # Analysis ready files have chunks covering blocks of time steps, so time series of cells are quick to read
+    return dict(chunks='auto', shuffle=True) if analysis_ready else {}
+
+
+def prepare(run_path, context):
+    parameters, domain_info = context['parameters'], context['domain_info']
+    with stage('rainfall'):
+        rainfall_total, row = get_rainfall_total(parameters, context['boundary'],
+                                                 context.get('rainfall_bounds') or domain_info['bounds'])
+        rainfall = storm_profile(rainfall_total, parameters['duration'])
+
+    with stage('scenario_inputs'):
+        write_scenario_inputs(run_path, os.path.join(context['template_path'], 'inputs'), parameters, rainfall)
+
+    state = dict(parameters=parameters, domain_info=domain_info, rainfall_total=float(rainfall_total),
+                 row={key: float(value) for key, value in row.items()} if row is not None else None)
+    return state, [os.path.join(run_path, file_name) for file_name in os.listdir(run_path)]
+
+
+def read_points():
+    """Time series of the points in inputs/points, None if there are no points"""
+    from timeseries import PointSeries
+
+    points = read_geometries('points')
+    if points is None or len(points) == 0:
+        return None
+    centroids = points.geometry.centroid
+    return PointSeries(centroids.x.values, centroids.y.values)
+
+
+def simulate(run_path, context):
+    surface_maps_path = os.path.join(run_path, 'R1C1_SurfaceMaps')
+    archive = None
+    if archive_incremental:
+        import archiver
+        archive = archiver.Archive(surface_maps_path + archiver.extensions[archive_codec], codec=archive_codec,
+                                   workers=context['workers'])
+
+    monitor = None
+    if watch_surface_maps:
+        import surface_maps
+
+        # Time series at points are taken from each time step as it is converted
+        context['series'] = read_points()
+        callback = None
+        if archive is not None:
+            # Results files are archived once they are in the netCDF file, after which they are no longer needed
+            def callback(paths):
+                archive.add(paths)
+                if remove_surface_maps:
+                    for path in paths:
+                        os.remove(path)
+
+        parameters = context['parameters']
+        simulated_seconds = (parameters['duration'] + parameters['post_event_duration']) * 3600
+        n_times = simulated_seconds // parameters['output_interval'] + 1
+
+        # The netCDF file and maxima are created from each results file as soon as CityCAT has written it
+        def monitor(process):
+            return surface_maps.watch(surface_maps_path, process, os.path.join(run_path, 'R1C1_SurfaceMaps.nc'),
+                                      srid=27700,
+                                      attributes=netcdf_attributes(context['parameters'], context['rainfall_total']),
+                                      workers=context['workers'], callback=callback, series=context['series'],
+                                      n_times=n_times, **netcdf_encoding())
+    elif archive is not None:
+        if remove_surface_maps:
+            logger.warning('Surface maps are only removed once archived if WATCH_SURFACE_MAPS is set, as they are '
+                           'needed to create the netCDF file')
+
+        def monitor(process):
+            archiver.watch(surface_maps_path, process, archive)
+
+    start_timestamp, end_timestamp, context['maxima'] = run_citycat(run_path, monitor=monitor)
+
+    outputs = [surface_maps_path]
+    if context['maxima'] is not None:
+        outputs.append(os.path.join(run_path, 'R1C1_SurfaceMaps.nc'))
+    if archive is not None:
+        with stage('archive') as record:
+            archive.add_directory(surface_maps_path)
+            record.update(archive.close())
+        outputs.append(archive.path)
+    return dict(start_timestamp=start_timestamp.isoformat(), end_timestamp=end_timestamp.isoformat(),
+                watched=context['maxima'] is not None, archived=archive is not None), outputs
+
+
+def convert(run_path, context):
+    import surface_maps
+    import archiver
+
+    # Archive results files, unless they were archived while CityCAT was running
+    surface_maps_path = os.path.join(run_path, 'R1C1_SurfaceMaps')
+    archive_path = surface_maps_path + archiver.extensions[archive_codec]
+    if not context.get('archived'):
+        logger.info('Archiving results')
+        with stage('archive') as record:
+            record.update(archiver.archive_directory(surface_maps_path, archive_path, codec=archive_codec,
+                                                     workers=context['workers']))
+
+    # Create geotiff
+    logger.info('Creating outputs')
+    geotiff_path = os.path.join(run_path, 'max_depth.tif')
+    netcdf_path = os.path.join(run_path, 'R1C1_SurfaceMaps.nc')
+    outputs = [archive_path, netcdf_path]
+
+    max_depth_path = os.path.join(surface_maps_path, 'R1_C1_max_depth.csv')
+    if os.path.exists(max_depth_path):
+        with stage('max_depth'):
+            surface_maps.to_geotiff(max_depth_path, geotiff_path, srid=27700)
+            if analysis_ready:
+                to_cog(geotiff_path)
+        outputs.append(geotiff_path)
+
+    # The netCDF file is created while CityCAT is running if WATCH_SURFACE_MAPS is set
+    series = context.get('series')
+    if not context.get('watched'):
+        series = read_points()
+        with stage('netcdf'):
+            surface_maps.to_netcdf(surface_maps_path, out_path=netcdf_path, srid=27700, workers=context['workers'],
+                                   attributes=netcdf_attributes(context['parameters'], context['rainfall_total']),
+                                   series=series, **netcdf_encoding())
+    elif series is None:
+        # The simulation was run by an earlier process, so the time series are read from the netCDF file
+        points = read_points()
+        if points is not None:
+            from timeseries import from_netcdf
+            with stage('extract_points'):
+                series = from_netcdf(netcdf_path, points.x, points.y)
+
+    if series is not None:
+        series.to_csv(os.path.join(run_path, 'point_timeseries.csv'))
+        outputs.append(os.path.join(run_path, 'point_timeseries.csv'))
+    return {}, outputs
+
+
+def hazard_rasters(run_path, context):
+    from hazard import max_hazards, write_rasters
+
+    # Maxima are accumulated one time step at a time, the maximum depth from CityCAT is used if it was created
+    max_depth_path = os.path.join(run_path, 'R1C1_SurfaceMaps', 'R1_C1_max_depth.csv')
+    names = ['max_velocity', 'max_vd_product'] + ([] if os.path.exists(max_depth_path) else ['max_depth'])
+    # Maxima accumulated while CityCAT was running are only available if the simulation was run by this process
+    if context.get('maxima') is not None:
+        write_rasters(*context['maxima'], run_path, names=names)
+    else:
+        max_hazards(os.path.join(run_path, 'R1C1_SurfaceMaps.nc'), run_path, names=names)
+
+    outputs = [os.path.join(run_path, f'{name}.tif') for name in names]
+    if analysis_ready:
+        for path in outputs:
+            to_cog(path)
+    return {}, outputs
+
+
+def exposure(run_path, context):
+    # The hazard rasters are passed through as outputs, so later stages are run again if they change
+    outputs = [os.path.join(run_path, f'{name}.tif') for name in ['max_depth', 'max_velocity', 'max_vd_product']]
+    if not exposure_statistics:
+        return {}, outputs
+
+    import geometries
+    from exposure import zonal_statistics, write_exposure
+
+    # Buildings and each file of flood impact polygons are summarised separately
+    layers = [('buildings', geometries.list_files(os.path.join(inputs_path, 'buildings')))]
+    layers += [(os.path.splitext(os.path.basename(path))[0], [path])
+               for path in geometries.list_files(os.path.join(inputs_path, 'flood_impact'))]
+
+    exposure_path = os.path.join(run_path, 'exposure')
+    if os.path.exists(exposure_path):
+        shutil.rmtree(exposure_path)
+    for name, paths in layers:
+        with stage('exposure_' + name) as record:
+            polygons = geometries.read_files(paths, bbox=tuple(context['domain_info']['bounds']),
+                                           workers=context['workers'])
+            if polygons is None or len(polygons) == 0:
+                continue
+            assets, summary = zonal_statistics(polygons, run_path, workers=context['workers'])
+            write_exposure(assets, summary, exposure_path, name,
+                           driver='Parquet' if exposure_format == 'parquet' else 'GPKG')
+            record['features'] = len(assets)
+            record['flooded'] = int((assets.flooded_area > 0).sum())
+    outputs.append(exposure_path)
+    return {}, outputs
+
+
+def render(run_path, context):
+    from render import plot_max_depth
+
+    if 'boundary' not in context:
+        context['boundary'] = read_geometries('boundary')
+
+    geotiff_path = os.path.join(run_path, 'max_depth.tif')
+    outputs = [os.path.join(run_path, 'max_depth.png'), os.path.join(run_path, 'max_depth_interpolated.tif')]
+    with stage('plot'):
+        plot_max_depth(geotiff_path, outputs[0], context['boundary'])
+
+    with stage('interpolation'):
+        interpolate(geotiff_path, outputs[1])
+        if analysis_ready:
+            to_cog(outputs[1])
+
+    if render_tiles:
+        with stage('tiles') as record:
+            record['tiles'] = write_tiles(run_path)
+        outputs.append(os.path.join(run_path, 'tiles'))
+    return {}, outputs
+
+
+def write_tiles(run_path):
+    """Renders XYZ tiles of each hazard raster to run_path/tiles/<name>
+
+    Returns:
+        int: Number of tiles written
+    """
+    from render import tile_pyramid
+
+    tiles_path = os.path.join(run_path, 'tiles')
+    if os.path.exists(tiles_path):
+        shutil.rmtree(tiles_path)
+    return sum(tile_pyramid(os.path.join(run_path, f'{name}.tif'), name, os.path.join(tiles_path, name),
+                            zooms=tile_zooms, workers=workers)
+               for name in ['max_depth', 'max_velocity', 'max_vd_product'])
+
+
+def fill_block(geotiff_path, window, core, max_search_distance):
+    """Fills the nodata cells of a window of a raster, returning the part of the window within core"""
+    import rasterio as rio
+    from rasterio.fill import fillnodata
+
+    with rio.open(geotiff_path) as ds:
+        filled = fillnodata(ds.read(1, window=window), mask=ds.read_masks(1, window=window),
+                            max_search_distance=max_search_distance)
+    row, col = core.row_off - window.row_off, core.col_off - window.col_off
+    return filled[row:row + core.height, col:col + core.width]
+
+
+def interpolate(geotiff_path, out_path, workers=None, block_size=1024, max_search_distance=100):
+    """Creates an interpolated GeoTIFF by filling nodata cells from the values up to max_search_distance cells away
+
+    Blocks are filled in parallel, each read with a halo of max_search_distance cells so the result is the same as
+    filling the whole raster. Finished blocks are written as they complete and only a few are held in memory at once.
+    """
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+    import rasterio as rio
+    from rasterio.windows import Window
+
+    workers = workers or default_workers()
+    with rio.open(geotiff_path) as ds:
+        profile = ds.profile
+        width, height = ds.width, ds.height
+    profile.update(tiled=True, blockxsize=256, blockysize=256)
+
+    blocks = []
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            core = Window(col, row, min(block_size, width - col), min(block_size, height - row))
+            row_start, col_start = max(row - max_search_distance, 0), max(col - max_search_distance, 0)
+            row_stop = min(row + core.height + max_search_distance, height)
+            col_stop = min(col + core.width + max_search_distance, width)
+            blocks.append((Window(col_start, row_start, col_stop - col_start, row_stop - row_start), core))
+
+    with rio.open(out_path, 'w', **profile) as dst, ProcessPoolExecutor(min(workers, len(blocks))) as executor:
+        pending = {}
+        for window, core in blocks:
+            if len(pending) >= 2 * workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dst.write(future.result(), 1, window=pending.pop(future))
+            pending[executor.submit(fill_block, geotiff_path, window, core, max_search_distance)] = core
+        for future in list(pending):
+            dst.write(future.result(), 1, window=pending.pop(future))
+
+
+def describe(parameters, rainfall_total, row, n_buildings, n_green_areas, start_timestamp, end_timestamp):
+    """Title and description of the run used in the metadata file"""
+    name, x, y, size = parameters['name'], parameters['x'], parameters['y'], parameters['size']
+    duration, post_event_duration = parameters['duration'], parameters['post_event_duration']
+    time_horizon, return_period = parameters['time_horizon'], parameters['return_period']
+    roof_storage = parameters['roof_storage']
+
+    title = f'{name} {x},{y} {size/1000}km {duration}hr'
+    description = f'A {size/1000}x{size/1000}km domain centred at {x},{y} was simulated for ' \
+                  f'{duration+post_event_duration}hrs, which took ' \
+                  f'{round((end_timestamp-start_timestamp).total_seconds()/3600, 1)}hrs to complete. '
+
+    if parameters['rainfall_mode'] == 'return_period':
+        description += f'The {return_period}yr {duration}hr event was extracted from the UKCP18 baseline (1980-2000)'
+        if time_horizon != 'baseline':
+            description += f' and uplifted by {row["Uplift_50"]}%'
+        description += '. '
+
+        title += f' {time_horizon} {return_period}yr'
+
+    description += f'Total depth of rainfall was {int(round(rainfall_total, 0))}mm. '
+    title += f' {int(round(rainfall_total, 0))}mm'
+    if post_event_duration > 0:
+        description += f'Following the {duration}hr event, the simulation continued for {post_event_duration}hrs. '
+
+    if n_buildings > 0:
+        description += f'{n_buildings} buildings were extracted from the domain. '
+
+    if n_green_areas > 0:
+        description += f'{n_green_areas} green areas where infiltration can take place were defined. '
+
+    description += f'The boundaries of the domain were set to {"open" if parameters["open_boundaries"] else "closed"}.'
+
+    if roof_storage > 0:
+        description += f' There was {roof_storage}m of roof storage.'
+        title += f' storage={roof_storage}m'
+
+    if discharge_parameter > 0:
+        description += f' A flow of {discharge_parameter} cumecs was used as a boundary condition.'
+        title += f' {discharge_parameter}m3/s'
+
+    return title, description
+
+
+def copy_inputs():
+    udm_para_out_path = os.path.join(outputs_path, 'udm_parameters')
+    if not os.path.exists(udm_para_out_path):
+        os.mkdir(udm_para_out_path)
+
+    meta_data_txt = glob(udm_para_in_path + "/**/metadata.txt", recursive = True)
+    meta_data_csv = glob(udm_para_in_path + "/**/metadata.csv", recursive = True)
+    attractors = glob(udm_para_in_path + "/**/attractors.csv", recursive = True)
+    constraints = glob(udm_para_in_path + "/**/constraints.csv", recursive = True)
+
+    if len(meta_data_txt)==1:
+        src = meta_data_txt[0]
+        dst = os.path.join(udm_para_out_path,'metadata.txt')
         shutil.copy(src,dst)
 
-# Move the impact files to the outputs folder
-if len(fi_file) != 0 :
-    for i in range (0, len(fi_file)):
-        file_path = os.path.splitext(fi_file[i])
-        filename=file_path[0].split("/")
-    
-        src = fi_file[i]
-        dst = os.path.join(fi_output_path,filename[-1] + '.gpkg')
+    if len(meta_data_csv)==1:
+        src = meta_data_csv[0]
+        dst = os.path.join(udm_para_out_path,'metadata.csv')
         shutil.copy(src,dst)
 
+    if len(attractors)==1:
+        src = attractors[0]
+        dst = os.path.join(udm_para_out_path,'attractors.csv')
+        shutil.copy(src,dst)
+
+    if len(constraints)==1:
+        src = constraints[0]
+        dst = os.path.join(udm_para_out_path,'constraints.csv')
+        shutil.copy(src,dst)
 
-# Create metadata file
-logger.info('Building metadata file for DAFNI')
-metadata = f"""{{
+    # Moving essential files across:
+    boundary_input_path = os.path.join(inputs_path,'boundary')
+    boundary_file = glob(boundary_input_path + "/*.gpkg", recursive = True)
+    print('boundary_file:',boundary_file)
+    boundary_output_path = os.path.join(outputs_path,'boundary')
+    if not os.path.exists(boundary_output_path):
+        os.mkdir(boundary_output_path)
+
+    fi_input_path = os.path.join(inputs_path,'flood_impact')
+    fi_file = glob(fi_input_path + "/*.gpkg", recursive = True)
+    print('fi_file:',fi_file)
+    fi_output_path = os.path.join(outputs_path,'flood_impact')
+    if not os.path.exists(fi_output_path):
+        os.mkdir(fi_output_path)
+
+    # Move the boundary file to the outputs folder
+    if len(boundary_file) != 0 :
+        for i in range (0, len(boundary_file)):
+            file_path = os.path.splitext(boundary_file[i])
+            filename=file_path[0].split("/")
+
+            src = boundary_file[i]
+            dst = os.path.join(boundary_output_path,filename[-1] + '.gpkg')
+            shutil.copy(src,dst)
+
+    # Move the impact files to the outputs folder
+    if len(fi_file) != 0 :
+        for i in range (0, len(fi_file)):
+            file_path = os.path.splitext(fi_file[i])
+            filename=file_path[0].split("/")
+
+            src = fi_file[i]
+            dst = os.path.join(fi_output_path,filename[-1] + '.gpkg')
+            shutil.copy(src,dst)
+
+
+def write_metadata(run_path, title, description, bounds):
+    from pyproj import Transformer
+    from shapely.geometry import box
+    from shapely.ops import transform
+
+    transformer = Transformer.from_crs('EPSG:27700', 'EPSG:4326', always_xy=True)
+    geojson = json.dumps({
+        'type': 'Feature',
+        'properties': {},
+        'geometry': transform(transformer.transform, box(*bounds)).__geo_interface__})
+    print(title)
+
+    # Create metadata file
+    logger.info('Building metadata file for DAFNI')
+    metadata = f"""{{
   "@context": ["metadata-v1"],
   "@type": "dcat:Dataset",
   "dct:language": "en",
@@ -544,5 +1048,243 @@ metadata = f"""{{
   "geojson": {geojson}
 }}
 """
-with open(os.path.join(run_path, 'metadata.json'), 'w') as f:
-    f.write(metadata)
+    with open(os.path.join(run_path, 'metadata.json'), 'w') as f:
+        f.write(metadata)
+
+
+def metadata(run_path, context):
+    domain_info = context['domain_info']
+    title, description = describe(context['parameters'], context['rainfall_total'], context['row'],
+                                  domain_info['n_buildings'], domain_info['n_green_areas'],
+                                  datetime.fromisoformat(context['start_timestamp']),
+                                  datetime.fromisoformat(context['end_timestamp']))
+    write_metadata(run_path, title, description, domain_info['bounds'])
+    return dict(title=title, description=description), [os.path.join(run_path, 'metadata.json')]
+
+
+stages = dict(prepare=prepare, simulate=simulate, convert=convert, hazard_rasters=hazard_rasters, exposure=exposure,
+              render=render, metadata=metadata)
+
+
+def prepare_key(parameters, bounds, rainfall_bounds=None):
+    """Fingerprint of the inputs of the prepare stage"""
+    return fingerprint(domain_sources(bounds), parameters=parameters, bounds=list(bounds),
+                       rainfall_bounds=rainfall_bounds, simplify=simplify_tolerance)
+
+
+def run_stages(run_path, context, resume=False, only=None):
+    """Runs the stages of a scenario, recording a completion marker for each stage
+
+    Each marker records a fingerprint of the outputs of the previous stage, so a stage is out of date if any earlier
+    stage has been run again.
+
+    Args:
+        run_path: Directory in which to run CityCAT
+        context: Parameters, boundary, template_path, domain_info, rainfall_bounds and workers
+        resume: Whether to skip stages whose outputs are up to date
+        only: Name of a single stage to run, using the state recorded by the earlier stages
+
+    Returns:
+        dict: The context updated with the state of each stage
+    """
+    checkpoints = Checkpoints(run_path)
+    if only is not None and only != 'prepare':
+        state = checkpoints.state()
+        assert 'parameters' in state, f'{run_path} has not been prepared, run the earlier stages first'
+        context = {**context, **state}
+
+    inputs = None
+    if only in [None, 'prepare']:
+        inputs = prepare_key(context['parameters'], context['domain_info']['bounds'], context.get('rainfall_bounds'))
+
+    for name in stage_names:
+        if only is not None and name != only:
+            pass
+        elif resume and checkpoints.valid(name, inputs):
+            logger.info(f'Skipping {name}, its outputs are up to date')
+            context.update(checkpoints.marker(name)['state'])
+        else:
+            with stage(name):
+                state, outputs = stages[name](run_path, context)
+            context.update(state)
+            checkpoints.complete(name, inputs, outputs, **state)
+
+        marker = checkpoints.marker(name)
+        inputs = marker['outputs_fingerprint'] if marker is not None else None
+
+    return context
+
+
+def run_scenario(run_path, parameters, boundary, template_path, domain_info, workers=None, rainfall_bounds=None,
+                 resume=False, only=None):
+    """Creates the input files for a scenario, runs CityCAT and processes the results
+
+    Args:
+        run_path: Directory in which to run CityCAT
+        parameters: Scenario parameters
+        boundary: Boundary polygons used for plotting and rainfall extraction
+        template_path: Template created by :func:`prepare_template`, not used if the prepare stage is skipped
+        domain_info: Domain information created by :func:`prepare_template`
+        workers: Number of processes used for post-processing
+        rainfall_bounds: Extent used to extract the rainfall if there is no boundary, defaults to the domain bounds
+        resume: Whether to skip stages whose outputs are up to date
+        only: Name of a single stage to run
+
+    Returns:
+        tuple: Title and description of the run
+    """
+    workers = workers or default_workers()
+    # Stages shared between scenarios are kept, so each scenario records its own stages
+    shared_stages = list(telemetry.stages)
+
+    try:
+        context = run_stages(run_path, dict(parameters=parameters, boundary=boundary, template_path=template_path,
+                                            domain_info=domain_info, workers=workers, rainfall_bounds=rainfall_bounds),
+                             resume=resume, only=only)
+
+        write_telemetry(run_path, resume or only is not None, title=context.get('title'),
+                        parameters=context['parameters'], domain=context['domain_info'], workers=workers)
+    finally:
+        # A failed scenario does not leave its stages in the telemetry of the next run in the same process
+        telemetry.stages = shared_stages
+
+    return context.get('title'), context.get('description')
+
+
+def write_telemetry(run_path, keep_previous, **info):
+    telemetry_path = os.path.join(run_path, 'telemetry.json')
+    # Disk usage of the run is used to predict the disk usage of later runs
+    info['disk_mb'] = round(sum(os.path.getsize(path) for path in list_files([run_path])) / 1e6, 1)
+    if keep_previous and os.path.exists(telemetry_path):
+        # Stages which were skipped are described by the previous telemetry
+        with open(telemetry_path) as f:
+            info['previous_stages'] = json.load(f)['stages']
+    telemetry.write(telemetry_path, **info)
+
+
+def run_paths():
+    """Run directories in outputs/run which contain completion markers"""
+    return sorted(os.path.dirname(path) for path in
+                  glob(os.path.join(outputs_path, 'run', '**', '.stages'), recursive=True))
+
+
+def run_preflight(parameters, bounds, scenarios):
+    """Checks the predicted resources of the run against the limits before the domain is prepared
+
+    Returns:
+        str: Decomposition layout if the run is predicted to take too long and PREFLIGHT_ACTION is decompose
+    """
+    import preflight
+
+    with stage('preflight') as record:
+        report = preflight.check(inputs_path, bounds, parameters, preflight_history, preflight_limits,
+                                 index_path=os.getenv('DEM_INDEX'))
+        record.update(report)
+    if len(report['exceeded']) == 0:
+        return None
+
+    exceeded = ', '.join(f'{name} {report["prediction"][name]} > {preflight_limits[name]}'
+                         for name in report['exceeded'])
+    assert preflight_action != 'reject', f'Run rejected by preflight check, predicted {exceeded}'
+    if preflight_action == 'decompose' and report['exceeded'] == ['wall_seconds'] and scenarios is None:
+        layout = preflight.layout(report['prediction']['wall_seconds'], preflight_limits['wall_seconds'])
+        logger.warning(f'Predicted {exceeded}, decomposing the domain into {layout} sub-domains')
+        return layout
+    logger.warning(f'Predicted {exceeded}')
+    return None
+
+
+def main(resume=False, only=None, preflight_only=False):
+    configure()
+    setup_logging()
+    check_options()
+
+    if only is not None and only != 'prepare':
+        # Stages after prepare only use the state recorded in the run directories
+        for run_path in run_paths():
+            logger.info(f'Running {only} in {run_path}')
+            context = run_stages(run_path, dict(workers=workers), only=only)
+            write_telemetry(run_path, True, title=context.get('title'), parameters=context['parameters'],
+                            domain=context['domain_info'], workers=workers)
+        return
+
+    # If the UDM model preceeds the CityCat model in the workflow, a zip file should appear in the inputs folder
+    # Check if the zip file exists
+    archive = glob(inputs_path + "/**/*.zip", recursive = True)
+    logger.info(archive)
+
+    with stage('parameters'):
+        parameters = read_parameters()
+
+    logger.info('--------')
+    logger.info('Starting to run code')
+
+    logger.info('Setting boundary')
+    with stage('boundary'):
+        boundary = read_geometries('boundary')
+        bounds = get_bounds(boundary, parameters)
+
+    scenarios = read_scenarios(parameters)
+
+    decomposition = os.getenv('DECOMPOSITION')
+    if preflight_enabled or preflight_only:
+        try:
+            decomposition = run_preflight(parameters, bounds, scenarios) or decomposition
+        except AssertionError:
+            raise
+        except Exception:
+            # The preflight check is advisory, so a failure to make a prediction does not stop the run
+            logger.exception('Preflight check failed')
+        if preflight_only:
+            telemetry.write(os.path.join(outputs_path, 'preflight.json'))
+            return
+
+    if any(member['rainfall_mode'] == 'return_period' for member in scenarios or [parameters]):
+        # The store is created before scenarios or sub-domains are run in parallel, rather than by each of them
+        with stage('future_drainage'):
+            open_future_drainage()
+
+    with tempfile.TemporaryDirectory(dir=outputs_path) as tmp:
+        if os.getenv('SCREENING_RESOLUTION'):
+            from screening import run_screening
+            run_screening(float(os.getenv('SCREENING_RESOLUTION')), parameters, scenarios, boundary, bounds, tmp)
+            copy_inputs()
+            return
+
+        if decomposition and scenarios is None:
+            from decomposition import run_decomposed
+            run_decomposed(decomposition, parameters, boundary, bounds, tmp)
+            copy_inputs()
+            return
+
+        run_path = os.path.join(outputs_path, 'run')
+        checkpoints = Checkpoints(run_path)
+        prepared = checkpoints.state().get('domain_info')
+        if resume and scenarios is None and prepared is not None and \
+                checkpoints.valid('prepare', prepare_key(parameters, prepared['bounds'])):
+            # The domain is only needed to prepare the run
+            template_path, domain_info = None, prepared
+        else:
+            with stage('domain'):
+                template_path, domain_info = get_template(tmp, bounds, parameters)
+
+        if scenarios is not None:
+            from ensemble import run_ensemble
+            run_ensemble(scenarios, boundary, template_path, domain_info, resume=resume, only=only)
+        else:
+            # Create run directory
+            logger.info('Creating run directory')
+
+            run_scenario(run_path, parameters, boundary, template_path, domain_info, resume=resume, only=only)
+
+    copy_inputs()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs CityCAT and processes the results')
+    parser.add_argument('--resume', action='store_true', help='skip stages whose outputs are up to date')
+    parser.add_argument('--only', choices=stage_names, help='run a single stage')
+    parser.add_argument('--preflight', action='store_true',
+                        help='only predict the resources of the run, written to outputs/preflight.json')
+    args = parser.parse_args()
+    main(resume=args.resume, only=args.only, preflight_only=args.preflight)
@@ -0,0 +1,218 @@
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+import rasterio as rio
+from rasterio.io import MemoryFile
+from rasterio.enums import Resampling
+from rasterio.features import rasterize
+from rasterio.transform import Affine, from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, from_bounds
+import run
+from ensemble import run_ensemble
+from decomposition import compare
+
+logger = logging.getLogger('citycat-dafni')
+
+
+def coarsen_dem(dem, res):
+    """Averages a DEM to a whole multiple of its resolution close to res
+
+    Cells along the right and bottom edges which do not fill a coarse cell are dropped.
+
+    Args:
+        dem: Path or MemoryFile of the DEM
+        res: Cell size in metres
+
+    Returns:
+        tuple: MemoryFile of the coarse DEM and its bounds
+    """
+    with (rio.open(dem) if isinstance(dem, str) else dem.open()) as src:
+        factor = max(1, int(round(res / src.res[0])))
+        height, width = src.height // factor, src.width // factor
+        array = src.read(1, window=Window(0, 0, width * factor, height * factor), out_shape=(height, width),
+                         resampling=Resampling.average, masked=True)
+        transform = from_origin(src.bounds.left, src.bounds.top, src.res[0] * factor, src.res[1] * factor)
+        nodata = src.nodata
+
+    coarse = MemoryFile()
+    with coarse.open(driver='GTiff', transform=transform, width=width, height=height, count=1,
+                     dtype=rio.float32, nodata=nodata) as dataset:
+        dataset.write(array.filled(nodata).astype(np.float32), 1)
+        bounds = dataset.bounds
+    logger.info(f'---- Coarsened the DEM by a factor of {factor} to {src.res[0] * factor}m cells')
+    return coarse, bounds
+
+
+def cell_fractions(geometries, transform, shape, supersample=4):
+    """Fraction of each cell covered by geometries, from a grid supersample times finer"""
+    if geometries is None or len(geometries) == 0:
+        return np.zeros(shape)
+    fine_transform = transform * Affine.scale(1 / supersample)
+    covered = rasterize(geometries.geometry, out_shape=(shape[0] * supersample, shape[1] * supersample),
+                        transform=fine_transform, fill=0, default_value=1, dtype='uint8')
+    return covered.reshape(shape[0], supersample, shape[1], supersample).mean(axis=(1, 3))
+
+
+def cell_polygons(mask, transform, crs):
+    """Squares covering the cells of a mask, so CityCAT treats exactly those cells as covered"""
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    rows, cols = np.nonzero(mask)
+    left, top = transform * (cols, rows)
+    geometries = [box(x, y - abs(transform.e), x + transform.a, y) for x, y in zip(left, top)]
+    return gpd.GeoDataFrame(geometry=geometries, crs=crs)
+
+
+def coarsen_domain(domain, res, threshold=0.5):
+    """Aggregates a domain prepared by :func:`run.prepare_domain` to coarse cells
+
+    Buildings and green areas are replaced by the coarse cells they cover more than threshold of, so each is
+    represented by whole cells. A cell covered by both is a building.
+
+    Returns:
+        dict: Domain with the coarse DEM, buildings and green areas
+    """
+    dem, bounds = coarsen_dem(domain['dem'], res)
+    with dem.open() as dataset:
+        transform, shape = dataset.transform, dataset.shape
+
+    coarse = dict(domain, dem=dem, bounds=bounds)
+    buildings = cell_fractions(domain['buildings'], transform, shape) > threshold
+    green_areas = (cell_fractions(domain['green_areas'], transform, shape) > threshold) & ~buildings
+    for name, mask in [('buildings', buildings), ('green_areas', green_areas)]:
+        if domain[name] is not None:
+            coarse[name] = cell_polygons(mask, transform, domain[name].crs)
+    return coarse
+
+
+def exceedance(run_path, depth_threshold, vd_threshold):
+    """Maxima of a run and the area and extent of the cells above either threshold"""
+    arrays = {}
+    for name in ['max_depth', 'max_vd_product']:
+        with rio.open(os.path.join(run_path, f'{name}.tif')) as src:
+            arrays[name] = src.read(1, masked=True).filled(np.nan)
+            transform = src.transform
+    with np.errstate(invalid='ignore'):
+        above = (arrays['max_depth'] > depth_threshold) | (arrays['max_vd_product'] > vd_threshold)
+    rows, cols = np.nonzero(above)
+    extent = None
+    if len(rows) > 0:
+        left, top = transform * (cols.min(), rows.min())
+        right, bottom = transform * (cols.max() + 1, rows.max() + 1)
+        extent = [left, bottom, right, top]
+    return dict(max_depth=float(np.nanmax(arrays['max_depth'])),
+                max_vd_product=float(np.nanmax(arrays['max_vd_product'])),
+                exceeding_area=float(above.sum() * abs(transform.a * transform.e)), extent=extent)
+
+
+def resample_to(path, like_path, out_path):
+    """Averages a fine raster onto the cells of a coarse raster which it covers"""
+    with rio.open(like_path) as like, rio.open(path) as src:
+        window = from_bounds(*src.bounds, transform=like.transform).round_offsets().round_lengths()
+        transform = like.window_transform(window)
+        with WarpedVRT(src, crs=like.crs, transform=transform, width=window.width, height=window.height,
+                       resampling=Resampling.average) as vrt:
+            array = vrt.read(1, masked=True)
+        profile = like.profile
+    profile.update(width=window.width, height=window.height, transform=transform)
+    with rio.open(out_path, 'w', **profile) as dst:
+        dst.write(array.filled(profile['nodata']).astype(profile['dtype']), 1)
+
+
+def run_screening(res, parameters, scenarios, boundary, bounds, tmp, depth_threshold=None, vd_threshold=None,
+                  halo=None, sub_areas=None):
+    """Runs every scenario on a coarse grid and the fine grid only where the coarse maxima exceed the thresholds
+
+    Coarse runs are written to outputs/screening and fine runs to outputs/run, or to outputs/run/scenario_{i} for
+    an ensemble. Fine runs cover the extent of the coarse cells above either threshold plus a halo, shared by all
+    scenarios. Without a boundary, the rainfall of every run is extracted over the full domain, so the coarse and fine
+    runs of a scenario have the same rainfall. The coarse maximum depth of each scenario with a fine run is compared
+    with the fine maximum depth averaged onto the coarse grid, giving an estimate of the error of the coarse runs. The
+    maxima, whether a fine run was needed and the errors are written to outputs/screening/screening.csv.
+
+    Args:
+        res: Cell size of the coarse grid in metres
+        parameters: Run parameters
+        scenarios: Parameters of each scenario, None for a single run
+        boundary: Boundary polygons used for plotting and rainfall extraction
+        bounds: Extent of the full domain
+        tmp: Directory in which to prepare the domains
+        depth_threshold: Maximum depth above which a fine run is needed, defaults to SCREENING_DEPTH or 0.3
+        vd_threshold: Maximum V×D product above which a fine run is needed, defaults to SCREENING_VD or 0.5
+        halo: Distance in metres that fine runs extend beyond the exceeding cells, defaults to SCREENING_HALO or 500
+        sub_areas: Whether fine runs only cover the exceeding cells, defaults to SCREENING_SUB_AREAS or True
+    """
+    depth_threshold = depth_threshold if depth_threshold is not None else float(os.getenv('SCREENING_DEPTH', 0.3))
+    vd_threshold = vd_threshold if vd_threshold is not None else float(os.getenv('SCREENING_VD', 0.5))
+    halo = halo if halo is not None else float(os.getenv('SCREENING_HALO', 500))
+    if sub_areas is None:
+        sub_areas = os.getenv('SCREENING_SUB_AREAS', 'True').lower() == 'true'
+    members = scenarios if scenarios is not None else [parameters]
+
+    screening_path = os.path.join(run.outputs_path, 'screening')
+    os.makedirs(os.path.join(tmp, 'coarse'))
+    with run.stage('screening_domain'):
+        template_path, domain_info = run.get_template(os.path.join(tmp, 'coarse'), bounds, parameters, res=res)
+    with run.stage('screening'):
+        index = run_ensemble(members, boundary, template_path, domain_info, ensemble_path=screening_path,
+                             rainfall_bounds=bounds)
+
+    results = [exceedance(os.path.join(run.outputs_path, path), depth_threshold, vd_threshold)
+               if status == 'completed' else dict(extent=None) for path, status in zip(index.run_path, index.status)]
+    # A scenario which failed on the coarse grid is run on the fine grid
+    selected = [i for i, (result, status) in enumerate(zip(results, index.status))
+                if result['extent'] is not None or status != 'completed']
+    logger.info(f'{len(selected)} of {len(members)} scenarios exceed {depth_threshold}m depth or '
+                f'{vd_threshold}m²/s V×D and are run at full resolution')
+
+    fine_paths = {}
+    if len(selected) > 0:
+        fine_bounds = bounds
+        extents = [results[i]['extent'] for i in selected if results[i]['extent'] is not None]
+        if sub_areas and len(extents) == len(selected):
+            extents = np.array(extents)
+            fine_bounds = (float(max(extents[:, 0].min() - halo, bounds[0])),
+                           float(max(extents[:, 1].min() - halo, bounds[1])),
+                           float(min(extents[:, 2].max() + halo, bounds[2])),
+                           float(min(extents[:, 3].max() + halo, bounds[3])))
+        os.makedirs(os.path.join(tmp, 'fine'))
+        with run.stage('fine_domain'):
+            template_path, domain_info = run.get_template(os.path.join(tmp, 'fine'), fine_bounds, parameters)
+
+        if scenarios is None:
+            run_path = os.path.join(run.outputs_path, 'run')
+            run.run_scenario(run_path, parameters, boundary, template_path, domain_info, rainfall_bounds=bounds)
+            fine_paths[0] = run_path
+        else:
+            fine_index = run_ensemble([scenarios[i] for i in selected], boundary, template_path, domain_info,
+                                      ids=selected, rainfall_bounds=bounds)
+            fine_paths = {i: os.path.join(run.outputs_path, path)
+                          for i, path, status in zip(selected, fine_index.run_path, fine_index.status)
+                          if status == 'completed'}
+
+    # The coarse maximum depth is compared with the fine maximum depth averaged onto the coarse cells
+    errors = {}
+    for i, fine_path in fine_paths.items():
+        coarse_path = os.path.join(run.outputs_path, index.run_path[i], 'max_depth.tif')
+        if index.status[i] != 'completed':
+            continue
+        reference_path = os.path.join(run.outputs_path, index.run_path[i], 'fine_max_depth.tif')
+        resample_to(os.path.join(fine_path, 'max_depth.tif'), coarse_path, reference_path)
+        errors[i] = compare(coarse_path, reference_path)
+
+    report = pd.DataFrame([dict(scenario=i, status=index.status[i], fine_run=i in selected,
+                                **{key: value for key, value in result.items() if key != 'extent'},
+                                **{f'error_{key}': value for key, value in errors.get(i, {}).items()})
+                           for i, result in enumerate(results)])
+    report.to_csv(os.path.join(screening_path, 'screening.csv'), index=False)
+    mean_absolute_errors = [error['mean_absolute_error'] for error in errors.values() if error['cells'] > 0]
+    if len(mean_absolute_errors) > 0:
+        logger.info(f'Mean absolute error of the coarse maximum depth {np.mean(mean_absolute_errors):.3f}m')
+    with open(os.path.join(screening_path, 'screening.json'), 'w') as f:
+        json.dump(dict(res=res, depth_threshold=depth_threshold, vd_threshold=vd_threshold, halo=halo,
+                       sub_areas=sub_areas, scenarios=len(members), fine_runs=len(selected)), f, indent=2)
+    return report
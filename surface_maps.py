@@ -0,0 +1,416 @@
+import os
+import time
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import netCDF4 as nc
+
+logger = logging.getLogger('citycat-dafni')
+
+variables = ['Depth', 'Vx', 'Vy']
+
+# Layout of the netCDF files created by citycatio.output, which is not imported as it loads GeoPandas and GDAL
+datatype = 'f4'
+fill_value = nc.default_fillvals[datatype]
+# Decimal places kept by the quantisation of depths and velocities in the netCDF files
+least_significant_digit = 3
+
+
+def path_to_step(path):
+    return int(os.path.basename(path).split('min')[0].split('_')[2][1:])
+
+
+def path_to_time(path):
+    return int(os.path.basename(path).split('min')[0].split('_')[-1].split('.')[0])
+
+
+def get_transform(x, y):
+    """Resolution, cell centre coordinates and grid indices of cells, the same as citycatio.output.get_transform"""
+    res = np.diff(np.unique(x)).min()
+    unique_x = np.arange(x.min(), x.max() + res, res)
+    unique_y = np.arange(y.max(), y.min() - res, -res)
+
+    x_index = ((x - x.min()) / res).round(0).astype(int)
+    y_index = ((y.max() - y) / res).round(0).astype(int)
+
+    return res, unique_x, unique_y, x_index, y_index
+
+
+def list_results(in_path):
+    """Surface map files in in_path sorted by time step"""
+    file_paths = [os.path.join(in_path, rsl) for rsl in os.listdir(in_path) if rsl.lower().endswith('.rsl')]
+    file_paths.sort(key=path_to_step)
+    return file_paths
+
+
+def read_results(path, columns=variables, delimiter=' '):
+    """Reads columns of a CityCAT results file as a float32 array of shape (len(columns), cells)"""
+    df = pd.read_csv(path, usecols=columns, delimiter=delimiter, dtype=np.float32, engine='c')
+    return df[columns].values.T
+
+
+def read_locations(path, delimiter=' '):
+    """Transform and grid indices of the cells in a CityCAT results file"""
+    locations = pd.read_csv(path, usecols=['XCen', 'YCen'], delimiter=delimiter, engine='c')
+    res, unique_x, unique_y, x_index, y_index = get_transform(locations.XCen, locations.YCen)
+    return res, unique_x, unique_y, x_index.values, y_index.values
+
+
+def ordered_map(executor, fn, items, ahead):
+    """Like executor.map but with at most ahead results pending, so memory use is bounded"""
+    futures = deque()
+    for item in items:
+        futures.append(executor.submit(fn, item))
+        if len(futures) > ahead:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def quantize(array, digits=least_significant_digit):
+    """Rounds values as netCDF4 does when writing a variable with least_significant_digit, to a power of two
+
+    Values are rounded to the nearest multiple of 2**-bits, the smallest power of two finer than 10**-digits.
+    """
+    if digits is None:
+        return array
+    scale = 2.0 ** np.ceil(np.log2(10.0 ** digits))
+    return np.around(scale * array) / scale
+
+
+def check_attributes(attributes):
+    allowed_attribute_types = [float, int, str]
+    for key, val in attributes.items():
+        assert type(key) == str, 'Attribute names must be strings, {} is a {}'.format(key, type(key))
+        assert key[0].isalpha(), '{} must begin with an alphabetic character'.format(key)
+        assert all(char == '_' or char.isalnum() for char in key), \
+            '{} is not alphanumeric (including underscore)'.format(key)
+        try:
+            assert all(type(item) in allowed_attribute_types for item in val), \
+                'Attribute value types must be one of {}'.format(allowed_attribute_types)
+        except TypeError:
+            assert type(val) in allowed_attribute_types, \
+                '{} type must be one of {}'.format(key, allowed_attribute_types)
+
+
+def analysis_ready_chunks(n_times, y_size, x_size, size=128, max_steps=8, memory=512e6):
+    """Chunk shape for reading both maps of single time steps and time series of single cells
+
+    Each chunk covers a square window over a block of time steps. The number of time steps is limited so that a block
+    of all three variables fits within memory while it is written.
+
+    Returns:
+        tuple: Chunk shape (time, y, x)
+    """
+    steps = int(memory // (len(variables) * y_size * x_size * 4))
+    return max(1, min(n_times, max_steps, steps)), min(size, y_size), min(size, x_size)
+
+
+def create_netcdf(out_path, unique_x, unique_y, n_times, start_time=datetime(1, 1, 1), srid=None, attributes=None,
+                  chunks=None, **encoding):
+    """Creates a netCDF file with the same layout as :func:`citycatio.output.to_netcdf`
+
+    Args:
+        out_path: Path to create netCDF file
+        unique_x: X coordinates of the cell centres
+        unique_y: Y coordinates of the cell centres
+        n_times: Number of time steps to allocate, None for an unlimited time dimension
+        start_time: Start time to use when creating time steps
+        srid: EPSG Spatial Reference System Identifier of results files
+        attributes: Dictionary of key-value pairs to store as netCDF attributes
+        chunks: Chunk shape of the depth and velocity variables, defaults to one time step per chunk
+        **encoding: Options passed to createVariable for the depth and velocity variables
+
+    Returns:
+        netCDF4.Dataset: The open dataset
+    """
+    if os.path.exists(out_path):
+        os.remove(out_path)
+
+    x_size, y_size = len(unique_x), len(unique_y)
+    encoding = {**dict(zlib=True, least_significant_digit=least_significant_digit), **encoding}
+
+    ds = nc.Dataset(out_path, "w", format="NETCDF4")
+    ds.createDimension("time", n_times)
+    ds.createDimension("x", x_size)
+    ds.createDimension("y", y_size)
+
+    dims = ("time", "y", "x",)
+    chunks = chunks or (1, y_size, x_size)
+    depth_var = ds.createVariable("depth", datatype, dims, chunksizes=chunks, **encoding)
+    x_vel_var = ds.createVariable("x_vel", datatype, dims, chunksizes=chunks, **encoding)
+    y_vel_var = ds.createVariable("y_vel", datatype, dims, chunksizes=chunks, **encoding)
+    x_var = ds.createVariable("x", datatype, ("x",), zlib=True)
+    y_var = ds.createVariable("y", datatype, ("y",), zlib=True)
+    times_var = ds.createVariable("time", "f8", ("time",), zlib=True)
+
+    depth_var.units = 'm'
+    x_vel_var.units = 'm/s'
+    y_vel_var.units = 'm/s'
+    x_var.units = 'm'
+    y_var.units = 'm'
+
+    times_var.units = "minutes since {:%Y-%m-%d}".format(start_time).replace("-0", "-")
+    times_var.calendar = "gregorian"
+    times_var.long_name = "Time in minutes since {:%Y-%m-%d}".format(start_time).replace("-0", "-")
+
+    x_var[:] = unique_x
+    y_var[:] = unique_y
+
+    if srid is not None:
+        from osgeo import osr
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(srid)
+        for var in [depth_var, x_vel_var, y_vel_var]:
+            var.grid_mapping = 'crs'
+
+        crs = ds.createVariable('crs', 'i4')
+        crs.spatial_ref = srs.ExportToWkt()
+        crs.grid_mapping_name = srs.GetAttrValue('projection').lower()
+        crs.scale_factor_at_central_meridian = srs.GetProjParm('scale_factor')
+        crs.longitude_of_central_meridian = srs.GetProjParm('central_meridian')
+        crs.latitude_of_projection_origin = srs.GetProjParm('latitude_of_origin')
+        crs.false_easting = srs.GetProjParm('false_easting')
+        crs.false_northing = srs.GetProjParm('false_northing')
+
+    ds.Conventions = 'CF-1.6'
+    ds.institution = 'Newcastle University'
+    ds.source = 'CityCAT Model Results'
+    ds.references = 'Glenis, V., Kutija, V. & Kilsby, C.G. (2018) ' \
+                    'A fully hydrodynamic urban flood modelling system ' \
+                    'representing buildings, green space and interventions. ' \
+                    'Environmental Modelling and Software. 109 (August), 272–292'
+
+    ds.title = 'CityCAT Model Results'
+    ds.history = 'Created {}'.format(datetime.now())
+
+    if attributes is not None:
+        for key in attributes.keys():
+            ds.setncattr(key, attributes[key])
+
+    return ds
+
+
+def to_netcdf(
+        in_path,
+        out_path=None,
+        start_time: datetime = datetime(1, 1, 1),
+        srid: int = None,
+        attributes: dict = None,
+        workers: int = None,
+        chunks=None,
+        series=None,
+        **encoding):
+    """Converts CityCAT results to a netCDF file, parsing the results files in parallel
+
+    Drop-in replacement for :func:`citycatio.output.to_netcdf`.
+    Results files are parsed in a process pool and written in order into a netCDF file, by default with one chunk per
+    time step. Chunks spanning several time steps are filled in memory and written once they are complete.
+
+    Args:
+        in_path: path where CityCAT results files are located
+        out_path: path to create netCDF file
+            If not given then in_path will be used with an appended extension
+        start_time: Start time to use when creating time steps
+        srid: EPSG Spatial Reference System Identifier of results files
+        attributes: Dictionary of key-value pairs to store as netCDF attributes
+            Keys must begin with an alphabetic character and be alphanumeric, underscore is allowed
+        workers: Number of processes used to parse results files, defaults to the number of CPUs
+        chunks: Chunk shape (time, y, x) or auto to use :func:`analysis_ready_chunks`
+        series: timeseries.PointSeries to which each time step is added
+        **encoding: Options passed to createVariable for the depth and velocity variables
+    """
+    if attributes is not None:
+        check_attributes(attributes)
+
+    if out_path is None:
+        out_path = os.path.join(os.path.dirname(in_path), os.path.basename(in_path) + '.nc')
+
+    file_paths = list_results(in_path)
+    times = [path_to_time(path) for path in file_paths]
+    steps = [path_to_step(path) for path in file_paths]
+
+    res, unique_x, unique_y, x_index, y_index = read_locations(file_paths[0])
+    if series is not None:
+        series.locate(res, unique_x, unique_y)
+
+    n_times = max(max(steps) + 1, len(times))
+    if chunks == 'auto':
+        chunks = analysis_ready_chunks(n_times, len(unique_y), len(unique_x))
+    ds = create_netcdf(out_path, unique_x, unique_y, n_times, start_time, srid, attributes, chunks, **encoding)
+    arrays = np.full((len(variables), len(unique_y), len(unique_x)), fill_value, dtype=np.float32)
+
+    # Time steps are buffered until the chunks containing them are complete
+    time_chunk = chunks[0] if chunks is not None else 1
+    buffer = np.full((len(variables), time_chunk, len(unique_y), len(unique_x)), fill_value, dtype=np.float32)
+    block = None
+
+    def flush():
+        start = block * time_chunk
+        stop = min(start + time_chunk, n_times)
+        for name, array in zip(['depth', 'x_vel', 'y_vel'], buffer):
+            ds[name][start:stop, :, :] = array[:stop - start]
+
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as executor:
+        for step, minutes, values in zip(steps, times,
+                                         ordered_map(executor, read_results, file_paths, ahead=2 * workers)):
+            if step // time_chunk != block:
+                if block is not None:
+                    flush()
+                    buffer[:] = fill_value
+                block = step // time_chunk
+            arrays[:, y_index, x_index] = values
+            buffer[:, step % time_chunk] = arrays
+            if series is not None:
+                series.add(step, minutes, arrays)
+    flush()
+
+    ds['time'][:len(times)] = times
+    ds.close()
+
+    logger.info(f'---- Converted {len(file_paths)} results files using {workers} processes')
+
+
+def watch(in_path, process, out_path, start_time=datetime(1, 1, 1), srid=None, attributes=None, workers=None,
+          interval=5, callback=None, series=None, chunks=None, n_times=None, **encoding):
+    """Converts CityCAT results to a netCDF file and running maxima while the simulation is running
+
+    A results file is taken to be complete once a file for a later time step exists, or once the process has exited.
+    Complete files are added to the netCDF file and the maxima as they appear, so when CityCAT exits only the last
+    few time steps are left to process.
+
+    Args:
+        in_path: path where CityCAT writes results files
+        process: The running CityCAT process
+        out_path: path to create netCDF file
+        start_time: Start time to use when creating time steps
+        srid: EPSG Spatial Reference System Identifier of results files
+        attributes: Dictionary of key-value pairs to store as netCDF attributes
+        workers: Number of processes used to parse results files, defaults to the number of CPUs
+        interval: Seconds to wait between checking for new results files
+        callback: Function called with each batch of results files once they have been added to the netCDF file
+        series: timeseries.PointSeries to which each time step is added
+        chunks: Chunk shape (time, y, x) or auto to use :func:`analysis_ready_chunks`
+        n_times: Expected number of time steps, used to choose the chunks if chunks is auto
+        **encoding: Options passed to createVariable for the depth and velocity variables
+
+    Returns:
+        tuple: RunningMaxima, x and y coordinates of the cell centres, or None if no results files were created
+    """
+    from hazard import RunningMaxima
+
+    if attributes is not None:
+        check_attributes(attributes)
+
+    workers = workers or os.cpu_count()
+    done = set()
+    ds = maxima = block = None
+    block_stop = n_waiting = 0
+
+    def flush():
+        start = block * time_chunk
+        for name, array in zip(['depth', 'x_vel', 'y_vel'], buffer):
+            ds[name][start:block_stop, :, :] = array[:block_stop - start]
+
+    with ProcessPoolExecutor(workers) as executor:
+        while True:
+            exited = process.poll() is not None
+            file_paths = list_results(in_path) if os.path.exists(in_path) else []
+            if not exited:
+                # The file for the latest time step may still be being written
+                file_paths = file_paths[:-1]
+            file_paths = [path for path in file_paths if path not in done]
+
+            if len(file_paths) > 0:
+                if ds is None:
+                    res, unique_x, unique_y, x_index, y_index = read_locations(file_paths[0])
+                    if series is not None:
+                        series.locate(res, unique_x, unique_y)
+                    if chunks == 'auto':
+                        chunks = analysis_ready_chunks(n_times or 1, len(unique_y), len(unique_x))
+                    ds = create_netcdf(out_path, unique_x, unique_y, None, start_time, srid, attributes, chunks,
+                                       **encoding)
+                    arrays = np.full((len(variables), len(unique_y), len(unique_x)), np.nan, dtype=np.float32)
+                    maxima = RunningMaxima(arrays.shape[1:])
+                    # Time steps are buffered until the chunks containing them are complete, as in to_netcdf
+                    time_chunk = chunks[0] if chunks is not None else 1
+                    buffer = np.full((len(variables), time_chunk, len(unique_y), len(unique_x)), fill_value,
+                                     dtype=np.float32)
+
+                if exited:
+                    n_waiting = len(file_paths)
+                for path, values in zip(file_paths, ordered_map(executor, read_results, file_paths, ahead=2 * workers)):
+                    step = path_to_step(path)
+                    if step // time_chunk != block:
+                        if block is not None:
+                            flush()
+                            buffer[:] = fill_value
+                        block = step // time_chunk
+                    arrays[:, y_index, x_index] = values
+                    buffer[:, step % time_chunk] = np.nan_to_num(arrays, nan=fill_value)
+                    block_stop = max(block_stop, step + 1)
+                    ds['time'][step] = path_to_time(path)
+                    # The maxima are taken from the values as stored in the netCDF file, so they are the same as
+                    # those calculated from it after the simulation
+                    maxima.update(*quantize(arrays, encoding.get('least_significant_digit', least_significant_digit)))
+                    if series is not None:
+                        series.add(step, path_to_time(path), arrays)
+                    done.add(path)
+                if callback is not None:
+                    ds.sync()
+                    callback(file_paths)
+
+            if exited:
+                break
+            time.sleep(interval)
+
+    if ds is None:
+        return None
+    if block is not None:
+        flush()
+    ds.close()
+
+    logger.info(f'---- Converted {len(done)} results files while CityCAT was running, '
+                f'{n_waiting} remained when it exited')
+    return maxima, unique_x, unique_y
+
+
+def to_geotiff(in_path, out_path, srid: int = None, delimiter: str = ','):
+    """Converts single CityCAT results file to GeoTIFF
+
+    Drop-in replacement for :func:`citycatio.output.to_geotiff` which only parses the required columns.
+
+    Args:
+        in_path: path where CityCAT results file is located
+        out_path: path to create GeoTIFF file
+        srid: EPSG Spatial Reference System Identifier of results file
+        delimiter: Delimiter to use when reading the results file
+    """
+    import rasterio as rio
+    from rasterio.transform import from_origin
+
+    df = pd.read_csv(in_path, usecols=['XCen', 'YCen', 'Depth'], delimiter=delimiter, engine='c')
+
+    res, unique_x, unique_y, x_index, y_index = get_transform(df.XCen, df.YCen)
+
+    depth = np.full((len(unique_y), len(unique_x)), fill_value)
+    depth[y_index.values, x_index.values] = df.Depth.values
+
+    with rio.open(
+            out_path,
+            'w',
+            driver='GTiff',
+            height=depth.shape[0],
+            width=depth.shape[1],
+            count=1,
+            dtype=depth.dtype,
+            crs=f'EPSG:{srid}' if srid is not None else None,
+            transform=from_origin(unique_x.min() - res / 2, unique_y.max() + res / 2, res, res),
+            nodata=fill_value,
+            compress='lzw'
+    ) as dst:
+        dst.write(depth, 1)
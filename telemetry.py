@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import platform
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger('citycat-dafni')
+
+
+def cpu_times():
+    """User plus system CPU time of this process and of its terminated child processes"""
+    if resource is None:
+        t = os.times()
+        return t.user + t.system, t.children_user + t.children_system
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size of this process, returns False if this is not supported"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """Peak resident set size in MB of this process and of its largest terminated child process
+
+    The peak of this process is since it was last reset, the peak of the child processes is over the lifetime of the
+    process.
+    """
+    own = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    own = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return own, None
+    if own is None:
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return own, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+class Telemetry:
+    """Wall time, CPU time and peak memory of each pipeline stage
+
+    Stages can be nested, in which case the peak memory of the outer stage includes the inner stages. The peak memory
+    of child processes, such as CityCAT, cannot be reset, so it is recorded once for the whole process.
+    """
+    def __init__(self):
+        self.stages = []
+        self.stack = []
+
+    @contextmanager
+    def stage(self, name):
+        start_cpu, start_children_cpu = cpu_times()
+        record = dict(name=name, start=datetime.now().isoformat(), peak_rss_mb=0)
+        # The peak so far is carried to the enclosing stages before it is reset for this stage
+        own_peak, _ = peak_rss()
+        for outer in self.stack:
+            outer['peak_rss_mb'] = max(outer['peak_rss_mb'], round(own_peak or 0, 1))
+        self.stack.append(record)
+        resettable = reset_peak_rss()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            wall_seconds = time.perf_counter() - start
+            end_cpu, end_children_cpu = cpu_times()
+            own_peak, _ = peak_rss()
+            self.stack.pop()
+            record.update(
+                wall_seconds=round(wall_seconds, 3),
+                cpu_seconds=round(end_cpu - start_cpu, 3),
+                children_cpu_seconds=round(end_children_cpu - start_children_cpu, 3),
+                peak_rss_mb=round(max(record['peak_rss_mb'], own_peak or 0), 1),
+                peak_rss_is_stage=resettable)
+            if len(self.stack) > 0:
+                self.stack[-1]['peak_rss_mb'] = max(self.stack[-1]['peak_rss_mb'], record['peak_rss_mb'])
+            self.stages.append(record)
+            logger.info(f'---- {name} took {wall_seconds:.1f}s')
+
+    def write(self, path, **info):
+        """Writes the stages, the highest peak memory of any stage and any additional information to a JSON file"""
+        peak = max((record['peak_rss_mb'] for record in self.stages), default=None)
+        _, children_peak = peak_rss()
+        with open(path, 'w') as f:
+            json.dump(dict(
+                created=datetime.now().isoformat(),
+                host=platform.node(),
+                python=platform.python_version(),
+                cpus=os.cpu_count(),
+                **info,
+                peak_rss_mb=peak,
+                lifetime_children_peak_rss_mb=round(children_peak, 1) if children_peak is not None else None,
+                stages=self.stages), f, indent=2, default=str)
+        logger.info(f'Peak RSS {peak}MB')
+
+
+telemetry = Telemetry()
+
+
+def stage(name):
+    """Records a pipeline stage using the shared telemetry"""
+    return telemetry.stage(name)
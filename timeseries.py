@@ -0,0 +1,112 @@
+import logging
+import numpy as np
+import pandas as pd
+from surface_maps import fill_value
+
+logger = logging.getLogger('citycat-dafni')
+
+# Variables of the netCDF file, in the order of the surface map columns
+names = ['depth', 'x_vel', 'y_vel']
+
+
+def cell_indices(x, y, res, unique_x, unique_y):
+    """Row and column of the cells containing points, -1 for points outside the grid"""
+    cols = np.round((np.asarray(x, dtype=np.float64) - unique_x[0]) / res).astype(int)
+    rows = np.round((unique_y[0] - np.asarray(y, dtype=np.float64)) / res).astype(int)
+    outside = (cols < 0) | (cols >= len(unique_x)) | (rows < 0) | (rows >= len(unique_y))
+    cols[outside], rows[outside] = -1, -1
+    return rows, cols
+
+
+class PointSeries:
+    """Depth and velocity time series at points, taken from each time step while it is in memory
+
+    The cells containing the points are found once from the grid of the surface maps, after which the values of all
+    points are read from each time step with a single index.
+
+    Args:
+        x: X coordinates of the points
+        y: Y coordinates of the points
+    """
+    def __init__(self, x, y):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.rows = self.cols = None
+        self.times = {}
+        self.values = {}
+
+    def locate(self, res, unique_x, unique_y):
+        """Finds the cells containing the points on the grid of the surface maps"""
+        self.rows, self.cols = cell_indices(self.x, self.y, res, unique_x, unique_y)
+        outside = int((self.rows < 0).sum())
+        if outside > 0:
+            logger.warning(f'{outside} of {len(self.x)} points are outside the domain')
+
+    def add(self, step, minutes, arrays):
+        """Adds a time step
+
+        Args:
+            step: Index of the time step
+            minutes: Time of the time step in minutes
+            arrays: Depth and velocities of every cell, of shape (3, rows, cols)
+        """
+        values = arrays[:, self.rows, self.cols].astype(np.float32)
+        values[:, self.rows < 0] = np.nan
+        values[values == fill_value] = np.nan
+        self.times[step] = minutes
+        self.values[step] = values
+
+    def to_frame(self):
+        """Time series of every point, one row for each point and time step"""
+        steps = sorted(self.values)
+        n = len(self.x)
+        values = np.stack([self.values[step] for step in steps], axis=1) if len(steps) > 0 \
+            else np.empty((len(names), 0, n), dtype=np.float32)
+        frame = pd.DataFrame({
+            'point': np.tile(np.arange(n), len(steps)),
+            'x': np.tile(self.x, len(steps)),
+            'y': np.tile(self.y, len(steps)),
+            'time': np.repeat([self.times[step] for step in steps], n),
+            **{name: array.ravel() for name, array in zip(names, values)},
+        })
+        frame['velocity'] = np.hypot(frame.x_vel, frame.y_vel)
+        # CityCAT writes depths and velocities to 4 decimal places, adding zero removes negative zeros
+        frame[names + ['velocity']] = frame[names + ['velocity']].round(4) + 0
+        return frame
+
+    def to_csv(self, path):
+        self.to_frame().to_csv(path, index=False)
+
+
+def from_netcdf(netcdf_path, x, y):
+    """Extracts the time series at points from a netCDF file created from the surface maps
+
+    Only the rows and columns containing points are read, for all time steps at once.
+
+    Returns:
+        PointSeries: Time series of each point
+    """
+    import netCDF4 as nc
+
+    series = PointSeries(x, y)
+    with nc.Dataset(netcdf_path) as ds:
+        unique_x, unique_y = ds['x'][:].data, ds['y'][:].data
+        series.locate(abs(unique_x[1] - unique_x[0]) if len(unique_x) > 1 else abs(unique_y[1] - unique_y[0]),
+                      unique_x, unique_y)
+        inside = series.rows >= 0
+        rows, row_index = np.unique(series.rows[inside], return_inverse=True)
+        cols, col_index = np.unique(series.cols[inside], return_inverse=True)
+        times = ds['time'][:].data
+
+        values = np.full((len(names), len(times), len(series.x)), np.nan, dtype=np.float32)
+        if inside.any():
+            for i, name in enumerate(names):
+                # Reading the outer product of the rows and columns is a single read of each chunk
+                block = ds[name][:, rows, cols]
+                values[i][:, inside] = np.ma.filled(block, np.nan)[:, row_index, col_index]
+
+    for step, minutes in enumerate(times):
+        series.times[step] = int(minutes)
+        series.values[step] = values[:, step]
+    logger.info(f'---- Extracted {len(times)} time steps at {len(series.x)} points')
+    return series
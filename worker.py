@@ -0,0 +1,235 @@
+"""Runs jobs from a spool directory, paying the cost of importing libraries and starting Wine once per worker
+
+Usage: python worker.py [spool directory]
+
+Each job is a JSON file placed in <spool>/pending, containing the parameters which would otherwise be set as
+environment variables, for example {"parameters": {"SIZE": 0.1, "DURATION": 1, "TOTAL_DEPTH": 40}}.
+The outputs of each job are written to <spool>/outputs/<job> unless an "outputs" path is given.
+Finished jobs are moved to <spool>/done or <spool>/failed along with their latency.
+Jobs left in <spool>/running by a worker which stopped on the same host are requeued when a worker starts, or failed
+once they have been started WORKER_MAX_ATTEMPTS times.
+"""
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import logging
+import subprocess
+import multiprocessing as mp
+from datetime import datetime
+
+startup = time.perf_counter()
+import run  # noqa: E402
+# run.py imports these lazily, so they are imported here to be inherited by each job
+import matplotlib.pyplot as plt  # noqa: E402,F401
+import citycatio  # noqa: E402,F401
+import dem, geometries, future_drainage, surface_maps, hazard, render, input_files  # noqa: E402,F401
+import archiver, exposure, timeseries, preflight  # noqa: E402,F401
+
+logger = logging.getLogger('citycat-dafni')
+
+spool_path = os.getenv('SPOOL_PATH', os.path.join(run.data_path, 'spool'))
+# Seconds to wait between checking for new jobs
+poll_interval = float(os.getenv('WORKER_POLL_INTERVAL', 1))
+# Number of times a job is started before it is failed, if the workers running it stop
+max_attempts = int(os.getenv('WORKER_MAX_ATTEMPTS', 2))
+# Jobs are claimed by moving them to a directory of running jobs named after the worker
+hostname = socket.gethostname()
+worker_name = f'{hostname}-{os.getpid()}'
+
+
+def start_wine():
+    """Initialises the Wine prefix and keeps wineserver running between jobs"""
+    if os.name == 'nt':
+        return
+    try:
+        subprocess.run(['wineboot', '--init'], check=False)
+        subprocess.run(['wineserver', '--persistent'], check=False)
+    except OSError:
+        logger.warning('Could not start wineserver')
+
+
+def stop_wine():
+    if os.name == 'nt':
+        return
+    try:
+        subprocess.run(['wineserver', '--kill'], check=False)
+    except OSError:
+        pass
+
+
+def claim(name):
+    """Moves a pending job to running, returns False if another worker has claimed it"""
+    try:
+        os.rename(os.path.join(spool_path, 'pending', name), os.path.join(spool_path, 'running', worker_name, name))
+        return True
+    except OSError:
+        return False
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def read_job(job_path):
+    with open(job_path) as f:
+        job = json.load(f)
+    if not isinstance(job, dict):
+        raise ValueError('a job must be a JSON object')
+    return job
+
+
+def finish(job_path, status, result):
+    """Writes the result of a job to the done or failed directory and removes it from running"""
+    with open(os.path.join(spool_path, status, os.path.basename(job_path)), 'w') as f:
+        json.dump(result, f, indent=2)
+    os.remove(job_path)
+
+
+def recover():
+    """Requeues the jobs left in running by workers on this host which have stopped
+
+    Jobs which have already been started max_attempts times, or cannot be read, are failed instead.
+    """
+    for entry in os.scandir(os.path.join(spool_path, 'running')):
+        host, _, pid = entry.name.rpartition('-')
+        if not entry.is_dir() or host != hostname or not pid.isdigit():
+            continue
+        # A restarted container can have the same host name and process ID as the worker it replaces
+        if int(pid) != os.getpid() and alive(int(pid)):
+            continue
+        for name in os.listdir(entry.path):
+            job_path = os.path.join(entry.path, name)
+            try:
+                job = read_job(job_path)
+            except (OSError, ValueError) as e:
+                finish(job_path, 'failed', dict(status='failed', error=f'Could not read job: {e}'))
+                logger.warning(f'Failed unreadable job {name} left by worker {entry.name}')
+                continue
+            attempts = job.get('attempts', 1)
+            if attempts >= max_attempts:
+                finish(job_path, 'failed', dict(job, status='failed',
+                                                error=f'Worker {entry.name} stopped during attempt {attempts}'))
+                logger.warning(f'Failed job {name} left by worker {entry.name} after {attempts} attempts')
+                continue
+            with open(job_path, 'w') as f:
+                json.dump(dict(job, attempts=attempts + 1), f, indent=2)
+            os.rename(job_path, os.path.join(spool_path, 'pending', name))
+            logger.warning(f'Requeued job {name} left by worker {entry.name}')
+        try:
+            os.rmdir(entry.path)
+        except OSError:
+            pass
+
+
+def pending_jobs():
+    """Names of the pending jobs, oldest first"""
+    jobs = []
+    for entry in os.scandir(os.path.join(spool_path, 'pending')):
+        try:
+            if entry.name.endswith('.json'):
+                jobs.append((entry.stat().st_mtime, entry.name))
+        except OSError:
+            # Claimed by another worker
+            pass
+    return [name for _, name in sorted(jobs)]
+
+
+def run_job(job, outputs_path):
+    # Runs in a forked process, so the environment and paths of the worker are left unchanged
+    os.environ.update({key: str(value) for key, value in job.get('parameters', {}).items()})
+    os.makedirs(outputs_path, exist_ok=True)
+    run.outputs_path = outputs_path
+    run.main()
+
+
+def process(name, context, startup_seconds):
+    job_path = os.path.join(spool_path, 'running', worker_name, name)
+    queued = os.path.getmtime(job_path)
+    try:
+        job = read_job(job_path)
+    except (OSError, ValueError) as e:
+        # A job which cannot be read is failed rather than stopping the worker
+        finish(job_path, 'failed', dict(status='failed', error=f'Could not read job: {e}',
+                                        queued=datetime.fromtimestamp(queued).isoformat()))
+        logger.error(f'Could not read job {name}: {e}')
+        return None
+    job_id = os.path.splitext(name)[0]
+    outputs_path = job.get('outputs', os.path.join(spool_path, 'outputs', job_id))
+
+    logger.info(f'Starting job {job_id}')
+    started = time.time()
+    child = context.Process(target=run_job, args=(job, outputs_path))
+    child.start()
+    child.join()
+    finished = time.time()
+
+    status = 'done' if child.exitcode == 0 else 'failed'
+    result = dict(
+        job,
+        outputs=outputs_path,
+        status=status,
+        exit_code=child.exitcode,
+        queued=datetime.fromtimestamp(queued).isoformat(),
+        started=datetime.fromtimestamp(started).isoformat(),
+        queue_seconds=round(started - queued, 3),
+        run_seconds=round(finished - started, 3),
+        latency_seconds=round(finished - queued, 3),
+        worker_startup_seconds=round(startup_seconds, 3))
+    finish(job_path, status, result)
+
+    logger.info(f'Job {job_id} {status} in {result["run_seconds"]:.1f}s, '
+                f'{result["latency_seconds"]:.1f}s after it was queued')
+    return result
+
+
+def main():
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    start_wine()
+    startup_seconds = time.perf_counter() - startup
+    logger.info(f'Worker started in {startup_seconds:.1f}s, watching {spool_path}')
+
+    for directory in ['pending', 'running', 'done', 'failed', 'outputs']:
+        os.makedirs(os.path.join(spool_path, directory), exist_ok=True)
+    recover()
+    os.makedirs(os.path.join(spool_path, 'running', worker_name), exist_ok=True)
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+
+    # Jobs inherit the imported libraries by forking the worker
+    context = mp.get_context('fork' if os.name != 'nt' else 'spawn')
+    try:
+        while not stopping:
+            pending = pending_jobs()
+            for name in pending:
+                if stopping:
+                    break
+                if claim(name):
+                    process(name, context, startup_seconds)
+            if len(pending) == 0:
+                time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_wine()
+        try:
+            os.rmdir(os.path.join(spool_path, 'running', worker_name))
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        spool_path = sys.argv[1]
+    main()